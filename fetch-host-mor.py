@@ -4,6 +4,24 @@ fetch-host-mor is a Python script which will provide the MOR details of one or a
 --- Usage ---
 Run 'fetch-host-mor.py -h' for an overview
 
+--- Multiple vCenters ---
+Multiple vCenters can be provided on the command line and/or in a file with one vCenter per line. They are handled concurrently by a bounded amount of threads, and the results are merged into one table or JSON document with a vCenter column. A vCenter that does not finish within the timeout is reported as failed and disconnected, without holding up the report for the other vCenters. Once it is reported, no more of its hosts are printed.
+
+--- Streaming output ---
+With the NDJSON output, each host is printed as a JSON object on its own line as soon as it is retrieved, instead of after all vCenters are done.
+
+--- Scope ---
+The hosts can be limited to a datacenter, a cluster and/or a shell-style name pattern. The container view is then rooted at the datacenter or cluster, so only the hosts inside it are retrieved. With a name pattern, only the names are retrieved first and the details only for the matching hosts. A single host is looked up by the server through the search index.
+
+--- Watch mode ---
+In watch mode one session per vCenter is kept open, with a property collector filter on the name and HW UUID of all hosts. Instead of a report, events are printed as JSON lines: an add event for every host when the watch starts and whenever a host is added, a remove event when a host is removed and a modify event when a host is renamed or its HW UUID changes. When the session is lost, the watch reconnects and only reports the differences.
+
+--- Cache ---
+A cache file can be provided to store the name, MOR and HW UUID of all hosts, keyed by the vCenter instance UUID. As long as the cache for a vCenter is younger than the cache TTL, lookups for that vCenter are answered from the cache without logging in. When every vCenter is answered from the cache, pyVmomi is not loaded at all, and with JSON or NDJSON output neither is prettytable. A host that is not in the cache is looked up in vCenter, as it might have been added since. The cache is only refreshed by complete scans of a vCenter.
+
+--- Transport ---
+For vCenters behind slow links, the SOAP responses can be requested gzip compressed and the hosts can be retrieved in larger pages, so fewer round trips are needed. The transfer statistics report the bytes of the SOAP responses on the wire and after decompression, to see what the compression saves. Recent pyVmomi versions already ask for compressed responses by default, older versions need to support custom HTTP headers on connect for the compression option.
+
 --- Author ---
 Philippe Dellaert <philippe@dellaert.org>
 
@@ -12,16 +30,29 @@ https://raw.github.com/pdellaert/vSphere-Python/master/LICENSE.md
 
 """
 
+from __future__ import print_function
+
 from builtins import str
 import argparse
-import atexit
+import fnmatch
 import json
 import getpass
 import logging
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import vsphere_helpers
 
-from prettytable import PrettyTable
-from pyVim.connect import SmartConnect, SmartConnectNoSSL, Disconnect
-from pyVmomi import vim, vmodl
+from time import sleep, time
+from vsphere_helpers import transport, get_connect_args, count_transfer, print_transfer_stats
+
+# Loaded by import_vsphere_modules once a vCenter has to be contacted, so the help, argument errors and cached lookups start quickly
+Disconnect = None
+vim = None
+vmodl = None
+ThreadPool = None
 
 
 def get_args():
@@ -30,23 +61,396 @@ def get_args():
     """
 
     parser = argparse.ArgumentParser(description="Randomly vMotion each VM from a list one by one to a random host from a list, until stopped.")
+    parser.add_argument('-c', '--cache-file', nargs=1, required=False, help='File to cache the host details in, lookups are answered from it while it is not older than the cache TTL (default = no cache)', dest='cachefile', type=str)
+    parser.add_argument('--cache-ttl', nargs=1, required=False, help='Amount of seconds the cache of a vCenter is valid (default = 3600)', dest='cache_ttl', type=int, default=[3600])
+    parser.add_argument('--cluster', nargs=1, required=False, help='Only return hosts in this cluster', dest='cluster', type=str)
+    parser.add_argument('--compress', required=False, help='Request gzip compressed SOAP responses from the vCenters, for vCenters behind slow links', dest='compress', action='store_true')
+    parser.add_argument('--datacenter', nargs=1, required=False, help='Only return hosts in this datacenter', dest='datacenter', type=str)
     parser.add_argument('-d', '--debug', required=False, help='Enable debug output', dest='debug', action='store_true')
     parser.add_argument('-H', '--host', nargs=1, required=False, help='The host for which to return the MOR details, if not provided, provides MOR details for all ESXi hosts', dest='host', type=str)
     parser.add_argument('-j', '--json', required=False, help='Print as JSON, not as a table', dest='json_output', action='store_true')
+    parser.add_argument('-N', '--name-pattern', nargs=1, required=False, help='Only return hosts with a name matching this shell-style pattern, for instance "esxi-*.example.com"', dest='pattern', type=str)
+    parser.add_argument('-n', '--ndjson', required=False, help='Print each host as a JSON line as soon as it is retrieved', dest='ndjson_output', action='store_true')
     parser.add_argument('-l', '--log-file', nargs=1, required=False, help='File to log to (default = stdout)', dest='logfile', type=str)
     parser.add_argument('-o', '--port', nargs=1, required=False, help='Server port to connect to (default = 443)', dest='port', type=int, default=[443])
+    parser.add_argument('--page-size', nargs=1, required=False, help='Maximum amount of hosts retrieved in each page of a property retrieval, larger pages need fewer round trips (default = decided by vCenter)', dest='page_size', type=int)
     parser.add_argument('-p', '--password', nargs=1, required=False, help='The password with which to connect to the host. If not specified, the user is prompted at runtime for a password', dest='password', type=str)
     parser.add_argument('-S', '--disable-SSL-certificate-verification', required=False, help='Disable SSL certificate verification on connect', dest='nosslcheck', action='store_true')
+    parser.add_argument('-t', '--timeout', nargs=1, required=False, help='Maximum amount of seconds to wait for each vCenter, a vCenter that takes longer is reported as failed (default = 300)', dest='timeout', type=int, default=[300])
+    parser.add_argument('--transfer-stats', required=False, help='Print the bytes of the SOAP responses on the wire and after decompression to stderr when done', dest='transfer_stats', action='store_true')
+    parser.add_argument('-T', '--threads', nargs=1, required=False, help='Amount of vCenters to handle at once (default = 8)', dest='threads', type=int, default=[8])
     parser.add_argument('-u', '--user', nargs=1, required=True, help='The username with which to connect to the host', dest='username', type=str)
     parser.add_argument('-v', '--verbose', required=False, help='Enable verbose output', dest='verbose', action='store_true')
-    parser.add_argument('-V', '--vcenter', nargs=1, required=True, help='The vCenter or ESXi host to connect to', dest='vcenter', type=str)
+    parser.add_argument('-w', '--watch', required=False, help='Keep watching the hosts and print add, remove and modify events as JSON lines until stopped', dest='watch', action='store_true')
+    parser.add_argument('-V', '--vcenter', nargs='+', required=False, help='One or more vCenter or ESXi hosts to connect to', dest='vcenter', type=str)
+    parser.add_argument('-F', '--vcenter-file', nargs=1, required=False, help='File with a list of vCenter or ESXi hosts to connect to, one per line', dest='vcenterfile', type=str)
     args = parser.parse_args()
     return args
 
 
+def import_vsphere_modules():
+    """
+    Imports pyVmomi, pyVim and the thread pool, which take most of the startup time of the script
+    """
+
+    global Disconnect, vim, vmodl, ThreadPool
+    if vim is None:
+        from pyVim.connect import Disconnect
+        from pyVmomi import vim, vmodl
+        from multiprocessing.dummy import Pool as ThreadPool
+
+
+def get_properties(si, logger, vimtype, properties, root=None, objs=None):
+    """
+    Retrieve properties of objects with the shared paged property retrieval, with the page size of the transport settings
+    """
+
+    return vsphere_helpers.get_properties(si, logger, vimtype, properties, root=root, objs=objs, page_size=transport['page_size'])
+
+
+def find_obj(si, logger, name, vimtype, root=None):
+    """
+    Find an object in vSphere by it's name, only retrieving the names of the objects, and return it
+    """
+
+    return vsphere_helpers.find_obj(si, logger, name, vimtype, root=root, page_size=transport['page_size'])
+
+
+def find_scope(si, logger, vcenter, scope):
+    """
+    Returns the datacenter and the entity to root the host container view at, based on the datacenter and cluster of the scope
+    """
+
+    datacenter = None
+    root = si.content.rootFolder
+    if scope['datacenter']:
+        logger.debug('%s - Finding datacenter %s' % (vcenter, scope['datacenter']))
+        datacenter = find_obj(si, logger, scope['datacenter'], vim.Datacenter)
+        if datacenter is None:
+            logger.error('Datacenter %s does not exist in vCenter %s' % (scope['datacenter'], vcenter))
+            return None, None
+        root = datacenter.hostFolder
+    if scope['cluster']:
+        logger.debug('%s - Finding cluster %s' % (vcenter, scope['cluster']))
+        root = find_obj(si, logger, scope['cluster'], vim.ClusterComputeResource, root=root)
+        if root is None:
+            logger.error('Cluster %s does not exist in vCenter %s' % (scope['cluster'], vcenter))
+            return None, None
+    return datacenter, root
+
+
+def host_matches(name, host, scope):
+    """
+    Checks a host name against the requested host and the name pattern of the scope
+    """
+
+    if host is not None and name != host:
+        return False
+    if scope['pattern'] and not fnmatch.fnmatchcase(name or '', scope['pattern']):
+        return False
+    return True
+
+
+def connect_vcenter(logger, vcenter, port, username, password, nosslcheck):
+    """
+    Connects to a vCenter and returns the service instance, or None if the connection failed
+    """
+
+    si = None
+    try:
+        logger.info('Connecting to server %s:%s with username %s' % (vcenter, port, username))
+        si = vsphere_helpers.smart_connect(vcenter, username, password, int(port), nosslcheck, **get_connect_args())
+    except IOError as e:
+        pass
+
+    if not si:
+        logger.error('Could not connect to host %s with user %s and specified password' % (vcenter, username))
+    elif transport['stats']:
+        count_transfer(si)
+    return si
+
+
+def vcenter_handler(logger, vcenter, port, username, password, nosslcheck, host, scope, session, emit, keep_all):
+    """
+    Connects to a vCenter and returns the MOR details of one or all of its ESXi hosts. If emit is set, matching hosts are passed to it as they arrive instead of being returned. If keep_all is set, the details of all hosts are returned as well, for the cache, which requires a scan of all hosts.
+    The session of the vCenter is kept in session, so it can be cancelled and disconnected once the vCenter passes the timeout.
+    """
+
+    session['started'] = time()
+    si = connect_vcenter(logger, vcenter, port, username, password, nosslcheck)
+    if not si:
+        return None
+    with session['lock']:
+        if session['cancelled']:
+            Disconnect(si)
+            return None
+        session['si'] = si
+
+    try:
+        result = {
+            'instance_uuid': si.content.about.instanceUuid,
+            'records': [],
+            'all_records': [] if keep_all else None
+        }
+        found_host = False
+
+        datacenter, root = find_scope(si, logger, vcenter, scope)
+        if root is None:
+            return None
+
+        if keep_all:
+            # Complete scan for the cache, filtering locally
+            esxi_hosts = get_properties(si, logger, vim.HostSystem, ['name', 'summary.hardware.uuid'])
+        elif host is not None:
+            # Single host, looked up by the server through the search index, with a scan of the names in the scope as fallback
+            logger.debug('%s - Looking up host %s in the search index' % (vcenter, host))
+            esxi_host = si.content.searchIndex.FindByDnsName(datacenter=datacenter, dnsName=host, vmSearch=False)
+            if esxi_host is not None and scope['cluster'] and esxi_host.parent != root:
+                esxi_host = None
+            if esxi_host is not None and esxi_host.name != host:
+                # The DNS name of a host can differ from its inventory name, which is what is requested
+                logger.debug('%s - Host found in the search index for %s is named %s' % (vcenter, host, esxi_host.name))
+                esxi_host = None
+            if esxi_host is None:
+                logger.debug('%s - Host %s not found in the search index, checking the names in the scope' % (vcenter, host))
+                esxi_host = find_obj(si, logger, host, vim.HostSystem, root=root)
+            esxi_hosts = get_properties(si, logger, vim.HostSystem, ['name', 'summary.hardware.uuid'], objs=[esxi_host] if esxi_host else [])
+        elif scope['pattern']:
+            # Only the names are retrieved for all hosts in the scope, the details only for the matching ones
+            matching_hosts = [obj for obj, properties in get_properties(si, logger, vim.HostSystem, ['name'], root=root) if host_matches(properties.get('name'), host, scope)]
+            logger.debug('%s - %s hosts match pattern %s' % (vcenter, len(matching_hosts), scope['pattern']))
+            esxi_hosts = get_properties(si, logger, vim.HostSystem, ['name', 'summary.hardware.uuid'], objs=matching_hosts)
+        else:
+            esxi_hosts = get_properties(si, logger, vim.HostSystem, ['name', 'summary.hardware.uuid'], root=root)
+
+        # Getting hosts
+        for esxi_host, properties in esxi_hosts:
+            esxi_host_name = properties.get('name')
+            logger.debug('%s - Found Host %s' % (vcenter, esxi_host_name))
+            record = {
+                'vCenter': vcenter,
+                'Name': esxi_host_name,
+                'MOR value': esxi_host._moId,
+                'HW UUID': properties.get('summary.hardware.uuid')
+            }
+            if keep_all:
+                result['all_records'].append(record)
+            if not host_matches(esxi_host_name, host, scope):
+                continue
+            found_host = True
+            logger.debug('%s - name: %s, mor: %s, hw uuid: %s' % (vcenter, record['Name'], record['MOR value'], record['HW UUID']))
+            if emit:
+                with session['lock']:
+                    if session['cancelled']:
+                        return None
+                    emit(record)
+            else:
+                result['records'].append(record)
+
+        if host is not None and not found_host:
+            logger.error('Host %s does not exist in vCenter %s' % (host, vcenter))
+        return result
+    finally:
+        with session['lock']:
+            si = session['si']
+            session['si'] = None
+        if si is not None:
+            Disconnect(si)
+
+
+def cancel_vcenter_session(logger, vcenter, session):
+    """
+    Cancels the handling of a vCenter which passed the timeout: it stops emitting hosts and its session is disconnected
+    """
+
+    with session['lock']:
+        session['cancelled'] = True
+        si = session['si']
+        session['si'] = None
+    if si is not None:
+        logger.debug('Disconnecting from vCenter %s' % vcenter)
+        try:
+            Disconnect(si)
+        except Exception as e:
+            logger.debug('Unable to disconnect from vCenter %s: %s' % (vcenter, str(e)))
+
+
+def vcenter_watch_handler(logger, vcenter, port, username, password, nosslcheck, host, scope, emit, stop):
+    """
+    Keeps a session to a vCenter open and emits add, remove and modify events for its ESXi hosts until stopped. Returns 1 if the scope does not exist in the vCenter, 0 once stopped.
+    """
+
+    hosts = {}
+    while not stop.is_set():
+        si = connect_vcenter(logger, vcenter, port, username, password, nosslcheck)
+        if not si:
+            logger.warning('%s - Retrying connection in 30 seconds' % vcenter)
+            stop.wait(30)
+            continue
+
+        try:
+            content = si.content
+            datacenter, root = find_scope(si, logger, vcenter, scope)
+            if root is None:
+                logger.error('Not watching vCenter %s' % vcenter)
+                return 1
+            obj_view = content.viewManager.CreateContainerView(root, [vim.HostSystem], True)
+            collector = content.propertyCollector.CreatePropertyCollector()
+            traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+            filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj_view, skip=True, selectSet=[traversal_spec])]
+            filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vim.HostSystem, pathSet=['name', 'summary.hardware.uuid'])]
+            collector.CreateFilter(filter_spec, partialUpdates=True)
+
+            version = ''
+            synced = False
+            seen = set()
+            while not stop.is_set():
+                update_set = collector.WaitForUpdatesEx(version, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0 if not synced else 30, maxObjectUpdates=transport['page_size']))
+                if update_set is None:
+                    if not synced:
+                        # The initial state is complete, hosts that disappeared while disconnected are removed
+                        for moid in [moid for moid in hosts if moid not in seen]:
+                            emit_host_event(emit, host, scope, 'remove', hosts.pop(moid), None)
+                        synced = True
+                    continue
+                version = update_set.version
+                for filter_update in update_set.filterSet:
+                    for object_update in filter_update.objectSet:
+                        moid = object_update.obj._moId
+                        seen.add(moid)
+                        if object_update.kind == 'leave':
+                            if moid in hosts:
+                                emit_host_event(emit, host, scope, 'remove', hosts.pop(moid), None)
+                            continue
+                        old_record = hosts.get(moid)
+                        record = dict(old_record or {'vCenter': vcenter, 'Name': None, 'MOR value': moid, 'HW UUID': None})
+                        for change in object_update.changeSet:
+                            if change.name == 'name':
+                                record['Name'] = change.val
+                            elif change.name == 'summary.hardware.uuid':
+                                record['HW UUID'] = change.val
+                        hosts[moid] = record
+                        if old_record is None:
+                            emit_host_event(emit, host, scope, 'add', record, None)
+                        elif old_record != record:
+                            emit_host_event(emit, host, scope, 'modify', record, old_record)
+        except vmodl.MethodFault as e:
+            logger.warning('%s - Watch failed, reconnecting in 10 seconds: %s' % (vcenter, e.msg))
+            stop.wait(10)
+        except Exception as e:
+            logger.warning('%s - Watch failed, reconnecting in 10 seconds: %s' % (vcenter, str(e)))
+            stop.wait(10)
+        finally:
+            try:
+                Disconnect(si)
+            except Exception:
+                pass
+    return 0
+
+
+def emit_host_event(emit, host, scope, event, record, old_record):
+    """
+    Emits a watch event for a host, if its new or old name matches the requested host and the name pattern of the scope
+    """
+
+    if not host_matches(record['Name'], host, scope) and (old_record is None or not host_matches(old_record['Name'], host, scope)):
+        return
+    event_record = dict(record, event=event)
+    if old_record is not None:
+        event_record['changes'] = dict((key, {'old': old_record[key], 'new': record[key]}) for key in record if old_record[key] != record[key])
+    emit(event_record)
+
+
+def load_cache(logger, cachefile):
+    """
+    Loads the host cache, an empty cache is returned if the file does not exist or can not be read
+    """
+
+    cache = {'vcenters': {}, 'instances': {}}
+    if not os.path.isfile(cachefile):
+        return cache
+    try:
+        with open(cachefile, 'r') as cache_fd:
+            loaded = json.load(cache_fd)
+        cache['vcenters'].update(loaded.get('vcenters', {}))
+        cache['instances'].update(loaded.get('instances', {}))
+    except (IOError, ValueError) as e:
+        logger.warning('Unable to read cache file %s, ignoring it: %s' % (cachefile, str(e)))
+    return cache
+
+
+def save_cache(logger, cachefile, cache):
+    """
+    Writes the host cache to a temporary file and moves it in place, so concurrent readers never see a partial file
+    """
+
+    cachedir = os.path.dirname(os.path.abspath(cachefile))
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, prefix='.fetch-host-mor-')
+        with os.fdopen(fd, 'w') as cache_fd:
+            json.dump(cache, cache_fd, sort_keys=True)
+        os.rename(tmpfile, cachefile)
+        logger.debug('Cache written to %s' % cachefile)
+    except (IOError, OSError) as e:
+        logger.warning('Unable to write cache file %s: %s' % (cachefile, str(e)))
+
+
+def get_cached_records(cache, vcenter, port, cache_ttl):
+    """
+    Returns the cached host details of a vCenter, or None if there is no cache or it is older than the TTL
+    """
+
+    instance_uuid = cache['vcenters'].get('%s:%s' % (vcenter, port))
+    if instance_uuid is None or instance_uuid not in cache['instances']:
+        return None
+    instance = cache['instances'][instance_uuid]
+    if time() - instance.get('updated', 0) > cache_ttl:
+        return None
+    return [dict(record, **{'vCenter': vcenter}) for record in instance.get('hosts', [])]
+
+
+def watch_vcenters(logger, vcenters, port, username, password, nosslcheck, host, scope, emit):
+    """
+    Watches all vCenters, each in its own thread, until interrupted. Returns 1 if a vCenter could not be watched.
+    """
+
+    stop = threading.Event()
+    logger.debug('Setting up pool with %s threads to watch %s vCenters' % (len(vcenters), len(vcenters)))
+    pool = ThreadPool(len(vcenters))
+    watch_results = [pool.apply_async(vcenter_watch_handler, (logger, vcenter, port, username, password, nosslcheck, host, scope, emit, stop)) for vcenter in vcenters]
+    try:
+        while not all(result.ready() for result in watch_results):
+            sleep(1)
+    except KeyboardInterrupt:
+        logger.info('Received interrupt, stopping the watch')
+    stop.set()
+    pool.terminate()
+
+    if any(result.ready() and (not result.successful() or result.get() != 0) for result in watch_results):
+        logger.info('Finished, but not all vCenters were watched')
+        return 1
+    return 0
+
+
+def read_vcenter_file(logger, filename):
+    """
+    Returns the list of vCenters in a file, one per line
+    """
+
+    vcenters = []
+    with open(filename, 'r') as vcenter_file:
+        for line in vcenter_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                logger.debug('Found vCenter %s in %s' % (line, filename))
+                vcenters.append(line)
+    return vcenters
+
+
 def main():
     """
-    Find one or all ESXi hosts and print the MOR information
+    Find one or all ESXi hosts in one or more vCenters and print the MOR information
     """
 
     # Handling arguments
@@ -55,7 +459,13 @@ def main():
     host = None
     if args.host:
         host = args.host[0]
+    compress = args.compress
     json_output = args.json_output
+    ndjson_output = args.ndjson_output
+    cachefile = None
+    if args.cachefile:
+        cachefile = args.cachefile[0]
+    cache_ttl = args.cache_ttl[0]
     log_file = None
     if args.logfile:
         log_file = args.logfile[0]
@@ -64,9 +474,26 @@ def main():
     if args.password:
         password = args.password[0]
     nosslcheck = args.nosslcheck
+    page_size = None
+    if args.page_size:
+        page_size = args.page_size[0]
+    timeout = args.timeout[0]
+    threads = args.threads[0]
+    transfer_stats = args.transfer_stats
     username = args.username[0]
     verbose = args.verbose
-    vcenter = args.vcenter[0]
+    vcenters = []
+    if args.vcenter:
+        vcenters = args.vcenter
+    vcenterfile = None
+    if args.vcenterfile:
+        vcenterfile = args.vcenterfile[0]
+    watch = args.watch
+    scope = {
+        'datacenter': args.datacenter[0] if args.datacenter else None,
+        'cluster': args.cluster[0] if args.cluster else None,
+        'pattern': args.pattern[0] if args.pattern else None
+    }
 
     # Logging settings
     if debug:
@@ -82,89 +509,174 @@ def main():
         logging.basicConfig(filename=log_file, format='%(asctime)s %(levelname)s %(message)s', level=log_level)
     logger = logging.getLogger(__name__)
 
-    if json_output:
-        logger.debug('Setting up json output')
-        json_object = []
-    else:
-        logger.debug('Setting up basic output table')
-        pt = PrettyTable(['Name', 'MOR value', 'HW UUID'])
+    # Transport settings
+    if page_size is not None and page_size < 1:
+        logger.critical('The page size has to be at least 1, exiting')
+        return 1
+    transport['compress'] = compress
+    transport['page_size'] = page_size
+    transport['stats'] = transfer_stats
+
+    # Handling vCenter file
+    if vcenterfile:
+        logger.debug('Parsing vCenters %s' % vcenterfile)
+        if not os.path.isfile(vcenterfile):
+            logger.critical('vCenter file %s does not exist, exiting' % vcenterfile)
+            return 1
+        vcenters = vcenters + [vcenter for vcenter in read_vcenter_file(logger, vcenterfile) if vcenter not in vcenters]
+
+    if not vcenters:
+        logger.critical('No vCenter provided, use the vcenter or vcenter-file option')
+        return 1
+
+    # Output handling, NDJSON records are printed as soon as they arrive
+    output_lock = threading.Lock()
+
+    def emit_record(record):
+        with output_lock:
+            print(json.dumps(record, sort_keys=True))
+            sys.stdout.flush()
+
+    emit = None
+    if ndjson_output or watch:
+        logger.debug('Setting up NDJSON output')
+        emit = emit_record
+
+    # Answering from the cache where possible
+    results = {}
+    cache = None
+    if cachefile and (scope['datacenter'] or scope['cluster']):
+        logger.info('The cache does not contain the datacenter and cluster of the hosts, not using it for a scoped query')
+    elif cachefile and not watch:
+        logger.debug('Loading cache %s' % cachefile)
+        cache = load_cache(logger, cachefile)
+        for vcenter in vcenters:
+            cached_records = get_cached_records(cache, vcenter, port, cache_ttl)
+            if cached_records is None:
+                logger.debug('No valid cache for vCenter %s' % vcenter)
+                continue
+            records = [record for record in cached_records if host_matches(record['Name'], host, scope)]
+            if host is not None and not records:
+                logger.debug('Host %s not in the cache for vCenter %s, it might have been added since' % (host, vcenter))
+                continue
+            logger.info('Using cache for vCenter %s' % vcenter)
+            if emit:
+                for record in records:
+                    emit(record)
+                records = []
+            results[vcenter] = {'records': records}
+    uncached_vcenters = [vcenter for vcenter in vcenters if vcenter not in results]
 
     # Getting user password
-    if password is None:
+    if password is None and uncached_vcenters:
         logger.debug('No command line password received, requesting password from user')
-        password = getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (host, username))
+        password = getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (', '.join(uncached_vcenters), username))
 
+    if watch or uncached_vcenters:
+        logger.debug('Loading the vSphere modules')
+        import_vsphere_modules()
+
+    if watch:
+        result = watch_vcenters(logger, vcenters, port, username, password, nosslcheck, host, scope, emit)
+        if transport['stats']:
+            print_transfer_stats('Transfer statistics')
+        return result
+
+    pool = None
+    failed = False
     try:
-        si = None
-        try:
-            logger.info('Connecting to server %s:%s with username %s' % (vcenter, port, username))
-            if nosslcheck:
-                si = SmartConnectNoSSL(host=vcenter, user=username, pwd=password, port=int(port))
-            else:
-                si = SmartConnect(host=vcenter, user=username, pwd=password, port=int(port))
-        except IOError as e:
-            pass
+        # Pool handling, only needed for the vCenters which are not answered from the cache
+        sessions = {}
+        pending = {}
+        if uncached_vcenters:
+            threads = max(1, min(threads, len(uncached_vcenters)))
+            logger.debug('Setting up pool with %s threads for %s vCenters' % (threads, len(uncached_vcenters)))
+            pool = ThreadPool(threads)
+        for vcenter in uncached_vcenters:
+            sessions[vcenter] = {'started': None, 'si': None, 'cancelled': False, 'lock': threading.Lock()}
+            pending[vcenter] = pool.apply_async(vcenter_handler, (logger, vcenter, port, username, password, nosslcheck, host, scope, sessions[vcenter], emit, cache is not None))
 
-        if not si:
-            logger.error('Could not connect to host %s with user %s and specified password' % (vcenter, username))
-            return 1
+        # Collecting results as they finish, a vCenter that takes longer than the timeout is abandoned
+        while pending:
+            for vcenter in list(pending.keys()):
+                if pending[vcenter].ready():
+                    try:
+                        results[vcenter] = pending[vcenter].get()
+                    except vmodl.MethodFault as e:
+                        logger.error('Caught vmodl fault for vCenter %s: %s' % (vcenter, e.msg))
+                        results[vcenter] = None
+                    except Exception as e:
+                        logger.error('Caught exception for vCenter %s: %s' % (vcenter, str(e)))
+                        results[vcenter] = None
+                    del pending[vcenter]
+                elif sessions[vcenter]['started'] is not None and time() - sessions[vcenter]['started'] > timeout:
+                    logger.error('vCenter %s did not finish within %s seconds, skipping' % (vcenter, timeout))
+                    cancel_vcenter_session(logger, vcenter, sessions[vcenter])
+                    results[vcenter] = None
+                    del pending[vcenter]
+            if pending:
+                sleep(0.1)
 
-        logger.debug('Registering disconnect at exit')
-        atexit.register(Disconnect, si)
+        # Updating the cache with the complete scans
+        if cache is not None and uncached_vcenters:
+            for vcenter in uncached_vcenters:
+                if results.get(vcenter) is None:
+                    continue
+                cache['vcenters']['%s:%s' % (vcenter, port)] = results[vcenter]['instance_uuid']
+                cache['instances'][results[vcenter]['instance_uuid']] = {
+                    'updated': time(),
+                    'hosts': [dict((key, value) for key, value in record.items() if key != 'vCenter') for record in results[vcenter]['all_records']]
+                }
+            save_cache(logger, cachefile, cache)
 
-        # Getting hosts
-        content = si.content
-        obj_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.HostSystem], True)
-        esxi_host_list = obj_view.view
-        esxi_hosts = []
-        found_host = False
-        for esxi_host in esxi_host_list:
-            logger.debug('Found Host %s' % esxi_host.name)
-            if host == None:
-                esxi_hosts.append(esxi_host)
-            elif esxi_host.name == host:
-                esxi_hosts.append(esxi_host)
-                found_host = True
-                break
-
-        if host != None and not found_host:
-            logger.error('Host %s does not exist' % host)
-
-        for esxi_host in esxi_hosts:
-            esxi_host_name = esxi_host.name
-            esxi_host_mor = str(esxi_host).split(':')[1].replace("'", '')
-            esxi_host_hw_uuid = esxi_host.summary.hardware.uuid
-            logger.debug('name: %s, mor: %s, hw uuid: %s' % (esxi_host_name, esxi_host_mor, esxi_host_hw_uuid))
-            if json_output:
-                json_dict = {
-                        'Name': esxi_host_name,
-                        'MOR value': esxi_host_mor,
-                        'HW UUID': esxi_host_hw_uuid
-                    }
-                json_object.append(json_dict)
-            else: 
-                pt.add_row([esxi_host_name, esxi_host_mor, esxi_host_hw_uuid])
-
-        if json_output:
+        # With NDJSON output the hosts have already been printed, so no table is needed
+        if ndjson_output:
+            pass
+        elif json_output:
+            logger.debug('Setting up json output')
+            json_object = []
+        else:
+            logger.debug('Setting up basic output table')
+            from prettytable import PrettyTable
+            pt = PrettyTable(['vCenter', 'Name', 'MOR value', 'HW UUID'])
+
+        for vcenter in vcenters:
+            if results.get(vcenter) is None:
+                failed = True
+                continue
+            if ndjson_output:
+                continue
+            for record in results[vcenter]['records']:
+                if json_output:
+                    json_object.append(record)
+                else:
+                    pt.add_row([record['vCenter'], record['Name'], record['MOR value'], record['HW UUID']])
+
+        if ndjson_output:
+            pass
+        elif json_output:
             print(json.dumps(json_object, sort_keys=True, indent=4))
         else:
             print(pt)
 
     except KeyboardInterrupt:
-        logger.info('Received interrupt, finishing running threads and not creating any new migrations')
-        if pool is not None and pool_results is not None:
-            wait_for_pool_end(logger, pool, pool_results)
+        logger.info('Received interrupt, not waiting for the remaining vCenters')
+        failed = True
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if transport['stats']:
+        print_transfer_stats('Transfer statistics')
 
-    except vmodl.MethodFault as e:
-        logger.critical('Caught vmodl fault: %s' % e.msg)
+    if failed:
+        logger.info('Finished, but not all vCenters were handled')
         return 1
-    #except Exception as e:
-    #    logger.critical('Caught exception: %s' % str(e))
-    #    return 1
 
     logger.info('Finished all tasks')
     return 0
 
 # Start program
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -15,17 +15,32 @@ This script has the following capabilities:
     * Print logging to a log file or stdout
     * Do this in a threaded way
     * Use linked clones to speed up cloning
+    * Use instant clones from a running virtual machine
+    * Clone from replicas of the template on each target datastore
+    * Place the clones on datastores and hosts based on their free space and memory
+    * Power on the clones in batches per datacenter
+    * Split a large set of clones over multiple workers with a shared journal file
+    * Split the clones over multiple processes, to use multiple CPU cores
+    * Write the created clones to a results file, in the CSV format
+    * Remove a set of clones again, from the basename and count, a CSV or a results file
+    * Run as a service which accepts clone, migrate and lookup jobs on a local socket, with a warm session and inventory
+    * Retry clone, reconfigure and power on tasks after transient faults, and stop using datastores and hosts which keep failing
+    * Stop a run gracefully with ctrl-c or SIGTERM, cancelling queued tasks and writing the results of the finished clones
+    * Order the clones by priority, take turns over the datastores and clusters or clone the quickest VMs first
+    * Request compressed responses and larger pages from a remote vCenter, and report the bytes transferred
 
 --- Using threads ---
 Deciding on the optimal amount of threads might need a bit of experimentation. Keep certain things in mind:
     * The optimal amount of threads depends on the IOPS of the datastore as each thread will start a template deployment task, which in turn starts copying the disks.
     * vCenter will, by default, only run 8 deployment tasks simultaniously while other tasks are queued, so setting the amount of threads to more than 8, is not really usefull.
+    * The log messages of the threads are prefixed with the name of their VM. On Python 3 the threads hand their log messages to a queue and a single thread writes them, so a slow log file or terminal does not hold up the threads. Debug messages are only formatted when debug output is enabled.
 
 --- Using CSV file ---
 A CSV file can be provided with a line for each VM that needs to be created, with specific parameters for each VM. The format of each row should be (fields surrounded with <> are mandatory, fields surrounded with [] are optional):
-"<Clone name>";"[Datacenter]";"[Cluster]";"[Resouce Pool]";"[Folder]";"[Datastore]";"[MAC Address]";"[Post-processing Script]";"[Advanced VM Parameters in JSON format]"
+"<Clone name>";"[Datacenter]";"[Cluster]";"[Resouce Pool]";"[Folder]";"[Datastore]";"[MAC Address]";"[Post-processing Script]";"[Advanced VM Parameters in JSON format]";"[Priority]"
 For instance:
-"Test01";"New-York";"Compute-Cluster-01";"Development";"IT";"VSAN-DS";"00:50:56:11:11:11";"run.sh";"{'parameter.1':'value.1','parameter.2':'value.2'}"
+"Test01";"New-York";"Compute-Cluster-01";"Development";"IT";"VSAN-DS";"00:50:56:11:11:11";"run.sh";"{'parameter.1':'value.1','parameter.2':'value.2'}";"10"
+VMs with a higher priority are cloned first, the default priority is 0.
 
 --- Post-processing Script ---
 The Post-processing script is run for each VM created if it is provided either as a commandline parameter or as a field in the CSV.
@@ -54,17 +69,71 @@ from builtins import range
 import argparse
 import atexit
 import csv
+import fnmatch
+import functools
 import getpass
 import json
 import logging
+import multiprocessing
+import os
 import os.path
+import random
 import re
+import signal
+import socket
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
+import vsphere_helpers
 
-from time import sleep
-from pyVim.connect import SmartConnect, SmartConnectNoSSL, Disconnect
-from pyVmomi import vim, vmodl
+from time import sleep, time
 from multiprocessing.dummy import Pool as ThreadPool
+from vsphere_helpers import transport, get_connect_args, count_transfer, print_transfer_stats, get_vm_logger
+
+# Loaded by import_vsphere_modules once vCenter has to be contacted, so the help and argument errors start quickly
+Disconnect = None
+vim = None
+vmodl = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = None
+
+# Semaphore shared by the worker processes, limiting the clones running at once over all of them
+process_slots = None
+
+# Stop request of SIGINT or SIGTERM and the settings to drain the running clones. The signal handler only sets requested, the main thread passes it on to the stop event. The deadline starts when the stop is first seen.
+drain = {'requested': False, 'stop': threading.Event(), 'lock': threading.Lock(), 'timeout': None, 'deadline': None, 'cancel_queued': False, 'announced': False}
+
+# Callbacks per VM name which receive the state of its tasks, used to stream the job status in service mode
+task_listeners = {}
+
+# Object types and properties kept in the live inventory of the service mode, set by import_vsphere_modules
+INVENTORY_PROPERTIES = None
+
+# Faults after which a task is retried, as they are usually gone after a while, set by import_vsphere_modules
+TRANSIENT_FAULTS = None
+
+# Faults which count as a failure of the datastore or host of a task for its circuit breaker, set by import_vsphere_modules
+TARGET_FAULTS = None
+
+# Maximum amount of seconds to wait before retrying a task
+RETRY_MAX_DELAY = 300
+
+# Returned by vm_clone_handler when the virtual machine already exists, to tell it apart from a failed clone
+VM_EXISTS = 'exists'
+
+# Types which can be looked up in service mode, set by import_vsphere_modules
+LOOKUP_TYPES = None
 
 
 def get_args():
@@ -75,59 +144,731 @@ def get_args():
     parser = argparse.ArgumentParser(description="Deploy a template into multiple VM's. You can get information returned with the name of the virtual machine created and it's main mac and ip address. Either in IPv4 or IPv6 format. You can specify which folder and/or resource pool the clone should be placed in. Verbose and debug output can either be send to stdout, or saved to a log file. A post-script can be specified for post-processing. And it can all be done in a number of parallel threads you specify. The script also provides the ability to use a CSV for a lot of it settings and if you want to specify the mac address of the clones (usefull for DHCP/PXE configuration).")
     parser.add_argument('-6', '--six', required=False, help='Get IPv6 address for VMs instead of IPv4', dest='ipv6', action='store_true')
     parser.add_argument('-b', '--basename', nargs=1, required=False, help='Basename of the newly deployed VMs', dest='basename', type=str)
+    parser.add_argument('--batch-power-on', required=False, help='Power on the cloned VMs in batches per datacenter, with one task for each batch', dest='batch_power_on', action='store_true')
+    parser.add_argument('--breaker-cooldown', nargs=1, required=False, help='Amount of seconds no new tasks are started on a datastore or host after its circuit breaker opened (default = 300)', dest='breaker_cooldown', type=int, default=[300])
+    parser.add_argument('--breaker-threshold', nargs=1, required=False, help='Amount of failures in a row of tasks on a datastore or host after which its circuit breaker opens, 0 disables the circuit breakers (default = 0)', dest='breaker_threshold', type=int, default=[0])
+    parser.add_argument('--batch-window', nargs=1, required=False, help='Amount of seconds to collect cloned VMs for a power on batch (default = 5)', dest='batch_window', type=int, default=[5])
+    parser.add_argument('--cancel-queued', required=False, help='When the run is stopped with SIGINT or SIGTERM, cancel the tasks which are still queued in vCenter right away', dest='cancel_queued', action='store_true')
+    parser.add_argument('--compress', required=False, help='Request gzip compressed SOAP responses from vCenter, for a vCenter behind a slow link', dest='compress', action='store_true')
     parser.add_argument('-c', '--count', nargs=1, required=False, help='Starting count, the name of the first VM deployed will be <basename>-<count>, the second will be <basename>-<count+1> (default = 1)', dest='count', type=int, default=[1])
-    parser.add_argument('-C', '--csv', nargs=1, required=False, help='An optional CSV overwritting the basename and count. For each line, a clone will be created. A line consits of the following fields, fields inside <> are mandatory, fields with [] are not: "<Clone name>";"[Datacenter]";"[Cluster]";"[Resouce Pool]";"[Folder]";"[Datastore]";"[MAC Address]";"[Post-processing Script]";"[Advanced VM Parameters in JSON format]"', dest='csvfile', type=str)
+    parser.add_argument('-C', '--csv', nargs=1, required=False, help='An optional CSV overwritting the basename and count. For each line, a clone will be created. A line consits of the following fields, fields inside <> are mandatory, fields with [] are not: "<Clone name>";"[Datacenter]";"[Cluster]";"[Resouce Pool]";"[Folder]";"[Datastore]";"[MAC Address]";"[Post-processing Script]";"[Advanced VM Parameters in JSON format]";"[Priority]"', dest='csvfile', type=str)
     parser.add_argument('--cluster', nargs=1, required=False, help='The cluster in which the new VMs should reside (default = same cluster as source virtual machine)', dest='cluster', type=str)
     parser.add_argument('-d', '--debug', required=False, help='Enable debug output', dest='debug', action='store_true')
     parser.add_argument('--datacenter', nargs=1, required=False, help='The datacenter in which the new VMs should reside (default = same datacenter as source virtual machine)', dest='datacenter', type=str)
     parser.add_argument('--datastore', nargs=1, required=False, help='The datastore in which the new VMs should reside (default = same datastore as source virtual machine)', dest='datastore', type=str)
+    parser.add_argument('--drain-timeout', nargs=1, required=False, help='When the run is stopped with SIGINT or SIGTERM, amount of seconds to let the running clones finish, after which their tasks are cancelled (default = no limit)', dest='drain_timeout', type=int)
     parser.add_argument('--folder', nargs=1, required=False, help='The folder in which the new VMs should reside (default = same folder as source virtual machine)', dest='folder', type=str)
     parser.add_argument('-H', '--host', nargs=1, required=True, help='The vCenter or ESXi host to connect to', dest='host', type=str)
     parser.add_argument('-i', '--print-ips', required=False, help='Enable IP output', dest='ips', action='store_true')
     parser.add_argument('-m', '--print-macs', required=False, help='Enable MAC output', dest='macs', action='store_true')
+    parser.add_argument('--instant', required=False, help='Use instant cloning from the running source virtual machine. The clones are running right away, the MAC address and advanced parameters are set as part of the clone', dest='instant', action='store_true')
+    parser.add_argument('--journal', nargs=1, required=False, help='Journal file on shared storage to split the VMs over multiple workers running with the same arguments. Each worker claims VMs in the journal before cloning them, and records them as done in it', dest='journal', type=str)
+    parser.add_argument('--lease-ttl', nargs=1, required=False, help='Amount of seconds after which the claim of a worker which stopped updating the journal is taken over by another worker (default = 300)', dest='lease_ttl', type=int, default=[300])
+    parser.add_argument('--listen', nargs=1, required=False, help='Run as a service listening for clone, migrate and lookup jobs on this Unix socket, keeping the session and a live inventory warm. The other clone settings are the defaults of the clone jobs', dest='listen', type=str)
     parser.add_argument('-l', '--log-file', nargs=1, required=False, help='File to log to (default = stdout)', dest='logfile', type=str)
     parser.add_argument('-L', '--linked', required=False, help='Enable linked cloning', dest='linked', action='store_true')
     parser.add_argument('--snapshot', required=False, help='Snapshot to be used for linked cloning', dest='snapshot', type=str)
     parser.add_argument('-n', '--number', nargs=1, required=False, help='Amount of VMs to deploy (default = 1)', dest='amount', type=int, default=[1])
+    parser.add_argument('--order', nargs=1, required=False, help='Order to clone the VMs in, after their priority: input (the order of the CSV or the names), fair-share (taking turns over the datastores and clusters) or shortest-first (the clones needing the least tasks first) (default = input)', dest='order', type=str, choices=['input', 'fair-share', 'shortest-first'], default=['input'])
     parser.add_argument('-o', '--port', nargs=1, required=False, help='Server port to connect to (default = 443)', dest='port', type=int, default=[443])
+    parser.add_argument('--page-size', nargs=1, required=False, help='Maximum amount of objects retrieved in each page of a property retrieval or inventory update, larger pages need fewer round trips (default = decided by vCenter)', dest='page_size', type=int)
     parser.add_argument('-p', '--password', nargs=1, required=False, help='The password with which to connect to the host. If not specified, the user is prompted at runtime for a password', dest='password', type=str)
+    parser.add_argument('--placement', nargs='+', required=False, help='Datastores, datastore name patterns or datastore clusters to place the clones on, based on their free space. Only used for clones without a datastore', dest='placement', type=str)
+    parser.add_argument('--placement-hosts', required=False, help='Also place the clones on a host of the cluster, with access to the datastore and enough free memory', dest='placement_hosts', action='store_true')
+    parser.add_argument('--placement-strategy', nargs=1, required=False, help='Strategy to place the clones with, either most-free or round-robin (default = most-free)', dest='placement_strategy', type=str, choices=['most-free', 'round-robin'], default=['most-free'])
+    parser.add_argument('--processes', nargs=1, required=False, help='Amount of worker processes to split the VMs over, each with its own vCenter session. The amount of threads is the amount of clones running at once over all processes (default = 1)', dest='processes', type=int, default=[1])
     parser.add_argument('-P', '--disable-power-on', required=False, help='Disable power on of cloned VMs', dest='nopoweron', action='store_true')
+    parser.add_argument('--replicas', required=False, help='Create or reuse a replica of the template on each target datastore and clone from the replica on the destination datastore, with the snapshot in case of linked cloning', dest='replicas', action='store_true')
+    parser.add_argument('--replica-cache', nargs=1, required=False, help='File to keep the replicas in, so later runs do not need to look them up (default = no cache)', dest='replica_cache', type=str)
+    parser.add_argument('-r', '--results-file', nargs=1, required=False, help='CSV file to write a line for each created VM to, in the same format as the CSV input', dest='results_file', type=str)
     parser.add_argument('--resource-pool', nargs=1, required=False, help='The resource pool in which the new VMs should reside, (default = Resources, the root resource pool)', dest='resource_pool', type=str)
+    parser.add_argument('--retries', nargs=1, required=False, help='Amount of times a clone, reconfigure or power on task is retried after a transient fault, like a busy or locked resource (default = 0)', dest='retries', type=int, default=[0])
+    parser.add_argument('--retry-budget', nargs=1, required=False, help='Maximum amount of retries over the whole run for each type of fault, so an overloaded vCenter is not flooded with retries (default = 100)', dest='retry_budget', type=int, default=[100])
+    parser.add_argument('--retry-delay', nargs=1, required=False, help='Amount of seconds to wait before the first retry of a task, doubled with each further retry, with a random part (default = 5)', dest='retry_delay', type=int, default=[5])
     parser.add_argument('-s', '--post-script', nargs=1, required=False, help='Script to be called after each VM is created and booted. Arguments passed: name mac-address ip-address', dest='post_script', type=str)
     parser.add_argument('-S', '--disable-SSL-certificate-verification', required=False, help='Disable SSL certificate verification on connect', dest='nosslcheck', action='store_true')
-    parser.add_argument('-t', '--template', nargs=1, required=True, help='Template to deploy', dest='template', type=str)
+    parser.add_argument('-t', '--template', nargs=1, required=False, help='Template to deploy, required unless removing VMs or running as a service', dest='template', type=str)
+    parser.add_argument('--teardown', required=False, help='Power off and remove the VMs from the basename and count or the CSV, instead of creating them. The amount of threads sets how many VMs are removed at once', dest='teardown', action='store_true')
+    parser.add_argument('--transfer-stats', required=False, help='Print the bytes of the SOAP responses on the wire and after decompression to stderr when done', dest='transfer_stats', action='store_true')
     parser.add_argument('-T', '--threads', nargs=1, required=False, help='Amount of threads to use. Choose the amount of threads with the speed of your datastore in mind, each thread starts the creation of a virtual machine. (default = 1)', dest='threads', type=int, default=[1])
     parser.add_argument('-u', '--user', nargs=1, required=True, help='The username with which to connect to the host', dest='username', type=str)
     parser.add_argument('-v', '--verbose', required=False, help='Enable verbose output', dest='verbose', action='store_true')
+    parser.add_argument('-W', '--worker-id', nargs=1, required=False, help='Name of this worker in the journal (default = hostname:pid)', dest='worker_id', type=str)
     parser.add_argument('-w', '--wait-max', nargs=1, required=False, help='Maximum amount of seconds to wait when gathering information (default = 120)', dest='maxwait', type=int, default=[120])
     args = parser.parse_args()
     return args
 
 
-def find_obj(si, logger, name, vimtype, threaded=False):
+def import_vsphere_modules():
+    """
+    Imports pyVmomi and pyVim, which take most of the startup time of the script, and sets the constants with vSphere types
     """
-    Find an object in vSphere by it's name and return it
+
+    global Disconnect, vim, vmodl, INVENTORY_PROPERTIES, TRANSIENT_FAULTS, TARGET_FAULTS, LOOKUP_TYPES
+    if vim is not None:
+        return
+    from pyVim.connect import Disconnect
+    from pyVmomi import vim, vmodl
+
+    INVENTORY_PROPERTIES = {
+        vim.VirtualMachine: ['name', 'runtime.powerState', 'runtime.host'],
+        vim.HostSystem: ['name', 'hardware.systemInfo.uuid', 'runtime.connectionState', 'runtime.inMaintenanceMode'],
+        vim.Datacenter: ['name'],
+        vim.ClusterComputeResource: ['name'],
+        vim.ResourcePool: ['name'],
+        vim.Folder: ['name'],
+        vim.Datastore: ['name']
+    }
+    TRANSIENT_FAULTS = (vim.fault.TaskInProgress, vim.fault.ConcurrentAccess, vim.fault.FileLocked, vim.fault.ResourceInUse, vim.fault.Timedout, vmodl.fault.HostCommunication)
+    TARGET_FAULTS = (vim.fault.Timedout, vmodl.fault.HostCommunication, vim.fault.NoDiskSpace, vim.fault.InsufficientResourcesFault, vim.fault.CannotAccessFile, vim.fault.InvalidHostState, vmodl.fault.HostNotConnected, vmodl.fault.HostNotReachable)
+    LOOKUP_TYPES = {
+        'vm': vim.VirtualMachine,
+        'host': vim.HostSystem,
+        'datacenter': vim.Datacenter,
+        'cluster': vim.ClusterComputeResource,
+        'resource_pool': vim.ResourcePool,
+        'folder': vim.Folder,
+        'datastore': vim.Datastore
+    }
+
+
+def start_log_queue():
+    """
+    Moves the handlers of the root logger behind a queue, so the threads only hand over their records and a single listener thread formats and writes them
+    Returns the listener, or None if queue logging is not available or already in place
+    """
+
+    root_logger = logging.getLogger()
+    if QueueHandler is None or any(isinstance(handler, QueueHandler) for handler in root_logger.handlers):
+        return None
+    handlers = list(root_logger.handlers)
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def stop_log_queue(listener):
+    """
+    Writes the remaining records in the queue and moves the handlers back to the root logger
+    """
+
+    if listener is None:
+        return
+    listener.stop()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, QueueHandler):
+            root_logger.removeHandler(handler)
+    for handler in listener.handlers:
+        root_logger.addHandler(handler)
+
+
+def stop_handler(signum, frame):
+    """
+    Handles SIGINT and SIGTERM by stopping the run: no new clones are started and the running clones are drained. A second signal aborts right away.
+    Nothing is logged and the stop event is not set here, as the handler can interrupt the main thread while it holds the lock of the log queue or of the stop event.
+    """
+
+    drain['requested'] = True
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def start_drain_handling(timeout, cancel_queued):
+    """
+    Registers the handlers for SIGINT and SIGTERM which stop the run and drain the running clones
+    """
+
+    drain['timeout'] = timeout
+    drain['cancel_queued'] = cancel_queued
+    signal.signal(signal.SIGINT, stop_handler)
+    signal.signal(signal.SIGTERM, stop_handler)
+
+
+def is_stop_requested():
+    """
+    Passes a stop request of the signal handler on to the stop event and returns whether the run is stopping. Only called from the main thread.
+    """
+
+    if drain['requested'] and not drain['stop'].is_set():
+        drain['stop'].set()
+    return drain['stop'].is_set()
+
+
+def is_drain_expired():
+    """
+    Returns whether the deadline for the running clones to finish has passed, after a stop was requested
+    """
+
+    if not drain['stop'].is_set() or drain['timeout'] is None:
+        return False
+    with drain['lock']:
+        if drain['deadline'] is None:
+            drain['deadline'] = time() + drain['timeout']
+        return time() >= drain['deadline']
+
+
+def wait_for_pool_results(logger, results):
+    """
+    Waits for asynchronous pool results, checking regularly so the stop signals are handled in the meantime
+    """
+
+    for result in results:
+        while not result.ready():
+            result.wait(1)
+            if is_stop_requested() and not drain['announced']:
+                drain['announced'] = True
+                logger.warning('Received a stop signal, not starting new clones and draining the running clones. Send it again to abort right away.')
+
+
+def get_properties(si, logger, vimtype, properties, root=None, objs=None):
+    """
+    Retrieve properties of objects with the shared paged property retrieval, with the page size of the transport settings
+    """
+
+    return vsphere_helpers.get_properties(si, logger, vimtype, properties, root=root, objs=objs, page_size=transport['page_size'])
+
+
+def update_inventory(logger, inventory, maxwait):
+    """
+    Waits up to maxwait seconds for property collector updates and applies them to the live inventory, keeping an index of the objects by type and name
+    """
+
+    wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=maxwait, maxObjectUpdates=transport['page_size'])
+    update_set = inventory['collector'].WaitForUpdatesEx(inventory['version'], wait_options)
+    while update_set:
+        with inventory['lock']:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    obj = object_update.obj
+                    properties = inventory['objects'].setdefault(obj._moId, {})
+                    old_name = properties.get('name')
+                    if object_update.kind == 'leave':
+                        logger.debug('Object %s has been removed from the inventory', old_name)
+                        inventory['objects'].pop(obj._moId, None)
+                        if inventory['names'].get((obj._wsdlName, old_name)) == obj:
+                            inventory['names'].pop((obj._wsdlName, old_name), None)
+                        continue
+                    for change in object_update.changeSet:
+                        if change.op in ['remove', 'indirectRemove']:
+                            properties.pop(change.name, None)
+                        else:
+                            properties[change.name] = change.val
+                    if properties.get('name') != old_name and inventory['names'].get((obj._wsdlName, old_name)) == obj:
+                        inventory['names'].pop((obj._wsdlName, old_name), None)
+                    if properties.get('name') is not None:
+                        inventory['names'].setdefault((obj._wsdlName, properties.get('name')), obj)
+            inventory['version'] = update_set.version
+        if not update_set.truncated:
+            break
+        update_set = inventory['collector'].WaitForUpdatesEx(inventory['version'], vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0, maxObjectUpdates=transport['page_size']))
+
+
+def inventory_watch_handler(logger, inventory):
+    """
+    Keeps the live inventory current until it is stopped. The continuous updates also keep the session from expiring.
+    """
+
+    while not inventory['stop'].is_set():
+        try:
+            update_inventory(logger, inventory, 10)
+        except vmodl.MethodFault as e:
+            logger.warning('Live inventory update failed, retrying in 5 seconds: %s', e.msg)
+            sleep(5)
+        except Exception as e:
+            logger.warning('Live inventory update failed, retrying in 5 seconds: %s', str(e))
+            sleep(5)
+
+
+def start_inventory_watch(si, logger):
+    """
+    Creates the live inventory of the VMs, hosts, datacenters, clusters, resource pools, folders and datastores, loads the current state and starts the thread that keeps it current
     """
 
     content = si.content
-    obj_view = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
-    obj_list = obj_view.view
+    inventory = {
+        'lock': threading.Lock(),
+        'objects': {},
+        'names': {},
+        'collector': content.propertyCollector.CreatePropertyCollector(),
+        'view': content.viewManager.CreateContainerView(content.rootFolder, list(INVENTORY_PROPERTIES.keys()), True),
+        'version': '',
+        'stop': threading.Event(),
+        'thread': None
+    }
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=inventory['view'], skip=True, selectSet=[traversal_spec])]
+    filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=properties) for vimtype, properties in INVENTORY_PROPERTIES.items()]
+    inventory['collector'].CreateFilter(filter_spec, partialUpdates=True)
+    logger.info('Loading the live inventory')
+    update_inventory(logger, inventory, 0)
+    logger.info('Live inventory loaded with %s objects', len(inventory['objects']))
+
+    inventory['thread'] = threading.Thread(target=inventory_watch_handler, args=(logger, inventory))
+    inventory['thread'].daemon = True
+    inventory['thread'].start()
+    return inventory
+
+
+def stop_inventory_watch(logger, inventory):
+    """
+    Stops the live inventory thread and removes the property collector and view
+    """
 
-    for obj in obj_list:
-        if threaded:
-            logger.debug('THREAD %s - Checking Object "%s"' % (name, obj.name))
-        else:
-            logger.debug('Checking object "%s"' % obj.name)
-        if obj.name == name:
-            if threaded:
-                logger.debug('THREAD %s - Found object %s' % (name, obj.name))
+    logger.debug('Stopping live inventory feed')
+    inventory['stop'].set()
+    try:
+        inventory['collector'].Destroy()
+        inventory['view'].Destroy()
+    except Exception as e:
+        logger.debug('Unable to remove the live inventory property collector: %s', str(e))
+
+
+def find_inventory_obj(inventory, name, vimtype):
+    """
+    Returns an object of a type from the live inventory by its name, or None if it does not exist
+    """
+
+    with inventory['lock']:
+        return inventory['names'].get((vimtype._wsdlName, name))
+
+
+def get_inventory_properties(inventory, obj):
+    """
+    Returns a copy of the properties of an object in the live inventory
+    """
+
+    with inventory['lock']:
+        return dict(inventory['objects'].get(obj._moId, {}))
+
+
+def find_obj(si, logger, name, vimtype, inventory=None):
+    """
+    Find an object in vSphere by it's name and return it. Only the names are retrieved, with a paged property retrieval. With a live inventory, the object is looked up in it instead.
+    """
+
+    if inventory is not None:
+        return find_inventory_obj(inventory, name, vimtype[0])
+    return vsphere_helpers.find_obj(si, logger, name, vimtype[0], page_size=transport['page_size'])
+
+
+def wait_for_task(logger, task, vm_name, description):
+    """
+    Waits for a task to finish and returns its info, the state of the info is either success or error
+    """
+
+    cancelled = False
+    while True:
+        info = task.info
+        logger.debug('Checking %s task', description)
+        listener = task_listeners.get(vm_name)
+        if listener is not None:
+            listener(description, info)
+        if info.state == vim.TaskInfo.State.success:
+            logger.debug('%s task finished', description)
+            return info
+        elif info.state == vim.TaskInfo.State.running:
+            logger.debug('%s task is at %s percent', description, info.progress)
+        elif info.state == vim.TaskInfo.State.queued:
+            logger.debug('%s task is queued', description)
+        elif info.state == vim.TaskInfo.State.error:
+            if isinstance(info.error, vmodl.fault.RequestCanceled):
+                logger.info('%s task has quit with cancelation', description)
             else:
-                logger.debug('Found object %s' % obj.name)
-            return obj
-    return None
+                logger.info('%s task has quit with error: %s', description, info.error.msg)
+            return info
+        if not cancelled and info.cancelable and drain['stop'].is_set() and ((drain['cancel_queued'] and info.state == vim.TaskInfo.State.queued) or is_drain_expired()):
+            logger.warning('Cancelling %s task as the run is stopping', description)
+            try:
+                task.CancelTask()
+            except vmodl.MethodFault as e:
+                logger.debug('Unable to cancel %s task: %s', description, e.msg)
+            cancelled = True
+        logger.debug('Sleeping 2 seconds for new check')
+        sleep(2)
+
 
+def is_breaker_open(logger, retry, targets):
+    """
+    Checks the circuit breakers of the datastores and hosts of a task. Once the cooldown of an open breaker has passed, a single task is let through to test whether the target has recovered.
+    """
 
-def find_mac_ip(logger, vm, maxwait, ipv6=False, threaded=False):
+    now = time()
+    with retry['lock']:
+        for target in targets:
+            breaker = retry['breakers'].get(target._moId)
+            if not retry['threshold'] or breaker is None or breaker['failures'] < retry['threshold']:
+                continue
+            if now < breaker['until']:
+                logger.warning('Circuit breaker of %s is open for %s more seconds, not starting task', target._moId, int(breaker['until'] - now))
+                return True
+            logger.info('Testing %s after its circuit breaker cooldown', target._moId)
+            breaker['until'] = now + retry['cooldown']
+    return False
+
+
+def record_breakers(logger, retry, targets, fault):
+    """
+    Records the outcome of a task in the circuit breakers of its datastores and hosts. A success closes a breaker, a breaker opens after the threshold of failures in a row.
+    """
+
+    with retry['lock']:
+        for target in targets:
+            breaker = retry['breakers'].setdefault(target._moId, {'failures': 0, 'until': 0})
+            if fault is None:
+                breaker['failures'] = 0
+            elif isinstance(fault, TARGET_FAULTS):
+                breaker['failures'] += 1
+                if retry['threshold'] and breaker['failures'] >= retry['threshold']:
+                    logger.warning('Circuit breaker of %s is open for %s seconds after %s failures in a row', target._moId, retry['cooldown'], breaker['failures'])
+                    breaker['until'] = time() + retry['cooldown']
+
+
+def get_retry_delay(logger, retry, fault, attempt):
+    """
+    Returns the amount of seconds to wait before retrying a task after a fault, or None if it should not be retried. Only transient faults are retried, within the amount of retries per task and the retry budget of the fault over the whole run. The delay doubles with each attempt and half of it is random, to spread out the retries of many tasks.
+    """
+
+    if retry is None or attempt > retry['retries'] or not isinstance(fault, TRANSIENT_FAULTS) or drain['stop'].is_set():
+        return None
+    fault_name = type(fault).__name__
+    with retry['lock']:
+        used = retry['budgets'].get(fault_name, 0)
+        if used >= retry['budget']:
+            logger.warning('Retry budget for %s faults is used up, not retrying', fault_name)
+            return None
+        retry['budgets'][fault_name] = used + 1
+    delay = min(RETRY_MAX_DELAY, retry['delay'] * 2 ** (attempt - 1))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def run_task(logger, retry, start_task, vm_name, description, targets):
+    """
+    Starts a task and waits for it to finish. Without retry settings, this is the same as waiting for the task. Otherwise the task is started again after a transient fault and the circuit breakers of its datastores and hosts are kept. Returns the info of the last attempt, or None if a circuit breaker is open.
+    """
+
+    targets = [target for target in targets if target is not None]
+    attempt = 0
+    while True:
+        attempt += 1
+        if retry is not None and is_breaker_open(logger, retry, targets):
+            return None
+        try:
+            info = wait_for_task(logger, start_task(), vm_name, description)
+            fault = info.error if info.state == vim.TaskInfo.State.error else None
+        except vmodl.MethodFault as e:
+            if retry is None:
+                raise
+            logger.info('%s task could not be created: %s', description, e.msg)
+            info = None
+            fault = e
+        if retry is None:
+            return info
+        record_breakers(logger, retry, targets, fault)
+        if fault is None:
+            return info
+        delay = get_retry_delay(logger, retry, fault, attempt)
+        if delay is None and info is None:
+            raise fault
+        elif delay is None:
+            return info
+        logger.info('Retrying %s task in %.1f seconds after a %s fault (attempt %s of %s)', description, delay, type(fault).__name__, attempt + 1, retry['retries'] + 1)
+        sleep(delay)
+
+
+def get_retry_settings(retries, delay, budget, threshold, cooldown):
+    """
+    Returns the retry and circuit breaker settings shared by all tasks, or None if both are disabled
+    """
+
+    if not retries and not threshold:
+        return None
+    return {'lock': threading.Lock(), 'retries': retries, 'delay': delay, 'budget': budget, 'budgets': {}, 'threshold': threshold, 'cooldown': cooldown, 'breakers': {}}
+
+
+def find_datacenter(obj):
+    """
+    Find the datacenter an object belongs to by walking up its parents
+    """
+
+    while obj is not None and not isinstance(obj, vim.Datacenter):
+        obj = obj.parent
+    return obj
+
+
+def run_power_on_batch(logger, datacenter, batch, vm_name):
+    """
+    Powers on a batch of virtual machines with one task on their datacenter and stores the result of each virtual machine in its batch entry
+    """
+
+    entries = dict((entry['vm']._moId, entry) for entry in batch)
+    try:
+        logger.info('Powering on a batch of %s VMs in datacenter %s', len(batch), datacenter.name)
+        task = datacenter.PowerOnMultiVM_Task(vm=[entry['vm'] for entry in batch])
+        info = wait_for_task(logger, task, vm_name, 'Batch power on')
+        if info.state != vim.TaskInfo.State.success:
+            return
+        for attempted in info.result.attempted:
+            entry = entries.get(attempted.vm._moId)
+            if entry is None:
+                continue
+            if attempted.task:
+                entry['result'] = wait_for_task(get_vm_logger(logger, entry['name']), attempted.task, entry['name'], 'Power on').state == vim.TaskInfo.State.success
+            else:
+                entry['result'] = True
+        for not_attempted in info.result.notAttempted:
+            entry = entries.get(not_attempted.vm._moId)
+            if entry is not None:
+                get_vm_logger(logger, entry['name']).warning('Power on was not attempted: %s', not_attempted.fault.msg)
+        for entry in batch:
+            if not entry['result']:
+                get_vm_logger(logger, entry['name']).warning('VM was not powered on by the batch power on')
+    finally:
+        for entry in batch:
+            entry['done'].set()
+
+
+def power_on_batched(logger, power_on_batches, datacenter, vm, vm_name):
+    """
+    Powers on a virtual machine together with the other virtual machines of its datacenter which are ready within the batch window, returns if it was powered on
+    """
+
+    entry = {'vm': vm, 'name': vm_name, 'done': threading.Event(), 'result': False}
+    with power_on_batches['lock']:
+        batch = power_on_batches['datacenters'].get(datacenter._moId)
+        leader = batch is None
+        if leader:
+            batch = []
+            power_on_batches['datacenters'][datacenter._moId] = batch
+        batch.append(entry)
+
+    if leader:
+        # The first virtual machine of a batch waits for the window to pass and powers on the whole batch
+        logger.debug('Waiting %s seconds for other VMs to join the power on batch', power_on_batches['window'])
+        sleep(power_on_batches['window'])
+        with power_on_batches['lock']:
+            del power_on_batches['datacenters'][datacenter._moId]
+        run_power_on_batch(logger, datacenter, batch, vm_name)
+    else:
+        logger.debug('Waiting for the power on batch')
+        entry['done'].wait()
+    return entry['result']
+
+
+def open_csv_file(filename, mode='r'):
+    """
+    Opens a CSV file the way the csv module expects it on both Python 2 and 3
+    """
+
+    if sys.version_info[0] < 3:
+        return open(filename, mode + 'b')
+    return open(filename, mode, newline='')
+
+
+def run_tasks(si, logger, items, start_task, max_running, description):
+    """
+    Starts a task for each item, with at most max_running tasks at once, and waits for them with property collector updates instead of polling every task. Returns a dict with the final task state and error for each item.
+    """
+
+    collector = si.content.propertyCollector.CreatePropertyCollector()
+    pending = list(items)
+    running = {}
+    results = {}
+    version = ''
+    try:
+        while pending or running:
+            while pending and len(running) < max_running:
+                item = pending.pop(0)
+                try:
+                    task = start_task(item)
+                except vmodl.MethodFault as e:
+                    get_vm_logger(logger, item).warning('Unable to start %s task: %s', description, e.msg)
+                    results[item] = (vim.TaskInfo.State.error, e)
+                    continue
+                get_vm_logger(logger, item).debug('%s task started', description)
+                filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+                filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)]
+                filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=['info.state', 'info.error'])]
+                running[task._moId] = (item, collector.CreateFilter(filter_spec, True))
+
+            if not running:
+                continue
+            update = collector.WaitForUpdatesEx(version, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=60))
+            if update is None:
+                continue
+            version = update.version
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    if obj_update.obj._moId not in running:
+                        continue
+                    changes = dict((change.name, change.val) for change in obj_update.changeSet)
+                    state = changes.get('info.state')
+                    if state in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+                        item, task_filter = running.pop(obj_update.obj._moId)
+                        task_filter.Destroy()
+                        if state == vim.TaskInfo.State.error:
+                            get_vm_logger(logger, item).warning('%s task has quit with error: %s', description, changes.get('info.error').msg if changes.get('info.error') else 'unknown error')
+                        else:
+                            get_vm_logger(logger, item).debug('%s task finished', description)
+                        results[item] = (state, changes.get('info.error'))
+    finally:
+        collector.Destroy()
+    return results
+
+
+def teardown_vms(si, logger, vm_names, threads):
+    """
+    Powers off and destroys the virtual machines with the given names, returns the amount of virtual machines which could not be destroyed
+    """
+
+    # All virtual machines are looked up at once
+    logger.info('Looking up %s VMs to remove', len(vm_names))
+    wanted = set(vm_names)
+    vms = {}
+    power_states = {}
+    for vm, properties in get_properties(si, logger, vim.VirtualMachine, ['name', 'runtime.powerState']):
+        if properties.get('name') in wanted:
+            vms[properties['name']] = vm
+            power_states[properties['name']] = properties.get('runtime.powerState')
+    for vm_name in vm_names:
+        if vm_name not in vms:
+            get_vm_logger(logger, vm_name).warning('Virtual machine not found, not removing')
+
+    # The power off tasks are all started at once
+    powered_on = [vm_name for vm_name in vm_names if power_states.get(vm_name) == vim.VirtualMachinePowerState.poweredOn]
+    if powered_on:
+        logger.info('Powering off %s VMs', len(powered_on))
+        run_tasks(si, logger, powered_on, lambda vm_name: vms[vm_name].PowerOffVM_Task(), len(powered_on), 'Power off')
+
+    # Destroy tasks run with the amount of threads at once
+    to_destroy = [vm_name for vm_name in vm_names if vm_name in vms]
+    logger.info('Removing %s VMs, %s at once', len(to_destroy), threads)
+    results = run_tasks(si, logger, to_destroy, lambda vm_name: vms[vm_name].Destroy_Task(), threads, 'Remove')
+
+    failed = 0
+    for vm_name in to_destroy:
+        if results[vm_name][0] == vim.TaskInfo.State.success:
+            get_vm_logger(logger, vm_name).info('Virtual machine removed')
+        else:
+            failed += 1
+    logger.info('Removed %s VMs, %s failed', len(to_destroy) - failed, failed)
+    return failed
+
+
+def get_results_row(vm_spec):
+    """
+    Returns the CSV fields of a virtual machine spec: name, datacenter, cluster, resource pool, folder, datastore, MAC, post script and advanced parameters
+    """
+
+    return ['' if vm_spec[index] is None else vm_spec[index] for index in (3, 4, 5, 6, 7, 8, 9, 12, 21)]
+
+
+def write_results_file(logger, results_file, rows):
+    """
+    Writes a CSV line for each created virtual machine in the same format as the CSV input, so it can be used to clone or remove the same set again
+    """
+
+    logger.debug('Writing results to %s', results_file)
+    with open_csv_file(results_file, 'w') as results:
+        results_writer = csv.writer(results, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+        for row in rows:
+            results_writer.writerow(row)
+
+
+def update_journal(logger, journal, records=None, claim=None):
+    """
+    Catches up with the records the other workers added to the journal and appends records, all under the journal lock. With claim, a lease on that virtual machine is taken if it is free and the lease status is returned: claimed, leased (by a live worker) or finished.
+    """
+
+    with journal['lock']:
+        with open(journal['file'], 'a+') as journal_fd:
+            fcntl.lockf(journal_fd, fcntl.LOCK_EX)
+            try:
+                journal_fd.seek(journal['offset'])
+                for line in journal_fd.readlines():
+                    try:
+                        record = json.loads(line)
+                        journal['leases'][record['vm']] = record
+                    except (ValueError, KeyError):
+                        continue
+                journal['offset'] = journal_fd.tell()
+
+                status = None
+                if claim is not None:
+                    lease = journal['leases'].get(claim)
+                    if lease is not None and lease['state'] in ('done', 'exists', 'failed'):
+                        return 'finished'
+                    if lease is not None and lease['worker'] != journal['worker'] and time() - lease['time'] < journal['ttl']:
+                        return 'leased'
+                    if lease is not None and lease['worker'] != journal['worker']:
+                        get_vm_logger(logger, claim).warning('Taking over the expired lease of worker %s', lease['worker'])
+                    records = [{'vm': claim, 'worker': journal['worker'], 'state': 'claimed', 'time': time()}]
+                    status = 'claimed'
+
+                for record in records or []:
+                    journal_fd.write(json.dumps(record, sort_keys=True) + '\n')
+                    journal['leases'][record['vm']] = record
+                journal_fd.flush()
+                os.fsync(journal_fd.fileno())
+                journal['offset'] = journal_fd.tell()
+                return status
+            finally:
+                fcntl.lockf(journal_fd, fcntl.LOCK_UN)
+
+
+def journal_heartbeat(logger, journal, stop):
+    """
+    Renews the leases of the virtual machines this worker is cloning until stopped, so other workers do not take them over
+    """
+
+    while not stop.wait(journal['ttl'] / 3.0):
+        with journal['lock']:
+            active = list(journal['active'])
+        if active:
+            logger.debug('Renewing the leases of %s VMs', len(active))
+            update_journal(logger, journal, [{'vm': vm_name, 'worker': journal['worker'], 'state': 'claimed', 'time': time()} for vm_name in active])
+
+
+def sharded_vm_clone_handler_wrapper(args):
+    """
+    Wrapping arround vm_clone_handler, the virtual machine is only cloned if it can be claimed in the journal. Returns the lease status.
+    """
+
+    journal, vm_spec = args
+    logger = vm_spec[1]
+    vm_name = vm_spec[3]
+    if drain['stop'].is_set():
+        get_vm_logger(logger, vm_name).info('Not cloning, the run is stopping')
+        return 'stopped'
+    status = update_journal(logger, journal, claim=vm_name)
+    if status != 'claimed':
+        get_vm_logger(logger, vm_name).debug('Not cloning, the VM is %s', status)
+        return status
+
+    with journal['lock']:
+        journal['active'].add(vm_name)
+    try:
+        vm = vm_clone_handler(*vm_spec)
+    finally:
+        with journal['lock']:
+            journal['active'].discard(vm_name)
+
+    if isinstance(vm, vim.VirtualMachine):
+        state = 'done'
+    elif vm == VM_EXISTS:
+        state = 'exists'
+    else:
+        state = 'failed'
+    update_journal(logger, journal, [{'vm': vm_name, 'worker': journal['worker'], 'state': state, 'time': time(), 'row': get_results_row(vm_spec)}])
+    return 'finished'
+
+
+def find_mac_ip(logger, vm, maxwait, ipv6=False):
     """
     Find the external mac and IP of a virtual machine and return it
     """
@@ -136,73 +877,82 @@ def find_mac_ip(logger, vm, maxwait, ipv6=False, threaded=False):
     ip = None
     waitcount = 0
 
-    while waitcount < maxwait:
-        if threaded:
-            logger.debug('THREAD %s - Waited for %s seconds, gathering net information' % (vm.config.name, waitcount))
-        else:
-            logger.debug('Waited for %s seconds, gathering net information for virtual machine %s' % (waitcount, vm.config.name))
+    while waitcount < maxwait and not is_drain_expired():
+        logger.debug('Waited for %s seconds, gathering net information', waitcount)
         net_info = vm.guest.net
 
         for cur_net in net_info:
             if cur_net.macAddress:
-                if threaded:
-                    logger.debug('THREAD %s - Mac address %s found' % (vm.config.name, cur_net.macAddress))
-                else:
-                    logger.debug('Mac address %s found for virtual machine %s' % (cur_net.macAddress, vm.config.name))
+                logger.debug('Mac address %s found', cur_net.macAddress)
                 mac = cur_net.macAddress
             if mac and cur_net.ipConfig:
                 if cur_net.ipConfig.ipAddress:
                     for cur_ip in cur_net.ipConfig.ipAddress:
-                        if threaded:
-                            logger.debug('THREAD %s - Checking ip address %s' % (vm.config.name, cur_ip.ipAddress))
-                        else:
-                            logger.debug('Checking ip address %s for virtual machine %s' % (cur_ip.ipAddress, vm.config.name))
+                        logger.debug('Checking ip address %s', cur_ip.ipAddress)
                         if ipv6 and re.match('\d{1,4}\:.*', cur_ip.ipAddress) and not re.match('fe83\:.*', cur_ip.ipAddress):
                             ip = cur_ip.ipAddress
                         elif not ipv6 and re.match('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', cur_ip.ipAddress) and cur_ip.ipAddress != '127.0.0.1':
                             ip = cur_ip.ipAddress
                         if ip:
-                            if threaded:
-                                logger.info('THREAD %s - Mac %s and ip %s found' % (vm.config.name, mac, ip))
-                            else:
-                                logger.info('Mac %s and ip %s found for virtual machine %s' % (mac, ip, vm.config.name))
+                            logger.info('Mac %s and ip %s found', mac, ip)
                             return [mac, ip]
 
-        if threaded:
-            logger.debug('THREAD %s - No IP found, waiting 5 seconds and retrying' % vm.config.name)
-        else:
-            logger.debug('No IP found for virtual machine %s, waiting 5 seconds and retrying' % vm.config.name)
+        logger.debug('No IP found, waiting 5 seconds and retrying')
         waitcount += 5
         sleep(5)
     if mac:
-        if threaded:
-            logger.info('THREAD %s - Found mac address %s, No ip address found' % (vm.config.name, mac))
-        else:
-            logger.info('Found mac address %s, No ip address found for virtual machine %s' % (mac, vm.config.name))
+        logger.info('Found mac address %s, No ip address found', mac)
         return [mac, '']
-    if threaded:
-        logger.info('THREAD %s - Unable to find mac address or ip address' % vm.config.name)
-    else:
-        logger.info('Unable to find mac address or ip address for virtual machine %s' % vm.config.name)
+    logger.info('Unable to find mac address or ip address')
+    return None
+
+
+def get_mac_device_spec(logger, vm, custom_mac):
+    """
+    Returns a device spec which sets the mac address of the first ethernet card of a virtual machine, or None if it has no ethernet card
+    """
+
+    logger.debug('Searching for ethernet device')
+    for vm_device in vm.config.hardware.device:
+        if isinstance(vm_device, vim.vm.device.VirtualEthernetCard):
+            logger.debug('Found ethernet device')
+            vm_device.addressType = "Manual"
+            vm_device.macAddress = custom_mac
+            logger.debug('Creating of device spec for ethernet card')
+            return vim.vm.device.VirtualDeviceSpec(device=vm_device, operation=vim.vm.device.VirtualDeviceSpec.Operation.edit)
     return None
 
 
-def run_post_script(logger, post_script, vm, mac_ip, custom_mac):
+def get_option_values(logger, adv_parameters):
+    """
+    Returns the option values for the advanced parameters in JSON format
+    """
+
+    logger.debug('Loading JSON data: %s', adv_parameters)
+    adv_parameters_dict = json.loads(adv_parameters)
+    vm_option_values = []
+    for key, value in adv_parameters_dict.items():
+        logger.debug('Creating option value for key %s and value %s', key, value)
+        vm_option_values.append(vim.option.OptionValue(key=key, value=value))
+    return vm_option_values
+
+
+def run_post_script(logger, post_script, vm_name, mac_ip, custom_mac):
     """
     Runs a post script for a vm
     """
     if mac_ip:
-        logger.info('Running post-script command: %s %s %s %s' % (post_script, vm.config.name, mac_ip[0], mac_ip[1]))
-        retcode = subprocess.call([post_script, vm.config.name, mac_ip[0], mac_ip[1]])
-        logger.debug('Received return code %s for command: %s %s %s %s' % (retcode, post_script, vm.config.name, mac_ip[0], mac_ip[1]))
+        logger.info('Running post-script command: %s %s %s %s', post_script, vm_name, mac_ip[0], mac_ip[1])
+        retcode = subprocess.call([post_script, vm_name, mac_ip[0], mac_ip[1]])
+        logger.debug('Received return code %s for command: %s %s %s %s', retcode, post_script, vm_name, mac_ip[0], mac_ip[1])
     elif custom_mac:
-        logger.info('Running post-script command: %s %s %s' % (post_script, vm.config.name, custom_mac))
-        retcode = subprocess.call([post_script, vm.config.name])
-        logger.debug('Received return code %s for command: %s %s' % (retcode, post_script, vm.config.name))
+        logger.info('Running post-script command: %s %s %s', post_script, vm_name, custom_mac)
+        retcode = subprocess.call([post_script, vm_name])
+        logger.debug('Received return code %s for command: %s %s', retcode, post_script, vm_name)
     else:
-        logger.info('Running post-script command: %s %s' % (post_script, vm.config.name))
-        retcode = subprocess.call([post_script, vm.config.name])
-        logger.debug('Received return code %s for command: %s %s' % (retcode, post_script, vm.config.name))
+        logger.info('Running post-script command: %s %s', post_script, vm_name)
+        retcode = subprocess.call([post_script, vm_name])
+        logger.debug('Received return code %s for command: %s %s', retcode, post_script, vm_name)
     return retcode
 
 
@@ -216,257 +966,961 @@ def get_snapshots_by_name_recursively(snapshots, snapname):
     return snap_obj
 
 
+def get_placement(si, logger, targets, strategy, clone_size, clone_provisioned, clone_memory, place_hosts):
+    """
+    Takes a snapshot of the free and provisioned space of the datastores matching the targets (names, patterns or datastore clusters), and of the free memory of the hosts if hosts are placed as well. The snapshot is updated locally as clones are placed.
+    """
+
+    # Datastore clusters are expanded to their datastores
+    pod_datastores = set()
+    for pod, properties in get_properties(si, logger, vim.StoragePod, ['name', 'childEntity']):
+        if properties.get('name') in targets:
+            logger.debug('Adding the datastores of datastore cluster %s', properties['name'])
+            pod_datastores.update(datastore._moId for datastore in properties.get('childEntity') or [])
+
+    datastores = []
+    for datastore, properties in get_properties(si, logger, vim.Datastore, ['name', 'summary.accessible', 'summary.capacity', 'summary.freeSpace', 'summary.uncommitted']):
+        name = properties.get('name')
+        if datastore._moId not in pod_datastores and not any(fnmatch.fnmatch(name, target) for target in targets):
+            continue
+        if not properties.get('summary.accessible'):
+            logger.warning('Datastore %s is not accessible, not placing clones on it', name)
+            continue
+        capacity = properties.get('summary.capacity') or 0
+        free = properties.get('summary.freeSpace') or 0
+        datastores.append({'name': name, 'obj': datastore, 'free': free, 'provisioned': capacity - free + (properties.get('summary.uncommitted') or 0), 'clones': 0})
+    datastores.sort(key=lambda datastore: datastore['name'])
+
+    hosts = []
+    if place_hosts:
+        for host, properties in get_properties(si, logger, vim.HostSystem, ['name', 'parent', 'datastore', 'runtime.connectionState', 'runtime.inMaintenanceMode', 'summary.hardware.memorySize', 'summary.quickStats.overallMemoryUsage']):
+            if properties.get('runtime.connectionState') != vim.HostSystem.ConnectionState.connected or properties.get('runtime.inMaintenanceMode'):
+                continue
+            free_memory = (properties.get('summary.hardware.memorySize') or 0) - (properties.get('summary.quickStats.overallMemoryUsage') or 0) * 1024 * 1024
+            hosts.append({'name': properties.get('name'), 'obj': host, 'parent': properties['parent']._moId, 'datastores': set(datastore._moId for datastore in properties.get('datastore') or []), 'free_memory': free_memory, 'clones': 0})
+        hosts.sort(key=lambda host: host['name'])
+
+    logger.info('Placing clones on %s datastores with the %s strategy', len(datastores), strategy)
+    return {'lock': threading.Lock(), 'strategy': strategy, 'clone_size': clone_size, 'clone_provisioned': clone_provisioned, 'clone_memory': clone_memory, 'datastores': datastores, 'hosts': hosts, 'next_datastore': 0, 'next_host': 0}
+
+
+def place_datastore(logger, placement):
+    """
+    Picks the datastore for a clone from the placement snapshot and accounts for the clone in it, returns the name and datastore or None if no datastore has enough free space
+    """
+
+    with placement['lock']:
+        candidates = [datastore for datastore in placement['datastores'] if datastore['free'] >= placement['clone_size']]
+        if not candidates:
+            return None, None
+        if placement['strategy'] == 'round-robin':
+            datastore = candidates[placement['next_datastore'] % len(candidates)]
+            placement['next_datastore'] += 1
+        else:
+            datastore = max(candidates, key=lambda datastore: datastore['free'])
+        datastore['free'] -= placement['clone_size']
+        datastore['provisioned'] += placement['clone_provisioned']
+        datastore['clones'] += 1
+        logger.info('Placed on datastore %s, leaving %s GB free and %s GB provisioned', datastore['name'], datastore['free'] // 1024 ** 3, datastore['provisioned'] // 1024 ** 3)
+        return datastore['name'], datastore['obj']
+
+
+def place_host(logger, placement, cluster, datastore):
+    """
+    Picks the host in the cluster for a clone from the placement snapshot, among the hosts with access to the datastore and enough free memory. Returns None if there is no such host, leaving the choice to vCenter.
+    """
+
+    with placement['lock']:
+        candidates = [host for host in placement['hosts'] if host['parent'] == cluster._moId and datastore._moId in host['datastores'] and host['free_memory'] >= placement['clone_memory']]
+        if not candidates:
+            return None
+        if placement['strategy'] == 'round-robin':
+            host = candidates[placement['next_host'] % len(candidates)]
+            placement['next_host'] += 1
+        else:
+            host = max(candidates, key=lambda host: host['free_memory'])
+        host['free_memory'] -= placement['clone_memory']
+        host['clones'] += 1
+        logger.info('Placed on host %s, leaving %s GB of memory free', host['name'], host['free_memory'] // 1024 ** 3)
+        return host['obj']
+
+
+def load_replica_cache(logger, cachefile):
+    """
+    Loads the replica cache, an empty cache is returned if the file does not exist or can not be read
+    """
+
+    cache = {'instances': {}}
+    if not os.path.isfile(cachefile):
+        return cache
+    try:
+        with open(cachefile, 'r') as cache_fd:
+            cache['instances'].update(json.load(cache_fd).get('instances', {}))
+    except (IOError, ValueError) as e:
+        logger.warning('Unable to read replica cache file %s, ignoring it: %s', cachefile, str(e))
+    return cache
+
+
+def save_replica_cache(logger, cachefile, cache):
+    """
+    Writes the replica cache to a temporary file and moves it in place, so concurrent readers never see a partial file
+    """
+
+    cachedir = os.path.dirname(os.path.abspath(cachefile))
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, prefix='.multi-clone-')
+        with os.fdopen(fd, 'w') as cache_fd:
+            json.dump(cache, cache_fd, sort_keys=True)
+        os.rename(tmpfile, cachefile)
+        logger.debug('Replica cache written to %s', cachefile)
+    except (IOError, OSError) as e:
+        logger.warning('Unable to write replica cache file %s: %s', cachefile, str(e))
+
+
+def get_replica_name(template, datastore_name):
+    """
+    Returns the name of the replica of a template on a datastore
+    """
+
+    return '%s-replica-%s' % (template, datastore_name)
+
+
+def seed_replica_wrapper(args):
+    """
+    Wrapping arround seed_replica
+    """
+
+    return seed_replica(*args)
+
+
+def seed_replica(logger, template, template_vm, datastore_name, datastore, snapshot, replica_vm):
+    """
+    Creates the replica of the template on a datastore if it does not exist yet and makes sure it has the snapshot for linked cloning. Returns the replica and its snapshot, or None if seeding failed.
+    """
+
+    replica_name = get_replica_name(template, datastore_name)
+    logger = get_vm_logger(logger, replica_name)
+    if replica_vm is None:
+        # The resource pool of a host with access to the datastore is used, the replica is never powered on
+        logger.info('Creating replica of %s on datastore %s', template, datastore_name)
+        relocate_spec = vim.vm.RelocateSpec(datastore=datastore, pool=datastore.host[0].key.parent.resourcePool)
+        clone_spec = vim.vm.CloneSpec(powerOn=False, template=False, location=relocate_spec)
+        info = wait_for_task(logger, template_vm.Clone(name=replica_name, folder=template_vm.parent, spec=clone_spec), replica_name, 'Replica cloning')
+        if info.state != vim.TaskInfo.State.success:
+            return None
+        replica_vm = info.result
+    else:
+        logger.info('Reusing replica of %s on datastore %s', template, datastore_name)
+
+    replica_snapshot = None
+    if snapshot:
+        replica_snapshot = []
+        if replica_vm.snapshot:
+            replica_snapshot = get_snapshots_by_name_recursively(snapshots=replica_vm.snapshot.rootSnapshotList, snapname=snapshot)
+        if len(replica_snapshot) != 1:
+            logger.info('Creating snapshot %s on replica', snapshot)
+            info = wait_for_task(logger, replica_vm.CreateSnapshot_Task(name=snapshot, memory=False, quiesce=False), replica_name, 'Replica snapshot')
+            if info.state != vim.TaskInfo.State.success:
+                return None
+            replica_snapshot = get_snapshots_by_name_recursively(snapshots=replica_vm.snapshot.rootSnapshotList, snapname=snapshot)
+    return replica_vm, replica_snapshot
+
+
+def seed_replicas(si, logger, template, template_vm, datastore_names, snapshot, threads, cachefile):
+    """
+    Makes sure there is a replica of the template on each of the datastores, creating the missing ones in parallel. Returns a dict with the replica and its snapshot for each datastore.
+    """
+
+    # The template itself is used for its own datastore
+    template_datastore_name = template_vm.datastore[0].info.name
+    datastore_names = sorted(set(datastore_names) - set([template_datastore_name]))
+    if not datastore_names:
+        return {}
+
+    logger.debug('Finding datastores %s', ', '.join(datastore_names))
+    datastores = {}
+    for datastore, properties in get_properties(si, logger, vim.Datastore, ['name']):
+        if properties.get('name') in datastore_names:
+            datastores[properties['name']] = datastore
+
+    # Existing replicas come from the cache, or are looked up by name at once
+    instance_uuid = si.content.about.instanceUuid
+    cache = None
+    existing = {}
+    if cachefile:
+        cache = load_replica_cache(logger, cachefile)
+        cached = cache['instances'].get(instance_uuid, {}).get(template, {})
+        cached_vms = dict((datastore_name, vim.VirtualMachine(cached[datastore_name], si._stub)) for datastore_name in datastore_names if datastore_name in cached)
+        try:
+            for vm, properties in get_properties(si, logger, vim.VirtualMachine, ['name'], objs=list(cached_vms.values())):
+                for datastore_name, cached_vm in cached_vms.items():
+                    if cached_vm._moId == vm._moId and properties.get('name') == get_replica_name(template, datastore_name):
+                        existing[datastore_name] = vm
+            logger.debug('Found %s replicas in the cache', len(existing))
+        except vmodl.fault.ManagedObjectNotFound:
+            logger.info('Cached replicas no longer exist, looking them up by name')
+            existing = {}
+    if len(existing) < len(datastore_names):
+        replica_names = dict((get_replica_name(template, datastore_name), datastore_name) for datastore_name in datastore_names)
+        for vm, properties in get_properties(si, logger, vim.VirtualMachine, ['name']):
+            if properties.get('name') in replica_names:
+                existing[replica_names[properties['name']]] = vm
+
+    seed_specs = []
+    for datastore_name in datastore_names:
+        if datastore_name not in datastores:
+            logger.error('Unable to find datastore %s, not creating a replica', datastore_name)
+            continue
+        seed_specs.append((logger, template, template_vm, datastore_name, datastores[datastore_name], snapshot, existing.get(datastore_name)))
+
+    logger.info('Seeding %s replicas of %s', len(seed_specs), template)
+    seed_pool = ThreadPool(threads)
+    results = seed_pool.map(seed_replica_wrapper, seed_specs, 1)
+    seed_pool.close()
+    seed_pool.join()
+
+    replicas = {}
+    for seed_spec, result in zip(seed_specs, results):
+        if result is None:
+            logger.error('Unable to seed the replica on datastore %s, cloning from %s instead', seed_spec[3], template)
+        else:
+            replicas[seed_spec[3]] = result
+
+    if cache is not None:
+        cache['instances'].setdefault(instance_uuid, {}).setdefault(template, {}).update((datastore_name, replica[0]._moId) for datastore_name, replica in replicas.items())
+        save_replica_cache(logger, cachefile, cache)
+    return replicas
+
+
+def get_vm_rows(logger, basename, count, amount, csvfile, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, post_script):
+    """
+    Returns a row for each virtual machine, from the basename and count or from the CSV, with the defaults filled in: name, datacenter, cluster, resource pool, folder, datastore, MAC, post script, advanced parameters and priority. Returns None if the CSV does not exist or is invalid.
+    """
+
+    vm_rows = []
+    if csvfile is None:
+        # Generate VM names
+        logger.debug('No CSV found working with amount and basename')
+        vm_names = []
+        for a in range(1, amount + 1):
+            vm_names.append('%s-%i' % (basename, count))
+            count += 1
+
+        vm_names.sort()
+        for vm_name in vm_names:
+            vm_rows.append([vm_name, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, None, post_script, None, 0])
+    else:
+        # CSV fields:
+        # VM Name, Resource Pool, Folder, MAC Address, Post Script
+        logger.debug('Parsing csv %s', csvfile)
+
+        if not os.path.isfile(csvfile):
+            logger.critical('CSV file %s does not exist, exiting', csvfile)
+            return None
+
+        with open_csv_file(csvfile) as tasklist:
+            taskreader = csv.reader(tasklist, delimiter=';', quotechar='"')
+            for row in taskreader:
+                logger.debug('Found CSV row: %s', ','.join(row))
+                row = row + [''] * (10 - len(row))
+                # VM Name
+                if row[0] is None or row[0] is '':
+                    logger.warning('No VM name specified, skipping this vm creation')
+                    continue
+                else:
+                    cur_vm_name = row[0]
+                # Datacenter
+                if row[1] is None or row[1] is '':
+                    cur_datacenter_name = datacenter_name
+                else:
+                    cur_datacenter_name = row[1]
+                # Cluster
+                if row[2] is None or row[2] is '':
+                    cur_cluster_name = cluster_name
+                else:
+                    cur_cluster_name = row[2]
+                # Resource Pool
+                if row[3] is None or row[3] is '':
+                    cur_resource_pool_name = resource_pool_name
+                else:
+                    cur_resource_pool_name = row[3]
+                # Folder
+                if row[4] is None or row[4] is '':
+                    cur_folder_name = folder_name
+                else:
+                    cur_folder_name = row[4]
+                # Datastore
+                if row[5] is None or row[5] is '':
+                    cur_datastore_name = datastore_name
+                else:
+                    cur_datastore_name = row[5]
+                # MAC
+                if row[6] is None or row[6] is '':
+                    custom_mac = None
+                else:
+                    custom_mac = row[6]
+                # Post script
+                if row[7] is None or row[7] is '':
+                    cur_post_script = post_script
+                else:
+                    cur_post_script = row[7]
+                # Advanced parameters
+                if row[8] is None or row[8] is '':
+                    cur_adv_parameters = None
+                else:
+                    cur_adv_parameters = row[8]
+                # Priority
+                if not row[9]:
+                    cur_priority = 0
+                elif re.match(r'^-?\d+$', row[9].strip()):
+                    cur_priority = int(row[9])
+                else:
+                    logger.critical('Priority %s of %s is not a number, exiting', row[9], cur_vm_name)
+                    return None
+
+                # Creating VM
+                vm_rows.append([cur_vm_name, cur_datacenter_name, cur_cluster_name, cur_resource_pool_name, cur_folder_name, cur_datastore_name, custom_mac, cur_post_script, cur_adv_parameters, cur_priority])
+    return vm_rows
+
+
+def get_expected_tasks(row, instant):
+    """
+    Returns the amount of tasks needed to clone the virtual machine of a row, as an estimate of how long it takes. Instant clones set the MAC address and advanced parameters as part of the clone, other clones need a reconfigure task for each.
+    """
+
+    if instant:
+        return 1
+    return 1 + (1 if row[6] else 0) + (1 if row[8] else 0)
+
+
+def order_vm_rows(logger, vm_rows, order, instant):
+    """
+    Orders the rows of the virtual machines in the order they are cloned. Rows with a higher priority always go first. Within a priority, the rows keep their order (input), take turns over their datastores and clusters (fair-share) or the clones needing the least tasks go first (shortest-first).
+    """
+
+    ordered_rows = []
+    for priority in sorted(set(row[9] for row in vm_rows), reverse=True):
+        rows = [row for row in vm_rows if row[9] == priority]
+        if order == 'fair-share':
+            groups = {}
+            keys = []
+            for row in rows:
+                key = (row[5], row[2])
+                if key not in groups:
+                    keys.append(key)
+                    groups[key] = []
+                groups[key].append(row)
+            logger.debug('Interleaving %s VMs with priority %s over %s datastore and cluster combinations', len(rows), priority, len(keys))
+            rows = []
+            for index in range(max(len(group) for group in groups.values())):
+                rows.extend(groups[key][index] for key in keys if index < len(groups[key]))
+        elif order == 'shortest-first':
+            logger.debug('Ordering %s VMs with priority %s by their amount of tasks', len(rows), priority)
+            rows.sort(key=lambda row: get_expected_tasks(row, instant))
+        ordered_rows.extend(rows)
+    return ordered_rows
+
+
+def find_template(si, logger, template, linked, snapshot, instant, replicas, inventory=None):
+    """
+    Finds the template and, for linked cloning, its snapshot and checks if they can be used. Returns None for both if not.
+    """
+
+    # Find the correct VM
+    logger.debug('Finding template %s', template)
+    template_vm = find_obj(si, logger, template, [vim.VirtualMachine], inventory)
+    if template_vm is None:
+        logger.error('Unable to find template %s', template)
+        return None, None
+    logger.info('Template %s found', template)
+
+    # Instant clones are created from a running virtual machine
+    if instant and linked:
+        logger.error('Instant cloning and linked cloning can not be combined.')
+        return None, None
+    elif instant and replicas:
+        logger.error('Instant cloning and template replicas can not be combined.')
+        return None, None
+    elif instant and template_vm.runtime.powerState != vim.VirtualMachinePowerState.poweredOn:
+        logger.error('The source virtual machine %s has to be powered on for instant cloning.', template)
+        return None, None
+
+    # Finding the snapshot if linked
+    template_snapshot = None
+    if linked and not snapshot:
+        logger.error('When linked cloning is enabled, a snapshot has to be provided.')
+        return None, None
+    elif linked:
+        template_snapshot = get_snapshots_by_name_recursively(snapshots=template_vm.snapshot.rootSnapshotList, snapname=snapshot)
+        if len(template_snapshot) != 1:
+            logger.error('Snapshot %s not found.', snapshot)
+            return None, None
+        logger.info('Snapshot %s found.', snapshot)
+    return template_vm, template_snapshot
+
+
+def process_init(slots, stop, timeout, cancel_queued):
+    """
+    Initializes a worker process with the semaphore limiting the clones running at once over all processes, and the stop event of the main process. The main process handles the signals, the SIGTERM of a terminated pool ends the worker right away.
+    """
+
+    global process_slots
+    process_slots = slots
+    drain['stop'] = stop
+    drain['timeout'] = timeout
+    drain['cancel_queued'] = cancel_queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def process_clone_handler(args):
+    """
+    Clones a part of the virtual machines in a worker process, with its own vCenter session and thread pools. Returns the row of each virtual machine with whether it was created, or None if the process could not start cloning.
+    """
+
+    settings, vm_rows = args
+    logging.basicConfig(filename=settings['log_file'], format='%(asctime)s %(levelname)s %(message)s', level=settings['log_level'])
+    logger = logging.getLogger(__name__)
+    import_vsphere_modules()
+    transport['compress'] = settings['compress']
+    transport['page_size'] = settings['page_size']
+    transport['stats'] = settings['transfer_stats']
+
+    si = None
+    try:
+        logger.info('Connecting to server %s:%s with username %s in process %s', settings['host'], settings['port'], settings['username'], os.getpid())
+        si = vsphere_helpers.smart_connect(settings['host'], settings['username'], settings['password'], int(settings['port']), settings['nosslcheck'], **get_connect_args())
+    except IOError:
+        pass
+    if not si:
+        logger.error('Could not connect to host %s with user %s and specified password', settings['host'], settings['username'])
+        return None
+    if transport['stats']:
+        count_transfer(si)
+
+    log_listener = start_log_queue()
+    try:
+        template_vm, template_snapshot = find_template(si, logger, settings['template'], settings['linked'], settings['snapshot'], settings['instant'], False)
+        if template_vm is None:
+            return None
+
+        pool = ThreadPool(settings['threads'])
+        mac_ip_pool = ThreadPool(settings['threads'])
+        mac_ip_pool_results = []
+        power_on_batches = None
+        if settings['batch_power_on']:
+            power_on_batches = {'lock': threading.Lock(), 'window': settings['batch_window'], 'datacenters': {}}
+        retry = get_retry_settings(settings['retries'], settings['retry_delay'], settings['retry_budget'], settings['breaker_threshold'], settings['breaker_cooldown'])
+
+        vm_specs = []
+        for row in vm_rows:
+            vm_specs.append((si, logger, settings['linked'], row[0], row[1], row[2], row[3], row[4], row[5], row[6], settings['ipv6'], settings['maxwait'], row[7], settings['power_on'], settings['print_ips'], settings['print_macs'], settings['template'], template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, row[8], power_on_batches, settings['instant'], {}, None, None, retry))
+        vms = pool.map(vm_clone_handler_wrapper, vm_specs, 1)
+        pool.close()
+        pool.join()
+
+        wait_for_pool_results(logger, mac_ip_pool_results)
+        mac_ip_pool.close()
+        mac_ip_pool.join()
+
+        return [(row, isinstance(vm, vim.VirtualMachine)) for row, vm in zip(vm_rows, vms)]
+    finally:
+        Disconnect(si)
+        stop_log_queue(log_listener)
+        if transport['stats']:
+            print_transfer_stats('Transfer statistics of process %s' % os.getpid())
+
+
+def run_processes(logger, settings, vm_rows, processes, results_file):
+    """
+    Splits the virtual machines over worker processes, each with its own vCenter session, while the amount of threads limits the clones running at once over all processes. Collects the results of all processes.
+    """
+
+    slots = multiprocessing.Semaphore(settings['threads'])
+    drain['stop'] = multiprocessing.Event()
+    chunks = [vm_rows[index::processes] for index in range(processes)]
+    logger.info('Cloning %s VMs in %s processes, with %s clones at once', len(vm_rows), processes, settings['threads'])
+    process_pool = multiprocessing.Pool(processes, initializer=process_init, initargs=(slots, drain['stop'], drain['timeout'], drain['cancel_queued']))
+    try:
+        process_results = process_pool.map_async(process_clone_handler, [(settings, chunk) for chunk in chunks if chunk], 1)
+        wait_for_pool_results(logger, [process_results])
+        results = process_results.get()
+    except (Exception, KeyboardInterrupt):
+        # An abort or a failure of the main process does not wait for the clones of the worker processes
+        process_pool.terminate()
+        process_pool.join()
+        raise
+    process_pool.close()
+    process_pool.join()
+
+    created = set()
+    failed = False
+    for process_results in results:
+        if process_results is None:
+            failed = True
+            continue
+        created.update(row[0] for row, vm_created in process_results if vm_created)
+    logger.info('Created %s of %s VMs', len(created), len(vm_rows))
+
+    if results_file:
+        write_results_file(logger, results_file, [['' if field is None else field for field in row[:9]] for row in vm_rows if row[0] in created])
+    if is_stop_requested():
+        logger.warning('The run was stopped before all VMs were cloned')
+        return 1
+    if failed:
+        return 1
+    logger.info('Finished all tasks')
+    return 0
+
+
+def get_json_value(value):
+    """
+    Returns a property value which can be sent as JSON, managed objects are sent as their ID
+    """
+
+    if isinstance(value, vim.ManagedObject):
+        return value._moId
+    elif value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+def send_service_message(logger, connection, lock, message):
+    """
+    Sends a status message to a client of the service, as a line of JSON
+    """
+
+    with lock:
+        try:
+            connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        except socket.error as e:
+            logger.debug('Unable to send the status of job %s to the client: %s', message.get('id'), str(e))
+
+
+def service_clone_job(si, logger, service, request):
+    """
+    Clones a virtual machine for a job of the service, with the settings the service was started with as defaults
+    """
+
+    settings = service['settings']
+    vm_name = request['name']
+    template = request.get('template', settings['template'])
+    if not template:
+        return {'state': 'error', 'message': 'A clone job needs a template, as the service was started without one'}
+    linked = request.get('linked', settings['linked'])
+    snapshot = request.get('snapshot', settings['snapshot'])
+    instant = request.get('instant', settings['instant'])
+    power_on = request.get('power_on', settings['power_on'])
+    adv_parameters = request.get('parameters')
+    if isinstance(adv_parameters, dict):
+        adv_parameters = json.dumps(adv_parameters)
+
+    template_vm, template_snapshot = find_template(si, logger, template, linked, snapshot, instant, False, service['inventory'])
+    if template_vm is None:
+        return {'state': 'error', 'message': 'Template %s can not be used for this clone' % template}
+
+    mac_ip_pool_results = []
+    vm = vm_clone_handler(si, logger, linked, vm_name, request.get('datacenter', settings['datacenter']), request.get('cluster', settings['cluster']), request.get('resource_pool', settings['resource_pool']), request.get('folder', settings['folder']), request.get('datastore', settings['datastore']), request.get('mac'), settings['ipv6'], settings['maxwait'], request.get('post_script', settings['post_script']), power_on, False, False, template, template_vm, template_snapshot, service['mac_ip_pool'], mac_ip_pool_results, adv_parameters, service['power_on_batches'], instant, {}, None, service['inventory'], service['retry'])
+    for running_task in mac_ip_pool_results:
+        running_task.wait()
+    if not isinstance(vm, vim.VirtualMachine):
+        return {'state': 'error', 'message': 'Virtual machine %s was not created, see the log for details' % vm_name}
+
+    message = {'state': 'success', 'name': vm_name, 'moid': vm._moId}
+    if request.get('mac_ip') and (power_on or instant):
+        mac_ip = find_mac_ip(get_vm_logger(logger, vm_name), vm, settings['maxwait'], settings['ipv6'])
+        if mac_ip:
+            message['mac'] = mac_ip[0]
+            message['ip'] = mac_ip[1]
+    return message
+
+
+def service_migrate_job(si, logger, service, request):
+    """
+    Migrates a virtual machine to another host, datastore and/or resource pool for a job of the service
+    """
+
+    inventory = service['inventory']
+    vm_name = request['name']
+    logger = get_vm_logger(logger, vm_name)
+    vm = find_inventory_obj(inventory, vm_name, vim.VirtualMachine)
+    if vm is None:
+        return {'state': 'error', 'message': 'Unable to find virtual machine %s' % vm_name}
+
+    relocate_spec = vim.vm.RelocateSpec()
+    for key, vimtype, attribute in [('host', vim.HostSystem, 'host'), ('datastore', vim.Datastore, 'datastore'), ('resource_pool', vim.ResourcePool, 'pool')]:
+        if request.get(key):
+            obj = find_inventory_obj(inventory, request[key], vimtype)
+            if obj is None:
+                return {'state': 'error', 'message': 'Unable to find %s %s' % (key.replace('_', ' '), request[key])}
+            setattr(relocate_spec, attribute, obj)
+    if relocate_spec.host is None and relocate_spec.datastore is None:
+        return {'state': 'error', 'message': 'A migrate job needs a host or a datastore'}
+
+    logger.info('Migrating to host %s and datastore %s', request.get('host'), request.get('datastore'))
+    info = run_task(logger, service['retry'], functools.partial(vm.RelocateVM_Task, spec=relocate_spec, priority=vim.VirtualMachine.MovePriority.defaultPriority), vm_name, 'Migration', [relocate_spec.host, relocate_spec.datastore])
+    if info is None:
+        return {'state': 'error', 'message': 'Migration of %s was not started, as a circuit breaker of its host or datastore is open' % vm_name}
+    elif info.state != vim.TaskInfo.State.success:
+        return {'state': 'error', 'message': 'Migration of %s failed: %s' % (vm_name, info.error.msg)}
+    return {'state': 'success', 'name': vm_name, 'moid': vm._moId}
+
+
+def service_lookup_job(logger, service, request):
+    """
+    Looks up an object by its type and name in the live inventory and returns its ID and properties
+    """
+
+    lookup_type = request.get('type', 'vm')
+    if lookup_type not in LOOKUP_TYPES:
+        return {'state': 'error', 'message': 'Unknown lookup type %s, use one of %s' % (lookup_type, ', '.join(sorted(LOOKUP_TYPES.keys())))}
+    obj = find_inventory_obj(service['inventory'], request.get('name'), LOOKUP_TYPES[lookup_type])
+    if obj is None:
+        return {'state': 'error', 'message': 'Unable to find %s %s' % (lookup_type.replace('_', ' '), request.get('name'))}
+    logger.debug('Found %s %s as %s', lookup_type, request.get('name'), obj._moId)
+    properties = get_inventory_properties(service['inventory'], obj)
+    return {'state': 'success', 'name': request.get('name'), 'moid': obj._moId, 'properties': dict((key, get_json_value(value)) for key, value in properties.items())}
+
+
+def service_job_handler(si, logger, service, request, send):
+    """
+    Runs a job of the service and streams its status to the client. Clone and migrate jobs wait for a free thread slot and report the progress of their tasks, lookups are answered from the live inventory right away.
+    """
+
+    job_id = request.get('id')
+    job = request.get('job')
+    vm_name = request.get('name')
+
+    def send_task_status(description, info):
+        send({'id': job_id, 'state': 'running', 'task': description, 'task_state': str(info.state), 'progress': info.progress})
+
+    send({'id': job_id, 'state': 'accepted'})
+    try:
+        if job == 'lookup':
+            message = service_lookup_job(logger, service, request)
+        elif job in ['clone', 'migrate'] and not vm_name:
+            message = {'state': 'error', 'message': 'A %s job needs the name of a virtual machine' % job}
+        elif job in ['clone', 'migrate']:
+            with service['lock']:
+                busy = vm_name in task_listeners
+                if not busy:
+                    task_listeners[vm_name] = send_task_status
+            if busy:
+                message = {'state': 'error', 'message': 'A job for virtual machine %s is already running' % vm_name}
+            else:
+                try:
+                    with service['slots']:
+                        send({'id': job_id, 'state': 'running'})
+                        if job == 'clone':
+                            message = service_clone_job(si, logger, service, request)
+                        else:
+                            message = service_migrate_job(si, logger, service, request)
+                finally:
+                    task_listeners.pop(vm_name, None)
+        else:
+            message = {'state': 'error', 'message': 'Unknown job %s, use one of clone, migrate or lookup' % job}
+    except vmodl.MethodFault as e:
+        logger.error('Job %s failed with vmodl fault: %s', job_id, e.msg)
+        message = {'state': 'error', 'message': 'Caught vmodl fault: %s' % e.msg}
+    except Exception as e:
+        logger.error('Job %s failed with exception: %s', job_id, str(e))
+        message = {'state': 'error', 'message': 'Caught exception: %s' % str(e)}
+    message['id'] = job_id
+    send(message)
+
+
+def service_connection_handler(si, logger, service, connection):
+    """
+    Reads the jobs of a client, one JSON object per line, and runs each of them in its own thread. The connection is closed once the client stopped sending and all of its jobs are finished.
+    """
+
+    lock = threading.Lock()
+    jobs = []
+
+    def send(message):
+        send_service_message(logger, connection, lock, message)
+
+    try:
+        for line in connection.makefile('r'):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                send({'state': 'error', 'message': 'Unable to parse job: %s' % line})
+                continue
+            with service['lock']:
+                service['jobs'] += 1
+                request.setdefault('id', service['jobs'])
+            logger.info('Received %s job %s for %s', request.get('job'), request['id'], request.get('name'))
+            job = threading.Thread(target=service_job_handler, args=(si, logger, service, request, send))
+            job.daemon = True
+            job.start()
+            jobs.append(job)
+        for job in jobs:
+            job.join()
+    finally:
+        connection.close()
+
+
+def run_service(si, logger, service, listen):
+    """
+    Runs the service on a Unix socket until it is interrupted, each client is handled in its own thread
+    """
+
+    if os.path.exists(listen) and not stat.S_ISSOCK(os.stat(listen).st_mode):
+        logger.error('%s already exists and is not a socket', listen)
+        return 1
+    elif os.path.exists(listen):
+        logger.debug('Removing old socket %s', listen)
+        os.remove(listen)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(listen)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    logger.info('Listening for jobs on %s', listen)
+
+    try:
+        while True:
+            connection, address = server.accept()
+            logger.debug('Accepted a client connection')
+            client = threading.Thread(target=service_connection_handler, args=(si, logger, service, connection))
+            client.daemon = True
+            client.start()
+    except KeyboardInterrupt:
+        logger.info('Stopping the service')
+    finally:
+        server.close()
+        os.remove(listen)
+        stop_inventory_watch(logger, service['inventory'])
+        service['mac_ip_pool'].close()
+    return 0
+
+
 def vm_clone_handler_wrapper(args):
     """
-    Wrapping arround vm_clone_handler
+    Wrapping arround vm_clone_handler, in a worker process the clone waits for a free slot over all processes. Once the run is stopping, no new clones are started.
     """
 
-    return vm_clone_handler(*args)
+    if process_slots is not None:
+        with process_slots:
+            if not drain['stop'].is_set():
+                return vm_clone_handler(*args)
+    elif not drain['stop'].is_set():
+        return vm_clone_handler(*args)
+    get_vm_logger(args[1], args[3]).info('Not cloning, the run is stopping')
+    return None
 
 
-def vm_clone_handler(si, logger, linked, vm_name, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, custom_mac, ipv6, maxwait, post_script, power_on, print_ips, print_macs, template, template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, adv_parameters):
+def vm_clone_handler(si, logger, linked, vm_name, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, custom_mac, ipv6, maxwait, post_script, power_on, print_ips, print_macs, template, template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, adv_parameters, power_on_batches, instant, replicas, placement, inventory=None, retry=None):
     """
     Will handle the thread handling to clone a virtual machine and run post processing
     """
 
-    run_loop = True
     vm = None
+    logger = get_vm_logger(logger, vm_name)
 
-    logger.debug('THREAD %s - started' % vm_name)
-    logger.info('THREAD %s - Trying to clone %s to new virtual machine' % (vm_name, template))
+    logger.debug('started')
+    logger.info('Trying to clone %s to new virtual machine', template)
 
     # Find the correct Datacenter
     datacenter = None
     if datacenter_name:
-        logger.debug('THREAD %s - Finding datacenter %s' % (vm_name, datacenter_name))
-        datacenter = find_obj(si, logger, datacenter_name, [vim.Datacenter], False)
+        logger.debug('Finding datacenter %s', datacenter_name)
+        datacenter = find_obj(si, logger, datacenter_name, [vim.Datacenter], inventory)
         if datacenter is None:
-            logger.critical('THREAD %s - Unable to find datacenter %s' % (vm_name, datacenter_name))
+            logger.critical('Unable to find datacenter %s', datacenter_name)
             return 1
-        logger.info('THREAD %s - Datacenter %s found' % (vm_name, datacenter_name))
+        logger.info('Datacenter %s found', datacenter_name)
 
     # Find the correct Cluster
     cluster = None
     if cluster_name:
-        logger.debug('THREAD %s - Finding cluster %s' % (vm_name, cluster_name))
-        cluster = find_obj(si, logger, cluster_name, [vim.ClusterComputeResource], False)
+        logger.debug('Finding cluster %s', cluster_name)
+        cluster = find_obj(si, logger, cluster_name, [vim.ClusterComputeResource], inventory)
         if cluster is None:
-            logger.critical('THREAD %s - Unable to find cluster %s' % (vm_name, cluster_name))
+            logger.critical('Unable to find cluster %s', cluster_name)
             return 1
-        logger.info('THREAD %s - Cluster %s found' % (vm_name, cluster_name))
+        logger.info('Cluster %s found', cluster_name)
 
     # Find the correct Resource Pool
     resource_pool = None
     if resource_pool_name:
-        logger.debug('THREAD %s - Finding resource pool %s' % (vm_name, resource_pool_name))
-        resource_pool = find_obj(si, logger, resource_pool_name, [vim.ResourcePool], False)
+        logger.debug('Finding resource pool %s', resource_pool_name)
+        resource_pool = find_obj(si, logger, resource_pool_name, [vim.ResourcePool], inventory)
         if resource_pool is None:
-            logger.critical('THREAD %s - Unable to find resource pool %s' % (vm_name, resource_pool_name))
+            logger.critical('Unable to find resource pool %s', resource_pool_name)
             return 1
-        logger.info('THREAD %s - Resource pool %s found' % (vm_name, resource_pool_name))
+        logger.info('Resource pool %s found', resource_pool_name)
     elif cluster:
-        logger.info('THREAD %s - No resource pool specified, but a cluster is. Using its root resource pool.' % vm_name)
+        logger.info('No resource pool specified, but a cluster is. Using its root resource pool.')
         resource_pool = cluster.resourcePool
     else:
-        logger.info('THREAD %s - No resource pool specified. Using the default resource pool.' % vm_name)
-        resource_pool = find_obj(si, logger, 'Resources', [vim.ResourcePool], False)
+        logger.info('No resource pool specified. Using the default resource pool.')
+        resource_pool = find_obj(si, logger, 'Resources', [vim.ResourcePool], inventory)
 
     # Find the correct folder
     folder = None
     if folder_name:
-        logger.debug('THREAD %s - Finding folder %s' % (vm_name, folder_name))
-        folder = find_obj(si, logger, folder_name, [vim.Folder], False)
+        logger.debug('Finding folder %s', folder_name)
+        folder = find_obj(si, logger, folder_name, [vim.Folder], inventory)
         if folder is None:
-            logger.critical('THREAD %s - Unable to find folder %s' % (vm_name, folder_name))
+            logger.critical('Unable to find folder %s', folder_name)
             return 1
-        logger.info('THREAD %s - Folder %s found' % (vm_name, folder_name))
+        logger.info('Folder %s found', folder_name)
     elif datacenter:
-        logger.info('THREAD %s - Setting folder to datacenter root folder as a datacenter has been defined' % vm_name)
+        logger.info('Setting folder to datacenter root folder as a datacenter has been defined')
         folder = datacenter.vmFolder
     else:
-        logger.info('THREAD %s - Setting folder to template folder as default' % vm_name)
+        logger.info('Setting folder to template folder as default')
         folder = template_vm.parent
 
     # Find the correct datastore
     datastore = None
-    if datastore_name:
-        logger.debug('THREAD %s - Finding datastore %s' % (vm_name, datastore_name))
-        datastore = find_obj(si, logger, datastore_name, [vim.Datastore], False)
+    if placement is not None and not datastore_name:
+        datastore_name, datastore = place_datastore(logger, placement)
         if datastore is None:
-            logger.critical('THREAD %s - Unable to find datastore %s' % (vm_name, datastore_name))
+            logger.critical('No datastore has enough free space for the clone')
             return 1
-        logger.info('THREAD %s - Datastore %s found' % (vm_name, datastore_name))
+    elif datastore_name:
+        logger.debug('Finding datastore %s', datastore_name)
+        datastore = find_obj(si, logger, datastore_name, [vim.Datastore], inventory)
+        if datastore is None:
+            logger.critical('Unable to find datastore %s', datastore_name)
+            return 1
+        logger.info('Datastore %s found', datastore_name)
     else:
-        datastore = find_obj(si, logger, template_vm.datastore[0].info.name, [vim.Datastore], False)
+        datastore = find_obj(si, logger, template_vm.datastore[0].info.name, [vim.Datastore], inventory)
+
+    # Clone from the replica of the template on the target datastore
+    if replicas and datastore_name in replicas:
+        logger.info('Using the replica of %s on datastore %s', template, datastore_name)
+        template_vm, template_snapshot = replicas[datastore_name]
 
     # Creating necessary specs
-    logger.debug('THREAD %s - Creating relocate spec' % vm_name)
+    logger.debug('Creating relocate spec')
     relocate_spec = vim.vm.RelocateSpec()
     if resource_pool:
-        logger.debug('THREAD %s - Resource pool found, using' % vm_name)
+        logger.debug('Resource pool found, using')
         relocate_spec.pool = resource_pool
     if datastore:
-        logger.debug('THREAD %s - Datastore found, using' % vm_name)
+        logger.debug('Datastore found, using')
         relocate_spec.datastore = datastore
-    if linked:
-        logger.debug('THREAD %s - Linked clone enabled' % vm_name)
+    if placement is not None and placement['hosts'] and cluster:
+        relocate_spec.host = place_host(logger, placement, cluster, datastore)
+    if linked and not instant:
+        logger.debug('Linked clone enabled')
         relocate_spec.diskMoveType = vim.vm.RelocateSpec.DiskMoveOptions.createNewChildDiskBacking
 
-    logger.debug('THREAD %s - Creating clone spec' % vm_name)
+    logger.debug('Creating clone spec')
     clone_spec = vim.vm.CloneSpec(powerOn=False, template=False, location=relocate_spec)
     if linked:
         clone_spec.snapshot = template_snapshot[0].snapshot
 
-    if find_obj(si, logger, vm_name, [vim.VirtualMachine], True):
-        logger.warning('THREAD %s - Virtual machine already exists, not creating' % vm_name)
-        run_loop = False
+    if find_obj(si, logger, vm_name, [vim.VirtualMachine], inventory):
+        logger.warning('Virtual machine already exists, not creating')
+        return VM_EXISTS
+    elif instant:
+        # The MAC address and advanced parameters are part of the instant clone spec, as the clone starts running right away
+        logger.debug('Creating instant clone spec')
+        relocate_spec.folder = folder
+        instant_clone_spec = vim.vm.InstantCloneSpec(name=vm_name, location=relocate_spec)
+        if custom_mac:
+            logger.info('Setting mac to %s', custom_mac)
+            vm_device_spec = get_mac_device_spec(logger, template_vm, custom_mac)
+            if vm_device_spec is not None:
+                relocate_spec.deviceChange = [vm_device_spec]
+        if adv_parameters:
+            logger.info('Setting advanced parameters')
+            instant_clone_spec.config = get_option_values(logger, adv_parameters)
+        logger.debug('Creating instant clone task')
+        info = run_task(logger, retry, functools.partial(template_vm.InstantClone_Task, spec=instant_clone_spec), vm_name, 'Instant cloning', [datastore, relocate_spec.host])
+        if info is not None and info.state == vim.TaskInfo.State.success:
+            logger.info('Instant cloned and running')
+            vm = info.result
     else:
-        logger.debug('THREAD %s - Creating clone task' % vm_name)
-        task = template_vm.Clone(name=vm_name, folder=folder, spec=clone_spec)
-        logger.info('THREAD %s - Cloning task created' % vm_name)
-        logger.info('THREAD %s - Checking task for completion. This might take a while' % vm_name)
-
-    while run_loop:
-        info = task.info
-        logger.debug('THREAD %s - Checking clone task' % vm_name)
-        if info.state == vim.TaskInfo.State.success:
-            logger.info('THREAD %s - Cloned and running' % vm_name)
+        logger.debug('Creating clone task')
+        logger.info('Checking task for completion. This might take a while')
+        info = run_task(logger, retry, functools.partial(template_vm.Clone, name=vm_name, folder=folder, spec=clone_spec), vm_name, 'Cloning', [datastore, relocate_spec.host])
+        if info is not None and info.state == vim.TaskInfo.State.success:
+            logger.info('Cloned and running')
             vm = info.result
-            run_loop = False
-            break
-        elif info.state == vim.TaskInfo.State.running:
-            logger.debug('THREAD %s - Cloning task is at %s percent' % (vm_name, info.progress))
-        elif info.state == vim.TaskInfo.State.queued:
-            logger.debug('THREAD %s - Cloning task is queued' % vm_name)
-        elif info.state == vim.TaskInfo.State.error:
-            if info.error.fault:
-                logger.info('THREAD %s - Cloning task has quit with error: %s' % (vm_name, info.error.fault.faultMessage))
-            else:
-                logger.info('THREAD %s - Cloning task has quit with cancelation' % vm_name)
-            run_loop = False
-            break
-        logger.debug('THREAD %s - Sleeping 2 seconds for new check' % vm_name)
-        sleep(2)
 
-    if vm and custom_mac is not None and custom_mac is not '':
-        vm_ethernet = None
-        config_spec = None
-        logger.info('THREAD %s - Trying to set mac to %s' % (vm_name, custom_mac))
-        logger.debug('THREAD %s - Searching for ethernet device' % vm_name)
-        for vm_device in vm.config.hardware.device:
-            if isinstance(vm_device, vim.vm.device.VirtualEthernetCard):
-                logger.debug('THREAD %s - Found ethernet device' % vm_name)
-                vm_ethernet = vm_device
-                break
-
-        if vm_ethernet is not None:
-            vm_ethernet.addressType = "Manual"
-            vm_ethernet.macAddress = custom_mac
-            logger.debug('THREAD %s - Creating of device spec for ethernet card' % vm_name)
-            vm_device_spec = vim.vm.device.VirtualDeviceSpec(device=vm_ethernet, operation=vim.vm.device.VirtualDeviceSpec.Operation.edit)
-            logger.debug('THREAD %s - Creating of config spec for VM' % vm_name)
+    if vm and is_drain_expired():
+        logger.warning('The run is stopping and its deadline has passed, not configuring or powering on the clone')
+        return vm
+
+    if vm and not instant and custom_mac is not None and custom_mac is not '':
+        logger.info('Trying to set mac to %s', custom_mac)
+        vm_device_spec = get_mac_device_spec(logger, vm, custom_mac)
+        if vm_device_spec is not None:
+            logger.debug('Creating of config spec for VM')
             config_spec = vim.vm.ConfigSpec(deviceChange=[vm_device_spec])
-            logger.info('THREAD %s - Applying MAC address change. This might take a couple of seconds' % vm_name)
-            config_task = vm.ReconfigVM_Task(spec=config_spec)
-            logger.debug('THREAD %s - Waiting fo MAC address change to complete' % vm_name)
-            run_loop = True
-            while run_loop:
-                info = task.info
-                if info.state == vim.TaskInfo.State.success:
-                    logger.debug('THREAD %s - Mac address change completed' % vm_name)
-                    run_loop = False
-                    break
-                elif info.state == vim.TaskInfo.State.error:
-                    if info.error.fault:
-                        logger.info('THREAD %s - MAC address change has quit with error: %s' % (vm_name, info.error.fault.faultMessage))
-                    else:
-                        logger.info('THREAD %s - MAC address change has quit with cancelation' % vm_name)
-                    run_loop = False
-                    break
-                sleep(2)
-
-    if vm and adv_parameters is not None and adv_parameters is not '':
-        logger.info('THREAD %s - Setting advanced parameters' % vm_name)
-        logger.debug('THREAD %s - Loading JSON data: %s' % (vm_name, adv_parameters))
-        adv_parameters_dict = json.loads(adv_parameters)
-        vm_option_values = []
-        for key, value in adv_parameters_dict.items():
-            logger.debug('THREAD %s - Creating option value for key %s and value %s' % (vm_name, key, value))
-            vm_option_values.append(vim.option.OptionValue(key=key, value=value))
-        logger.debug('THREAD %s - Creating of config spec for VM' % vm_name)
-        config_spec = vim.vm.ConfigSpec(extraConfig=vm_option_values)
-        logger.info('THREAD %s - Applying advanced parameters. This might take a couple of seconds' % vm_name)
-        config_task = vm.ReconfigVM_Task(spec=config_spec)
-        logger.debug('THREAD %s - Waiting for the advanced paramerter to be applied' % vm_name)
-        run_loop = True
-        while run_loop:
-            info = config_task.info
-            if info.state == vim.TaskInfo.State.success:
-                logger.debug('THREAD %s - Advanced parameters applied' % vm_name)
-                run_loop = False
-                break
-            elif info.state == vim.TaskInfo.State.error:
-                if info.error.fault:
-                    logger.info('THREAD %s - Applying advanced parameters has quit with error: %s' % (vm_name, info.error.fault.faultMessage))
-                else:
-                    logger.info('THREAD %s - Applying advanced parameters has quit with cancelation' % vm_name)
-                run_loop = False
-                break
-            sleep(2)
-
-    if vm and power_on:
-        logger.info('THREAD %s - Powering on VM. This might take a couple of seconds' % vm_name)
-        power_on_task = vm.PowerOn()
-        logger.debug('THREAD %s - Waiting fo VM to power on' % vm_name)
-        run_loop = True
-        while run_loop:
-            info = power_on_task.info
-            if info.state == vim.TaskInfo.State.success:
-                run_loop = False
-                break
-            elif info.state == vim.TaskInfo.State.error:
-                if info.error.fault:
-                    logger.info('THREAD %s - Power on has quit with error: %s' % (vm_name, info.error.fault.faultMessage))
-                else:
-                    logger.info('THREAD %s - Power on has quit with cancelation' % vm_name)
-                run_loop = False
-                break
-            sleep(2)
-
-    if vm and power_on and (post_script or print_ips or print_macs):
-        logger.debug('THREAD %s - Creating mac, ip and post-script processing thread' % vm_name)
-        mac_ip_pool_results.append(mac_ip_pool.apply_async(vm_mac_ip_handler, (logger, vm, ipv6, maxwait, post_script, power_on, print_ips, print_macs, custom_mac)))
+            logger.info('Applying MAC address change. This might take a couple of seconds')
+            logger.debug('Waiting fo MAC address change to complete')
+            run_task(logger, retry, functools.partial(vm.ReconfigVM_Task, spec=config_spec), vm_name, 'MAC address change', [datastore])
+
+    if vm and not instant and adv_parameters is not None and adv_parameters is not '':
+        logger.info('Setting advanced parameters')
+        logger.debug('Creating of config spec for VM')
+        config_spec = vim.vm.ConfigSpec(extraConfig=get_option_values(logger, adv_parameters))
+        logger.info('Applying advanced parameters. This might take a couple of seconds')
+        logger.debug('Waiting for the advanced paramerter to be applied')
+        run_task(logger, retry, functools.partial(vm.ReconfigVM_Task, spec=config_spec), vm_name, 'Applying advanced parameters', [datastore])
+
+    if vm and instant:
+        logger.debug('Instant clones are running from the start, no power on needed')
+    elif vm and power_on and power_on_batches is not None:
+        logger.info('Adding VM to the power on batch of its datacenter')
+        if datacenter is None:
+            datacenter = find_datacenter(vm)
+        power_on_batched(logger, power_on_batches, datacenter, vm, vm_name)
+    elif vm and power_on:
+        logger.info('Powering on VM. This might take a couple of seconds')
+        logger.debug('Waiting fo VM to power on')
+        run_task(logger, retry, vm.PowerOn, vm_name, 'Power on', [datastore, vm.runtime.host if retry is not None else None])
+
+    if vm and (power_on or instant) and (post_script or print_ips or print_macs):
+        logger.debug('Creating mac, ip and post-script processing thread')
+        mac_ip_pool_results.append(mac_ip_pool.apply_async(vm_mac_ip_handler, (logger, vm, vm_name, ipv6, maxwait, post_script, power_on, print_ips, print_macs, custom_mac)))
     elif vm and (post_script or print_ips or print_macs):
-        logger.error('THREAD %s - Power on is disabled, printing of IP and Mac is not possible' % vm_name)
+        logger.error('Power on is disabled, printing of IP and Mac is not possible')
 
     return vm
 
 
-def vm_mac_ip_handler(logger, vm, ipv6, maxwait, post_script, power_on, print_ips, print_macs, custom_mac):
+def vm_mac_ip_handler(logger, vm, vm_name, ipv6, maxwait, post_script, power_on, print_ips, print_macs, custom_mac):
     """
     Gather mac, ip and run post-script for a cloned virtual machine
     """
 
     mac_ip = None
     if print_macs or print_ips:
-        logger.info('THREAD %s - Gathering mac and ip' % vm.config.name)
-        mac_ip = find_mac_ip(logger, vm, maxwait, ipv6, True)
+        logger.info('Gathering mac and ip')
+        mac_ip = find_mac_ip(logger, vm, maxwait, ipv6)
         if mac_ip and print_macs and print_ips:
-            logger.info('THREAD %s - Printing mac and ip information: %s %s %s' % (vm.config.name, vm.config.name, mac_ip[0], mac_ip[1]))
-            print('%s %s %s' % (vm.config.name, mac_ip[0], mac_ip[1]))
+            logger.info('Printing mac and ip information: %s %s %s', vm_name, mac_ip[0], mac_ip[1])
+            print('%s %s %s' % (vm_name, mac_ip[0], mac_ip[1]))
         elif mac_ip and print_macs:
-            logger.info('THREAD %s - Printing mac information: %s %s' % (vm.config.name, vm.config.name, mac_ip[0]))
-            print('%s %s' % (vm.config.name, mac_ip[0]))
+            logger.info('Printing mac information: %s %s', vm_name, mac_ip[0])
+            print('%s %s' % (vm_name, mac_ip[0]))
         elif mac_ip and print_ips:
-            logger.info('THREAD %s - Printing ip information: %s %s' % (vm.config.name, vm.config.name, mac_ip[1]))
-            print('%s %s' % (vm.config.name, mac_ip[1]))
+            logger.info('Printing ip information: %s %s', vm_name, mac_ip[1])
+            print('%s %s' % (vm_name, mac_ip[1]))
         elif print_macs or print_ips:
-            logger.error('THREAD %s - Unable to find mac or ip information within %s seconds' % (vm.config.name, maxwait))
+            logger.error('Unable to find mac or ip information within %s seconds', maxwait)
 
     if post_script:
-        retcode = run_post_script(logger, post_script, vm, mac_ip, custom_mac)
+        retcode = run_post_script(logger, post_script, vm_name, mac_ip, custom_mac)
         if retcode > 0:
-            logger.warning('THREAD %s - Post processing failed.' % vm.config.name)
+            logger.warning('Post processing failed.')
 
 
 def main():
@@ -481,11 +1935,20 @@ def main():
     basename = None
     if args.basename:
         basename = args.basename[0]
+    batch_power_on = args.batch_power_on
+    batch_window = args.batch_window[0]
+    breaker_cooldown = args.breaker_cooldown[0]
+    breaker_threshold = args.breaker_threshold[0]
+    cancel_queued = args.cancel_queued
+    compress = args.compress
     count = args.count[0]
     csvfile = None
     if args.csvfile:
         csvfile = args.csvfile[0]
     debug = args.debug
+    drain_timeout = None
+    if args.drain_timeout:
+        drain_timeout = args.drain_timeout[0]
     cluster_name = None
     if args.cluster:
         cluster_name = args.cluster[0]
@@ -499,11 +1962,23 @@ def main():
     if args.folder:
         folder_name = args.folder[0]
     host = args.host[0]
+    instant = args.instant
+    journal_file = None
+    if args.journal:
+        journal_file = args.journal[0]
+    lease_ttl = args.lease_ttl[0]
+    listen = None
+    if args.listen:
+        listen = args.listen[0]
     print_ips = args.ips
     print_macs = args.macs
     log_file = None
     if args.logfile:
         log_file = args.logfile[0]
+    order = args.order[0]
+    page_size = None
+    if args.page_size:
+        page_size = args.page_size[0]
     port = args.port[0]
     post_script = None
     if args.post_script:
@@ -511,16 +1986,37 @@ def main():
     password = None
     if args.password:
         password = args.password[0]
+    placement_targets = args.placement
+    placement_hosts = args.placement_hosts
+    placement_strategy = args.placement_strategy[0]
     power_on = not args.nopoweron
+    processes = args.processes[0]
     resource_pool_name = None
     if args.resource_pool:
         resource_pool_name = args.resource_pool[0]
+    replicas = args.replicas
+    replica_cache = None
+    if args.replica_cache:
+        replica_cache = args.replica_cache[0]
+    results_file = None
+    if args.results_file:
+        results_file = args.results_file[0]
+    retries = args.retries[0]
+    retry_budget = args.retry_budget[0]
+    retry_delay = args.retry_delay[0]
     nosslcheck = args.nosslcheck
-    template = args.template[0]
+    teardown = args.teardown
+    template = None
+    if args.template:
+        template = args.template[0]
     threads = args.threads[0]
+    transfer_stats = args.transfer_stats
     username = args.username[0]
     verbose = args.verbose
     maxwait = args.maxwait[0]
+    worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+    if args.worker_id:
+        worker_id = args.worker_id[0]
     linked = args.linked
     snapshot = None
     if args.snapshot:
@@ -540,48 +2036,105 @@ def main():
         logging.basicConfig(filename=log_file, format='%(asctime)s %(levelname)s %(message)s', level=log_level)
     logger = logging.getLogger(__name__)
 
+    if not teardown and not listen and template is None:
+        logger.error('A template has to be provided, unless removing VMs or running as a service')
+        return 1
+    if teardown and basename is None and csvfile is None:
+        logger.error('A basename or CSV has to be provided to remove VMs')
+        return 1
+    if journal_file and fcntl is None:
+        logger.error('A journal requires file locking, which is not available on this platform')
+        return 1
+
+    if processes > 1 and (teardown or journal_file or placement_targets or replicas):
+        logger.error('Multiple processes can not be combined with teardown, a journal, placement or template replicas')
+        return 1
+    if listen and (teardown or journal_file or placement_targets or replicas or processes > 1):
+        logger.error('The service can not be combined with teardown, a journal, placement, template replicas or multiple processes')
+        return 1
+    if listen and not hasattr(socket, 'AF_UNIX'):
+        logger.error('The service requires Unix sockets, which are not available on this platform')
+        return 1
+    if page_size is not None and page_size < 1:
+        logger.error('The page size has to be at least 1')
+        return 1
+
+    # Transport settings
+    transport['compress'] = compress
+    transport['page_size'] = page_size
+    transport['stats'] = transfer_stats
+
     # Getting user password
     if password is None:
         logger.debug('No command line password received, requesting password from user')
         password = getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (host, username))
 
+    logger.debug('Loading the vSphere modules')
+    import_vsphere_modules()
+
+    # Stopping the run on SIGINT and SIGTERM, the service keeps the default handling
+    if not teardown and not listen:
+        start_drain_handling(drain_timeout, cancel_queued)
+
+    if processes > 1:
+        vm_rows = get_vm_rows(logger, basename, count, amount, csvfile, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, post_script)
+        if vm_rows is None:
+            return 1
+        vm_rows = order_vm_rows(logger, vm_rows, order, instant)
+        settings = {'host': host, 'port': port, 'username': username, 'password': password, 'nosslcheck': nosslcheck, 'log_file': log_file, 'log_level': log_level, 'template': template, 'linked': linked, 'snapshot': snapshot, 'instant': instant, 'ipv6': ipv6, 'maxwait': maxwait, 'power_on': power_on, 'print_ips': print_ips, 'print_macs': print_macs, 'threads': threads, 'batch_power_on': batch_power_on, 'batch_window': batch_window, 'retries': retries, 'retry_delay': retry_delay, 'retry_budget': retry_budget, 'breaker_threshold': breaker_threshold, 'breaker_cooldown': breaker_cooldown, 'compress': compress, 'page_size': page_size, 'transfer_stats': transfer_stats}
+        return run_processes(logger, settings, vm_rows, processes, results_file)
+
+    # The threads hand their log records to a queue, which is written by a single thread. Worker processes each start their own.
+    log_listener = start_log_queue()
+    atexit.register(stop_log_queue, log_listener)
+
     try:
         si = None
         try:
-            logger.info('Connecting to server %s:%s with username %s' % (host, port, username))
-            if nosslcheck:
-                si = SmartConnectNoSSL(host=host, user=username, pwd=password, port=int(port))
-            else:
-                si = SmartConnect(host=host, user=username, pwd=password, port=int(port))
+            logger.info('Connecting to server %s:%s with username %s', host, port, username)
+            si = vsphere_helpers.smart_connect(host, username, password, int(port), nosslcheck, **get_connect_args())
         except IOError as e:
             pass
 
         if not si:
-            logger.error('Could not connect to host %s with user %s and specified password' % (host, username))
+            logger.error('Could not connect to host %s with user %s and specified password', host, username)
             return 1
 
         logger.debug('Registering disconnect at exit')
         atexit.register(Disconnect, si)
+        if transport['stats']:
+            count_transfer(si)
+            atexit.register(print_transfer_stats, 'Transfer statistics')
+
+        if listen:
+            # Jobs use the live inventory instead of searching vCenter, and share the power on batches
+            service = {
+                'settings': {'template': template, 'linked': linked, 'snapshot': snapshot, 'instant': instant, 'power_on': power_on, 'ipv6': ipv6, 'maxwait': maxwait, 'datacenter': datacenter_name, 'cluster': cluster_name, 'resource_pool': resource_pool_name, 'folder': folder_name, 'datastore': datastore_name, 'post_script': post_script},
+                'inventory': start_inventory_watch(si, logger),
+                'slots': threading.BoundedSemaphore(threads),
+                'mac_ip_pool': ThreadPool(threads),
+                'power_on_batches': None,
+                'retry': get_retry_settings(retries, retry_delay, retry_budget, breaker_threshold, breaker_cooldown),
+                'lock': threading.Lock(),
+                'jobs': 0
+            }
+            if batch_power_on:
+                service['power_on_batches'] = {'lock': threading.Lock(), 'window': batch_window, 'datacenters': {}}
+            return run_service(si, logger, service, listen)
+
+        if teardown:
+            vm_rows = get_vm_rows(logger, basename, count, amount, csvfile, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, post_script)
+            if vm_rows is None:
+                return 1
+            vm_names = [row[0] for row in vm_rows]
+            if teardown_vms(si, logger, vm_names, threads):
+                return 1
+            logger.info('Finished all tasks')
+            return 0
 
-        # Find the correct VM
-        logger.debug('Finding template %s' % template)
-        template_vm = find_obj(si, logger, template, [vim.VirtualMachine], False)
+        template_vm, template_snapshot = find_template(si, logger, template, linked, snapshot, instant, replicas)
         if template_vm is None:
-            logger.error('Unable to find template %s' % template)
-            return 1
-        logger.info('Template %s found' % template)
-
-        # Finding the snapshot if linked
-        template_snapshot = None
-        if linked and not snapshot:
-            logger.error('When linked cloning is enabled, a snapshot has to be provided.')
             return 1
-        elif linked:
-            template_snapshot = get_snapshots_by_name_recursively(snapshots=template_vm.snapshot.rootSnapshotList, snapname=snapshot)
-            if len(template_snapshot) != 1:
-                logger.error('Snapshot %s not found.' % snapshot)
-                return 1
-            logger.info('Snapshot %s found.' % snapshot)
 
         # Pool handling
         logger.debug('Setting up pools and threads')
@@ -589,103 +2142,103 @@ def main():
         mac_ip_pool = ThreadPool(threads)
         mac_ip_pool_results = []
         vm_specs = []
-        logger.debug('Pools created with %s threads' % threads)
-
-        if csvfile is None:
-            # Generate VM names
-            logger.debug('No CSV found working with amount and basename')
-            logger.debug('Creating thread specifications')
-            vm_names = []
-            for a in range(1, amount + 1):
-                vm_names.append('%s-%i' % (basename, count))
-                count += 1
-
-            vm_names.sort()
-            for vm_name in vm_names:
-                vm_specs.append((si, logger, linked, vm_name, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, None, ipv6, maxwait, post_script, power_on, print_ips, print_macs, template, template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, None))
-        else:
-            # CSV fields:
-            # VM Name, Resource Pool, Folder, MAC Address, Post Script
-            logger.debug('Parsing csv %s' % csvfile)
-
-            if not os.path.isfile(csvfile):
-                logger.critical('CSV file %s does not exist, exiting' % csvfile)
+        logger.debug('Pools created with %s threads', threads)
+
+        # Power on batches per datacenter
+        power_on_batches = None
+        if batch_power_on:
+            logger.debug('Powering on VMs in batches collected over %s seconds', batch_window)
+            power_on_batches = {'lock': threading.Lock(), 'window': batch_window, 'datacenters': {}}
+
+        # Retry budgets and circuit breakers shared by all tasks
+        retry = get_retry_settings(retries, retry_delay, retry_budget, breaker_threshold, breaker_cooldown)
+
+        # Journal shared with the other workers
+        journal = None
+        if journal_file:
+            journal = {'file': journal_file, 'worker': worker_id, 'ttl': lease_ttl, 'lock': threading.Lock(), 'offset': 0, 'leases': {}, 'active': set()}
+
+        # Template replicas per datastore, filled in once the target datastores are known
+        datastore_replicas = {}
+
+        # Placement snapshot of the datastores and hosts. Full clones take the committed space of the template, other clones mainly their swap file.
+        placement = None
+        if placement_targets:
+            clone_memory = template_vm.summary.config.memorySizeMB * 1024 * 1024
+            if linked or instant:
+                clone_size = clone_provisioned = clone_memory
+            else:
+                clone_size = template_vm.summary.storage.committed
+                clone_provisioned = clone_size + template_vm.summary.storage.uncommitted
+            placement = get_placement(si, logger, placement_targets, placement_strategy, clone_size, clone_provisioned, clone_memory, placement_hosts)
+            if not placement['datastores']:
+                logger.error('No datastores found to place the clones on')
                 return 1
 
-            with open(csvfile, 'rb') as tasklist:
-                taskreader = csv.reader(tasklist, delimiter=';', quotechar='"')
-                for row in taskreader:
-                    logger.debug('Found CSV row: %s' % ','.join(row))
-                    # VM Name
-                    if row[0] is None or row[0] is '':
-                        logger.warning('No VM name specified, skipping this vm creation')
-                        continue
-                    else:
-                        cur_vm_name = row[0]
-                    # Datacenter
-                    if row[1] is None or row[1] is '':
-                        cur_datacenter_name = datacenter_name
-                    else:
-                        cur_datacenter_name = row[1]
-                    # Cluster
-                    if row[2] is None or row[2] is '':
-                        cur_cluster_name = cluster_name
-                    else:
-                        cur_cluster_name = row[2]
-                    # Resource Pool
-                    if row[3] is None or row[3] is '':
-                        cur_resource_pool_name = resource_pool_name
-                    else:
-                        cur_resource_pool_name = row[3]
-                    # Folder
-                    if row[4] is None or row[4] is '':
-                        cur_folder_name = folder_name
-                    else:
-                        cur_folder_name = row[4]
-                    # Datastore
-                    if row[5] is None or row[5] is '':
-                        cur_datastore_name = datastore_name
-                    else:
-                        cur_datastore_name = row[5]
-                    # MAC
-                    if row[6] is None or row[6] is '':
-                        custom_mac = None
-                    else:
-                        custom_mac = row[6]
-                    # Post script
-                    if row[7] is None or row[7] is '':
-                        cur_post_script = post_script
-                    else:
-                        cur_post_script = row[7]
-                    # Advanced parameters
-                    if row[8] is None or row[8] is '':
-                        cur_adv_parameters = None
-                    else:
-                        cur_adv_parameters = row[8]
-
-                    # Creating VM
-                    vm_specs.append((si, logger, linked, cur_vm_name, cur_datacenter_name, cur_cluster_name, cur_resource_pool_name, cur_folder_name, cur_datastore_name, custom_mac, ipv6, maxwait, cur_post_script, power_on, print_ips, print_macs, template, template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, cur_adv_parameters))
-
-        logger.debug('Running virtual machine clone pool')
-        pool.map(vm_clone_handler_wrapper, vm_specs)
+        vm_rows = get_vm_rows(logger, basename, count, amount, csvfile, datacenter_name, cluster_name, resource_pool_name, folder_name, datastore_name, post_script)
+        if vm_rows is None:
+            return 1
+        vm_rows = order_vm_rows(logger, vm_rows, order, instant)
+        logger.debug('Creating thread specifications')
+        for row in vm_rows:
+            vm_specs.append((si, logger, linked, row[0], row[1], row[2], row[3], row[4], row[5], row[6], ipv6, maxwait, row[7], power_on, print_ips, print_macs, template, template_vm, template_snapshot, mac_ip_pool, mac_ip_pool_results, row[8], power_on_batches, instant, datastore_replicas, placement, None, retry))
+
+        if replicas:
+            logger.debug('Seeding template replicas on the target datastores')
+            replica_datastore_names = [vm_spec[8] for vm_spec in vm_specs if vm_spec[8]]
+            if placement is not None:
+                replica_datastore_names += [datastore['name'] for datastore in placement['datastores']]
+            datastore_replicas.update(seed_replicas(si, logger, template, template_vm, replica_datastore_names, snapshot if linked else None, threads, replica_cache))
+
+        if journal is not None:
+            # Rows leased by other workers are retried until they are finished or their lease expires
+            logger.debug('Running virtual machine clone pool as worker %s', journal['worker'])
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=journal_heartbeat, args=(logger, journal, heartbeat_stop))
+            heartbeat.daemon = True
+            heartbeat.start()
+            pending_specs = vm_specs
+            while pending_specs and not is_stop_requested():
+                statuses = pool.map_async(sharded_vm_clone_handler_wrapper, [(journal, vm_spec) for vm_spec in pending_specs], 1)
+                wait_for_pool_results(logger, [statuses])
+                pending_specs = [vm_spec for vm_spec, status in zip(pending_specs, statuses.get()) if status == 'leased']
+                if pending_specs and not is_stop_requested():
+                    logger.info('%s VMs are leased by other workers, waiting for them to finish or for their leases to expire', len(pending_specs))
+                    sleep(journal['ttl'] / 3.0)
+            heartbeat_stop.set()
+        else:
+            logger.debug('Running virtual machine clone pool')
+            vms = pool.map_async(vm_clone_handler_wrapper, vm_specs, 1)
+            wait_for_pool_results(logger, [vms])
+            vms = vms.get()
 
         logger.debug('Closing virtual machine clone pool')
         pool.close()
         pool.join()
 
         logger.debug('Waiting for all mac, ip and post-script processes')
-        for running_task in mac_ip_pool_results:
-            running_task.wait()
+        wait_for_pool_results(logger, mac_ip_pool_results)
 
         logger.debug('Closing mac, ip and post-script processes')
         mac_ip_pool.close()
         mac_ip_pool.join()
 
+        if results_file and journal is not None:
+            # The done records of all workers are merged into the results
+            update_journal(logger, journal)
+            write_results_file(logger, results_file, [journal['leases'][vm_spec[3]]['row'] for vm_spec in vm_specs if journal['leases'].get(vm_spec[3], {}).get('state') == 'done'])
+        elif results_file:
+            write_results_file(logger, results_file, [get_results_row(vm_spec) for vm_spec, vm in zip(vm_specs, vms) if isinstance(vm, vim.VirtualMachine)])
+
+        if is_stop_requested():
+            logger.warning('The run was stopped before all VMs were cloned')
+            return 1
+
     except vmodl.MethodFault as e:
-        logger.critical('Caught vmodl fault: %s' % e.msg)
+        logger.critical('Caught vmodl fault: %s', e.msg)
         return 1
     except Exception as e:
-        logger.critical('Caught exception: %s' % str(e))
+        logger.critical('Caught exception: %s', str(e))
         return 1
 
     logger.info('Finished all tasks')
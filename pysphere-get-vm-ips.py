@@ -1,40 +1,47 @@
 #!/usr/bin/python
-import sys, re, getpass, argparse, subprocess
-from time import sleep
-from pysphere import MORTypes, VIServer, VITask, VIProperty, VIMor, VIException
-from pysphere.vi_virtual_machine import VIVirtualMachine
+from __future__ import print_function
+import sys, re, getpass, argparse, atexit, logging
+from vsphere_helpers import smart_connect, get_properties, find_obj
 
 def print_verbose(message):
     if verbose:
-        print message
+        print(message)
 
-def find_vm(name):
-    try:
-        vm = con.get_vm_by_name(name)
-        return vm
-    except VIException:
-        return None
+def classify_ips(ip_addresses,ipv6=False):
+    ips = []
+    for ip in ip_addresses:
+        if ipv6 and re.match('\d{1,4}\:.*',ip) and not re.match('fe83\:.*',ip):
+            print_verbose('IPv6 address found: %s' % ip)
+            ips.append(ip)
+        elif not ipv6 and re.match('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}',ip) and ip != '127.0.0.1':
+            print_verbose('IPv4 address found: %s' % ip)
+            ips.append(ip)
+    if ips:
+        return ';'.join(ips)
+    return None
 
 def find_ip(vm,ipv6=False):
-    ips = None
-    net_info = vm.get_property('net',False)
+    net_info = vm.guest.net
     if net_info:
-        for ip in net_info[0]['ip_addresses']:
-            if ipv6 and re.match('\d{1,4}\:.*',ip) and not re.match('fe83\:.*',ip):
-                print_verbose('IPv6 address found: %s' % ip)
-                ips = str(ips) + ';' + ip
-                #return ip
-            elif not ipv6 and re.match('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}',ip) and ip != '127.0.0.1':
-                print_verbose('IPv4 address found: %s' % ip)
-                ips = str(ips) + ';' + ip
-                #return ip
-    return ips
+        return classify_ips(net_info[0].ipAddress,ipv6)
+    return None
+
+def get_all_vms_net():
+    # Name, power state and guest network information of all VMs, retrieved with paged property collector calls
+    print_verbose('Retrieving name, power state and guest network information of all VMs')
+    for mor, properties in get_properties(si, logger, vim.VirtualMachine, ['name','runtime.powerState','guest.net']):
+        ip_addresses = []
+        if properties.get('guest.net'):
+            ip_addresses = properties['guest.net'][0].ipAddress or []
+        yield properties.get('name'), properties.get('runtime.powerState'), ip_addresses
 
 parser = argparse.ArgumentParser(description="Deploy a template into multiple VM's")
 parser.add_argument('-6', '--six', required=False, help='Get IPv6 address for VMs instead of IPv4', dest='ipv6', action='store_true')
 parser.add_argument('-a', '--all', required=False, help='Get address for all powered on VMs', dest='allvms', action='store_true')
 parser.add_argument('-n', '--name', nargs=1, required=False, help='VM Name', dest='vmname', type=str)
+parser.add_argument('-o', '--port', nargs=1, required=False, help='The port to connect to on the server (default=443)', dest='port', type=int, default=[443])
 parser.add_argument('-s', '--server', nargs=1, required=True, help='The vCenter or ESXi server to connect to', dest='server', type=str)
+parser.add_argument('-S', '--disable-SSL-certificate-verification', required=False, help='Disable SSL certificate verification on connect', dest='nosslcheck', action='store_true')
 parser.add_argument('-u', '--user', nargs=1, required=True, help='The username with which to connect to the server', dest='username', type=str)
 parser.add_argument('-v', '--verbose', required=False, help='Enable verbose output', dest='verbose', action='store_true')
 
@@ -45,44 +52,55 @@ allvms      = args.allvms
 vmname      = None
 if args.vmname:
     vmname      = args.vmname[0]
+nosslcheck  = args.nosslcheck
+port        = args.port[0]
 server      = args.server[0]
 username    = args.username[0]
 verbose     = args.verbose
 
+# The lookup primitives log their details in verbose mode
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG if verbose else logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# pyVmomi is only loaded now, so the help and argument errors are quick
+from pyVim.connect import Disconnect
+from pyVmomi import vim
+
 # Asking Users password for server
 password=getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (server,username))
 
 # Connecting to server
-print_verbose('Connecting to server %s with username %s' % (server,username))
-con = VIServer()
-con.connect(server,username,password)
+print_verbose('Connecting to server %s:%s with username %s' % (server,port,username))
+try:
+    si = smart_connect(server, username, password, port, nosslcheck)
+except (IOError, vim.fault.InvalidLogin) as e:
+    print('ERROR: Could not connect to server %s: %s' % (server,e))
+    sys.exit(1)
+atexit.register(Disconnect, si)
 print_verbose('Connected to server %s' % server)
-print_verbose('Server type: %s' % con.get_server_type())
-print_verbose('API version: %s' % con.get_api_version())
+print_verbose('Server type: %s' % si.content.about.fullName)
+print_verbose('API version: %s' % si.content.about.apiVersion)
 
 if allvms:
-    vms = con.get_registered_vms(None, None, None, 'poweredOn', None)
-    for vmpath in vms:
+    for vmname, power_state, ip_addresses in get_all_vms_net():
+        if power_state != 'poweredOn':
+            continue
         print_verbose('================================================================================')
-        vm = con.get_vm_by_path(vmpath)
-        vmname = vm.get_property('name')
-        ip = find_ip(vm,ipv6)
+        ip = classify_ips(ip_addresses,ipv6)
         if ip:
-            print '%s : %s' % (vmname,ip)
+            print('%s : %s' % (vmname,ip))
         else:
-            print 'ERROR: IP for VM %s not found' % vmname
+            print('ERROR: IP for VM %s not found' % vmname)
+        sys.stdout.flush()
 else:
     print_verbose('================================================================================')
     print_verbose('Trying to find IP for VM %s' % vmname)
-    vm = find_vm(vmname)
+    vm = find_obj(si, logger, vmname, vim.VirtualMachine)
     if vm:
         ip = find_ip(vm,ipv6)
         if ip:
-            print '%s : %s' % (vmname,ip)
+            print('%s : %s' % (vmname,ip))
         else:
-            print 'ERROR: IP for VM %s not found' % vmname
+            print('ERROR: IP for VM %s not found' % vmname)
     else:
-        print 'ERROR: %s not found' % vmname
-
-# Disconnecting from server
-con.disconnect()
+        print('ERROR: %s not found' % vmname)
@@ -1,77 +1,120 @@
 #!/usr/bin/python
-import sys, re, getpass, argparse, subprocess
-from time import sleep
-from pysphere import MORTypes, VIServer, VITask, VIProperty, VIMor, VIException
-from pysphere.vi_virtual_machine import VIVirtualMachine
+from __future__ import print_function
+import sys, re, getpass, argparse, subprocess, atexit, logging
+from time import sleep, time
+from multiprocessing.dummy import Pool as ThreadPool
+from vsphere_helpers import smart_connect, get_properties, find_obj, get_vm_logger
 
 def print_verbose(message):
     if verbose:
-        print message
-
-def find_vm(name):
-    try:
-        vm = con.get_vm_by_name(name)
-        return vm
-    except VIException:
-        return None
+        print(message)
+
+def wait_for_task(logger, task, description):
+    """
+    Waits for a task to finish and returns its info, the state of the info is either success or error
+    """
+
+    while True:
+        info = task.info
+        logger.debug('Checking %s task', description)
+        if info.state == vim.TaskInfo.State.success:
+            logger.debug('%s task finished', description)
+            return info
+        elif info.state == vim.TaskInfo.State.running:
+            logger.debug('%s task is at %s percent', description, info.progress)
+        elif info.state == vim.TaskInfo.State.queued:
+            logger.debug('%s task is queued', description)
+        elif info.state == vim.TaskInfo.State.error:
+            if isinstance(info.error, vmodl.fault.RequestCanceled):
+                logger.info('%s task has quit with cancelation', description)
+            else:
+                logger.info('%s task has quit with error: %s', description, info.error.msg)
+            return info
+        logger.debug('Sleeping 2 seconds for new check')
+        sleep(2)
 
 def find_resource_pool(name):
-    rps = con.get_resource_pools()
-    for mor, path in rps.iteritems():
+    # The path of each resource pool, like /Resources/Development, is built from the names and parents of all pools
+    pools = dict((mor._moId, (mor, properties)) for mor, properties in get_properties(si, logger, vim.ResourcePool, ['name','parent']))
+    for mor, properties in pools.values():
+        path = ''
+        parent = mor
+        while parent is not None and parent._moId in pools:
+            path = '/%s%s' % (pools[parent._moId][1].get('name'),path)
+            parent = pools[parent._moId][1].get('parent')
         print_verbose('Parsing RP %s' % path)
         if re.match('.*%s' % name,path):
             return mor
     return None
 
-def find_folder(name):
-    folders = con._get_managed_objects(MORTypes.Folder)
-    try:
-        for mor, folder_name in folders.iteritems():
-            print_verbose('Parsing folder %s' % folder_name)
-            if folder_name == name:
-                return mor
-    except IndexError:
-        return None
-    return None
+def find_existing_vm_names():
+    # Names of all VMs, retrieved with paged property collector calls
+    return set(properties.get('name') for mor, properties in get_properties(si, logger, vim.VirtualMachine, ['name']))
 
 def run_post_script(name,ip):
     print_verbose('Running post script: %s %s %s' % (post_script,name,ip))
     retcode = subprocess.call([post_script,name,ip])
     if retcode < 0:
-        print 'ERROR: %s %s %s : Returned a non-zero result' % (post_script,name,ip)
-        sys.exit(1)
+        print('ERROR: %s %s %s : Returned a non-zero result' % (post_script,name,ip))
+    return retcode
 
 def find_ip(vm,ipv6=False):
-    net_info = vm.get_property('net',False)
-    waitcount = 0
-    while net_info is None:
-        if waitcount > maxwait:
-            break
-        net_info = vm.get_property('net',False)
-        print_verbose('Waiting 5 seconds ...')
-        waitcount += 5
-        sleep(5)
+    net_info = vm.guest.net
     if net_info:
-        for ip in net_info[0]['ip_addresses']:
+        for ip in net_info[0].ipAddress:
             if ipv6 and re.match('\d{1,4}\:.*',ip) and not re.match('fe83\:.*',ip):
                 print_verbose('IPv6 address found: %s' % ip)
                 return ip
             elif not ipv6 and re.match('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}',ip) and ip != '127.0.0.1':
                 print_verbose('IPv4 address found: %s' % ip)
                 return ip
-    print_verbose('Timeout expired: No IP address found')
     return None
 
+def post_script_handler(vm_name,vm):
+    # Waits for the IP of a powered on VM and runs the post script with it
+    started = time()
+    while time() - started <= maxwait:
+        ip = find_ip(vm,ipv6)
+        if ip:
+            return run_post_script(vm_name,ip)
+        sleep(2)
+    print('ERROR: No IP found for VM %s, post processing disabled' % vm_name)
+    return 0
+
+def clone_handler(vm_name):
+    # Clones and powers on a VM, the post script is handed to its own pool so it overlaps with the next clones
+    vm_logger = get_vm_logger(logger, vm_name)
+    vm_logger.debug('Trying to clone %s', template)
+    task = template_vm.Clone(name=vm_name, folder=folder_mor, spec=clone_spec)
+    info = wait_for_task(vm_logger, task, 'Cloning')
+    if info.state != vim.TaskInfo.State.success:
+        vm_logger.error('Cloning failed: %s', info.error.msg)
+        return
+    vm_logger.debug('VM created')
+    clone = info.result
+
+    vm_logger.debug('Booting VM')
+    info = wait_for_task(vm_logger, clone.PowerOnVM_Task(), 'Power on')
+    if info.state != vim.TaskInfo.State.success:
+        vm_logger.error('Booting failed: %s', info.error.msg)
+        return
+    vm_logger.debug('VM booted')
+    if post_script:
+        post_script_results.append(post_script_pool.apply_async(post_script_handler, (vm_name,clone)))
+
 parser = argparse.ArgumentParser(description="Deploy a template into multiple VM's")
 parser.add_argument('-6', '--six', required=False, help='Get IPv6 address for VMs instead of IPv4', dest='ipv6', action='store_true')
 parser.add_argument('-b', '--basename', nargs=1, required=True, help='Basename of the newly deployed VMs', dest='basename', type=str)
 parser.add_argument('-c', '--count', nargs=1, required=False, help='Starting count, the name of the first VM deployed will be <basename>-<count>, the second will be <basename>-<count+1> (default=1)', dest='count', type=int, default=[1])
 parser.add_argument('-f', '--folder', nargs=1, required=False, help='The folder in which the new VMs should reside', dest='folder', type=str)
 parser.add_argument('-n', '--number', nargs=1, required=False, help='Amount of VMs to deploy (default=1)', dest='amount', type=int, default=[1])
+parser.add_argument('-o', '--port', nargs=1, required=False, help='The port to connect to on the server (default=443)', dest='port', type=int, default=[443])
 parser.add_argument('-p', '--post-script', nargs=1, required=False, help='Script to be called after each VM is created and booted. Arguments passed: name ip-address', dest='post_script', type=str)
 parser.add_argument('-r', '--resource-pool', nargs=1, required=False, help='The resource pool in which the new VMs should reside', dest='resource_pool', type=str)
 parser.add_argument('-s', '--server', nargs=1, required=True, help='The vCenter or ESXi server to connect to', dest='server', type=str)
+parser.add_argument('-S', '--disable-SSL-certificate-verification', required=False, help='Disable SSL certificate verification on connect', dest='nosslcheck', action='store_true')
 parser.add_argument('-t', '--template', nargs=1, required=True, help='Template to deploy', dest='template', type=str)
+parser.add_argument('-T', '--threads', nargs=1, required=False, help='Amount of clone tasks to run at once, IP discovery and post scripts run alongside them (default=1)', dest='threads', type=int, default=[1])
 parser.add_argument('-u', '--user', nargs=1, required=True, help='The username with which to connect to the server', dest='username', type=str)
 parser.add_argument('-v', '--verbose', required=False, help='Enable verbose output', dest='verbose', action='store_true')
 parser.add_argument('-w', '--wait-max', nargs=1, required=False, help='Maximum amount of seconds to wait when gathering information (default 120)', dest='maxwait', type=int, default=[120])
@@ -85,34 +128,49 @@ count       = args.count[0]
 folder      = None
 if args.folder:
     folder      = args.folder[0]
+nosslcheck  = args.nosslcheck
+port        = args.port[0]
 post_script     = None
-if args.post_script: 
+if args.post_script:
     post_script = args.post_script[0]
 resource_pool   = None
 if args.resource_pool:
     resource_pool = args.resource_pool[0]
 server      = args.server[0]
 template    = args.template[0]
+threads     = args.threads[0]
 username    = args.username[0]
 verbose     = args.verbose
 maxwait     = args.maxwait[0]
 
+# The lookup primitives and the clone threads log their details in verbose mode
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG if verbose else logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# pyVmomi is only loaded now, so the help and argument errors are quick
+from pyVim.connect import Disconnect
+from pyVmomi import vim, vmodl
+
 # Asking Users password for server
 password=getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (server,username))
 
 # Connecting to server
-print_verbose('Connecting to server %s with username %s' % (server,username))
-con = VIServer()
-con.connect(server,username,password)
+print_verbose('Connecting to server %s:%s with username %s' % (server,port,username))
+try:
+    si = smart_connect(server, username, password, port, nosslcheck)
+except (IOError, vim.fault.InvalidLogin) as e:
+    print('ERROR: Could not connect to server %s: %s' % (server,e))
+    sys.exit(1)
+atexit.register(Disconnect, si)
 print_verbose('Connected to server %s' % server)
-print_verbose('Server type: %s' % con.get_server_type())
-print_verbose('API version: %s' % con.get_api_version())
+print_verbose('Server type: %s' % si.content.about.fullName)
+print_verbose('API version: %s' % si.content.about.apiVersion)
 
 # Verify the template exists
 print_verbose('Finding template %s' % template)
-template_vm = find_vm(template)
+template_vm = find_obj(si, logger, template, vim.VirtualMachine)
 if template_vm is None:
-    print 'ERROR: %s not found' % template
+    print('ERROR: %s not found' % template)
     sys.exit(1)
 print_verbose('Template %s found' % template)
 
@@ -122,52 +180,53 @@ if resource_pool is not None:
     print_verbose('Finding resource pool %s' % resource_pool)
     resource_pool_mor = find_resource_pool(resource_pool)
     if resource_pool_mor is None:
-        print 'ERROR: %s not found' % resource_pool
+        print('ERROR: %s not found' % resource_pool)
         sys.exit(1)
     print_verbose('Resource pool %s found' % resource_pool)
 
-# Verify the target folder exists
-folder_mor = None
+# Verify the target folder exists, by default the VMs are placed in the folder of the template
+folder_mor = template_vm.parent
 if folder is not None:
     print_verbose('Finding folder %s' % folder)
-    folder_mor = find_folder(folder)
+    folder_mor = find_obj(si, logger, folder, vim.Folder)
     if folder_mor is None:
-        print 'ERROR: %s not found' % folder
+        print('ERROR: %s not found' % folder)
         sys.exit(1)
     print_verbose('Folder %s found' % folder)
 
-# List with VM name elements for post script processing
-vms_to_ps = []
-# Looping through amount that needs to be created
+# Clone specification, shared by all clones
+relocate_spec = vim.vm.RelocateSpec()
+if resource_pool_mor is not None:
+    relocate_spec.pool = resource_pool_mor
+clone_spec = vim.vm.CloneSpec(powerOn=False, template=False, location=relocate_spec)
+
+# Names of the VMs to clone, existing VMs are skipped
+existing_vm_names = find_existing_vm_names()
+vms_to_clone = []
 for a in range(1,amount+1):
-    print_verbose('================================================================================')
     vm_name = '%s-%i' % (basename,count)
-    print_verbose('Trying to clone %s to VM %s' % (template,vm_name))
-    if find_vm(vm_name):
-        print 'ERROR: %s already exists' % vm_name
+    if vm_name in existing_vm_names:
+        print('ERROR: %s already exists' % vm_name)
     else:
-        clone = template_vm.clone(vm_name, True, folder_mor, resource_pool_mor, None, None, False)
-        print_verbose('VM %s created' % vm_name)
-        
-        print_verbose('Booting VM %s' % vm_name)
-        clone.power_on()
-        
-        if post_script:
-            vms_to_ps.append(vm_name)
+        vms_to_clone.append(vm_name)
     count += 1
 
-# Looping through post scripting if necessary
-if post_script:
-    for name in vms_to_ps:
-            vm = find_vm(name)
-            if vm:
-                ip = find_ip(vm,ipv6)
-                if ip:
-                    run_post_script(name,ip)
-                else: 
-                    print 'ERROR: No IP found for VM %s, post processing disabled' % name
-            else:
-                print 'ERROR: VM %s not found, post processing disabled' % name
-
-# Disconnecting from server
-con.disconnect()
+# Up to threads clone tasks run at once, each VM is powered on as soon as its clone finishes.
+# Waiting for the IP and the post script run in their own threads, so they overlap with the next clones.
+post_script_pool = ThreadPool(max(threads,1))
+post_script_results = []
+clone_pool = ThreadPool(max(threads,1))
+clone_pool.map(clone_handler, vms_to_clone, 1)
+clone_pool.close()
+clone_pool.join()
+
+# Waiting for the post scripts
+post_script_pool.close()
+post_script_pool.join()
+post_script_failed = False
+for result in post_script_results:
+    if result.get() < 0:
+        post_script_failed = True
+
+if post_script_failed:
+    sys.exit(1)
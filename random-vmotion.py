@@ -6,6 +6,11 @@ This script has the following capabilities:
     * Continue until stopped
     * Print logging to a log file or stdout
     * Do this threaded
+    * Keep statistics of every migration and print a report when stopped
+    * Follow power state, host state and VM removal through a live inventory feed
+    * Reload the VM and host files without restarting
+    * Seed the random schedule, record it and replay it with the same timing
+    * Retry vMotions after transient faults, and stop using hosts which keep failing
 
 --- Usage ---
 Run 'random-vmotion.py -h' for an overview
@@ -16,6 +21,21 @@ Deciding on the optimal amount of threads might need a bit of experimentation. K
 
 --- Files ---
 The files are a list of VMs and Hosts, each in a seperate file and with one entry per line
+Both files are checked for changes every reload interval. When they change, only the new names are looked up in vCenter and the schedule is swapped while the running migrations continue.
+
+--- Record and replay ---
+The random choices can be seeded, so the same VM and host files result in the same sequence of target hosts. The actual schedule can be recorded to a file with one line per vMotion task, containing the time offset at which a thread started it since the start of the run, the VM and the target host: <offset>;<VM>;<Host>
+Such a file can be replayed, in which case the VMs and target hosts are taken from the file and every vMotion task is created at its recorded time offset. This allows a soak test to be repeated like-for-like against another environment or build. The replay needs at least as many threads as the recorded run, or tasks start late.
+
+--- Live inventory ---
+The power state and current host of the VMs and the connection and maintenance state of the hosts are followed through a property collector update feed in a background thread. VMs that are powered off or deleted, and hosts that are disconnected or in maintenance mode, are skipped by the scheduler without any extra calls to vCenter.
+
+--- Retries and circuit breakers ---
+With retries enabled, a vMotion which fails with a transient fault, like a busy or locked resource or a timeout, is started again after a delay which doubles with each attempt. Each type of fault has a retry budget over the whole run, so an overloaded vCenter is not flooded with retries. With a circuit breaker threshold, a host which fails that many vMotions in a row does not receive new vMotions until its cooldown has passed.
+
+--- Statistics ---
+Every migration is recorded with its VM, source host, target host, time spent queued, time spent running and outcome. When the script is interrupted, or when all VMs are migrated with one-run enabled, a report is printed with the throughput, the p50/p95/p99 running duration per host pair and the failure rates. Host pairs are sorted by their p95 duration, so slow vMotion networks end up at the top.
+If a statistics file is provided, each migration is also appended to it as a JSON line. The file is rotated when it reaches the maximum size.
 
 --- Documentation ---
 https://github.com/pdellaert/vSphere-Python/blob/master/docs/random-vmotion.md
@@ -28,19 +48,42 @@ https://raw.github.com/pdellaert/vSphere-Python/master/LICENSE.md
 
 """
 
+from __future__ import print_function
+
 from builtins import str
 import argparse
 import atexit
 import csv
 import getpass
+import json
 import logging
+import logging.handlers
+import math
 import os.path
 import random
+import sys
+import threading
 
-from time import sleep
-from pyVim.connect import SmartConnect, SmartConnectNoSSL, Disconnect
-from pyVmomi import vim, vmodl
+from time import sleep, time
 from multiprocessing.dummy import Pool as ThreadPool
+from vsphere_helpers import smart_connect, get_properties, get_vm_logger
+
+# Loaded by import_vsphere_modules once vCenter has to be contacted, so the help and argument errors start quickly
+Disconnect = None
+vim = None
+vmodl = None
+
+VM_WATCH_PROPERTIES = ['name', 'runtime.powerState', 'runtime.host']
+HOST_WATCH_PROPERTIES = ['name', 'runtime.connectionState', 'runtime.inMaintenanceMode']
+
+# Faults after which a vMotion is retried, as they are usually gone after a while, set by import_vsphere_modules
+TRANSIENT_FAULTS = None
+
+# Faults which count as a failure of the target host for its circuit breaker, set by import_vsphere_modules
+TARGET_FAULTS = None
+
+# Maximum amount of seconds to wait before retrying a vMotion
+RETRY_MAX_DELAY = 300
 
 
 def get_args():
@@ -50,67 +93,594 @@ def get_args():
 
     parser = argparse.ArgumentParser(description="Randomly vMotion each VM from a list one by one to a random host from a list, until stopped.")
     parser.add_argument('-1', '--one-run', required=False, help='Stop after vMotioning each VM once', dest='onerun', action='store_true')
+    parser.add_argument('--breaker-cooldown', nargs=1, required=False, help='Amount of seconds no vMotions are started to a host after its circuit breaker opened (default = 300)', dest='breaker_cooldown', type=int, default=[300])
+    parser.add_argument('--breaker-threshold', nargs=1, required=False, help='Amount of failed vMotions in a row to a host after which its circuit breaker opens, 0 disables the circuit breakers (default = 0)', dest='breaker_threshold', type=int, default=[0])
     parser.add_argument('-d', '--debug', required=False, help='Enable debug output', dest='debug', action='store_true')
     parser.add_argument('-H', '--host', nargs=1, required=True, help='The vCenter or ESXi host to connect to', dest='host', type=str)
     parser.add_argument('-i', '--interval', nargs=1, required=False, help='The amount of time to wait after a vMotion is finished to schedule a new one (default 30 seconds)', dest='interval', type=int, default=[30])
     parser.add_argument('-l', '--log-file', nargs=1, required=False, help='File to log to (default = stdout)', dest='logfile', type=str)
     parser.add_argument('-o', '--port', nargs=1, required=False, help='Server port to connect to (default = 443)', dest='port', type=int, default=[443])
     parser.add_argument('-p', '--password', nargs=1, required=False, help='The password with which to connect to the host. If not specified, the user is prompted at runtime for a password', dest='password', type=str)
+    parser.add_argument('-r', '--reload-interval', nargs=1, required=False, help='The amount of seconds between checks of the VM and target files for changes, 0 disables reloading (default = 10 seconds)', dest='reload_interval', type=int, default=[10])
+    parser.add_argument('--retries', nargs=1, required=False, help='Amount of times a vMotion is retried after a transient fault, like a busy or locked resource (default = 0)', dest='retries', type=int, default=[0])
+    parser.add_argument('--retry-budget', nargs=1, required=False, help='Maximum amount of retries over the whole run for each type of fault, so an overloaded vCenter is not flooded with retries (default = 100)', dest='retry_budget', type=int, default=[100])
+    parser.add_argument('--retry-delay', nargs=1, required=False, help='Amount of seconds to wait before the first retry of a vMotion, doubled with each further retry, with a random part (default = 5)', dest='retry_delay', type=int, default=[5])
+    parser.add_argument('-s', '--stats-file', nargs=1, required=False, help='File to append a JSON line to for each migration (default = no file)', dest='statsfile', type=str)
+    parser.add_argument('--stats-max-size', nargs=1, required=False, help='Size in MB at which the statistics file is rotated, 5 rotated files are kept (default = 10)', dest='stats_max_size', type=int, default=[10])
     parser.add_argument('-S', '--disable-SSL-certificate-verification', required=False, help='Disable SSL certificate verification on connect', dest='nosslcheck', action='store_true')
-    parser.add_argument('-t', '--targets', nargs=1, required=True, help='File with the list of target hosts to vMotion to', dest='targetfile', type=str)
+    parser.add_argument('--record', nargs=1, required=False, help='File to record the schedule of vMotion tasks to, one line with time offset, VM and target host per task', dest='recordfile', type=str)
+    parser.add_argument('--replay', nargs=1, required=False, help='File with a recorded schedule to replay with the same timing, the VMs and target hosts are taken from this file instead of the VM and target files', dest='replayfile', type=str)
+    parser.add_argument('--seed', nargs=1, required=False, help='Seed for the random selection of target hosts (default = unseeded)', dest='seed', type=int)
+    parser.add_argument('-t', '--targets', nargs=1, required=False, help='File with the list of target hosts to vMotion to, required unless a schedule is replayed', dest='targetfile', type=str)
     parser.add_argument('-T', '--threads', nargs=1, required=False, help='Amount of simultanious vMotions to execute at once. (default = 1)', dest='threads', type=int, default=[1])
     parser.add_argument('-u', '--user', nargs=1, required=True, help='The username with which to connect to the host', dest='username', type=str)
     parser.add_argument('-v', '--verbose', required=False, help='Enable verbose output', dest='verbose', action='store_true')
-    parser.add_argument('-V', '--vms', nargs=1, required=True, help='File with the list of VMs to vMotion', dest='vmfile', type=str)
+    parser.add_argument('-V', '--vms', nargs=1, required=False, help='File with the list of VMs to vMotion, required unless a schedule is replayed', dest='vmfile', type=str)
     args = parser.parse_args()
     return args
 
 
-def vm_vmotion_handler(si, logger, vm, host, interval):
+def import_vsphere_modules():
+    """
+    Imports pyVmomi and pyVim, which take most of the startup time of the script, and sets the constants with vSphere faults
+    """
+
+    global Disconnect, vim, vmodl, TRANSIENT_FAULTS, TARGET_FAULTS
+    if vim is not None:
+        return
+    from pyVim.connect import Disconnect
+    from pyVmomi import vim, vmodl
+
+    TRANSIENT_FAULTS = (vim.fault.TaskInProgress, vim.fault.ConcurrentAccess, vim.fault.FileLocked, vim.fault.ResourceInUse, vim.fault.Timedout, vmodl.fault.HostCommunication)
+    TARGET_FAULTS = (vim.fault.Timedout, vmodl.fault.HostCommunication, vim.fault.InsufficientResourcesFault, vim.fault.InvalidHostState, vmodl.fault.HostNotConnected, vmodl.fault.HostNotReachable)
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of a list of values
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(rank, 0)]
+
+
+def task_durations(info, submitted, finished):
+    """
+    Returns the queued and running durations of a task in seconds, falling back to the local clock if vCenter did not provide the timestamps
+    """
+
+    queued = None
+    running = None
+    if info.queueTime and info.startTime:
+        queued = (info.startTime - info.queueTime).total_seconds()
+    if info.startTime and info.completeTime:
+        running = (info.completeTime - info.startTime).total_seconds()
+    if running is None:
+        running = finished - submitted - (queued or 0)
+    return queued or 0.0, running
+
+
+def record_migration(stats, vm_name, source_name, target_name, queued, running, outcome):
+    """
+    Stores a migration in the in-memory statistics and appends it to the statistics file if enabled
+    """
+
+    record = (time(), vm_name, source_name, target_name, queued, running, outcome)
+    with stats['lock']:
+        stats['records'].append(record)
+    if stats['file_logger']:
+        stats['file_logger'].info(json.dumps({
+            'time': record[0],
+            'vm': vm_name,
+            'source': source_name,
+            'target': target_name,
+            'queued': queued,
+            'running': running,
+            'outcome': outcome
+        }, sort_keys=True))
+
+
+def print_stats_report(stats):
+    """
+    Prints the throughput, the duration percentiles per host pair and the failure rates of all recorded migrations
+    """
+
+    with stats['lock']:
+        records = list(stats['records'])
+    elapsed = time() - stats['start']
+
+    # Migrations skipped before their VM had a known source host are only counted in the totals, not in the host pairs
+    totals = {'success': 0, 'failed': 0, 'retried': 0, 'skipped': 0}
+    pairs = {}
+    for record in records:
+        outcome = record[6] if record[6] in ('success', 'retried', 'skipped') else 'failed'
+        totals[outcome] += 1
+        if record[2] is None:
+            continue
+        pair = pairs.setdefault((record[2], record[3]), {'queued': [], 'running': [], 'success': 0, 'failed': 0, 'retried': 0, 'skipped': 0})
+        pair[outcome] += 1
+        if outcome == 'success':
+            pair['queued'].append(record[4])
+            pair['running'].append(record[5])
+
+    succeeded = totals['success']
+    failed = totals['failed']
+    retried = totals['retried']
+    skipped = totals['skipped']
+    attempted = succeeded + failed
+    throughput = 0.0
+    if elapsed > 0:
+        throughput = succeeded * 3600.0 / elapsed
+
+    print('Migration statistics after %.0f seconds' % elapsed)
+    print('Migrations: %s attempted, %s succeeded, %s failed (%.1f%%), %s retried, %s skipped' % (attempted, succeeded, failed, (100.0 * failed / attempted) if attempted else 0.0, retried, skipped))
+    print('Throughput: %.1f successful migrations per hour' % throughput)
+    if not pairs:
+        return
+
+    def format_duration(value):
+        if value is None:
+            return '-'
+        return '%.1f' % value
+
+    rows = []
+    for (source_name, target_name), pair in pairs.items():
+        pair_attempted = pair['success'] + pair['failed']
+        rows.append((
+            percentile(pair['running'], 95) or 0.0,
+            [
+                '%s -> %s' % (source_name, target_name),
+                str(pair_attempted),
+                '%.1f' % ((100.0 * pair['failed'] / pair_attempted) if pair_attempted else 0.0),
+                format_duration(percentile(pair['queued'], 50)),
+                format_duration(percentile(pair['running'], 50)),
+                format_duration(percentile(pair['running'], 95)),
+                format_duration(percentile(pair['running'], 99))
+            ]
+        ))
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    header = ['Source -> Target', 'Count', 'Fail %', 'Queued p50', 'Run p50', 'Run p95', 'Run p99']
+    widths = [max(len(header[i]), max(len(row[1][i]) for row in rows)) for i in range(len(header))]
+    print('  '.join(header[i].ljust(widths[i]) if i == 0 else header[i].rjust(widths[i]) for i in range(len(header))))
+    for row in rows:
+        print('  '.join(row[1][i].ljust(widths[i]) if i == 0 else row[1][i].rjust(widths[i]) for i in range(len(header))))
+
+
+def find_objs_by_name(si, logger, names, vimtype):
+    """
+    Find objects in vSphere by their names with a single paged property retrieval and return a dict of name to object
+    """
+
+    found = {}
+    if not names:
+        return found
+
+    logger.debug('Looking up %s objects by name' % len(names))
+    for obj, properties in get_properties(si, logger, vimtype, ['name']):
+        name = properties.get('name')
+        if name in names and name not in found:
+            logger.debug('Found object %s' % name)
+            found[name] = obj
+    return found
+
+
+def open_csv_file(filename, mode='r'):
+    """
+    Opens a CSV file the way the csv module expects it on both Python 2 and 3
+    """
+
+    if sys.version_info[0] < 3:
+        return open(filename, mode + 'b')
+    return open(filename, mode, newline='')
+
+
+def read_names_file(logger, filename, kind):
+    """
+    Returns the list of names in a VM or host file
+    """
+
+    names = []
+    with open_csv_file(filename) as tasklist:
+        taskreader = csv.reader(tasklist, delimiter=';', quotechar="'")
+        for row in taskreader:
+            logger.debug('Found CSV row: %s' % ','.join(row))
+            if not row or row[0] is None or row[0] == '':
+                logger.warning('No %s name specified, skipping this %s' % (kind, kind.lower()))
+                continue
+            if row[0] not in names:
+                names.append(row[0])
+    return names
+
+
+def load_names_file(si, logger, filename, kind, vimtype, current_objs):
+    """
+    Reads a VM or host file and returns the list of objects in file order and a dict of name to object. Names already in current_objs are reused, only new names are looked up in vCenter.
+    """
+
+    names = read_names_file(logger, filename, kind)
+    new_names = [name for name in names if name not in current_objs]
+    found = find_objs_by_name(si, logger, new_names, vimtype)
+
+    objs = {}
+    for name in names:
+        if name in current_objs:
+            objs[name] = current_objs[name]
+        elif name in found:
+            logger.debug('Found %s %s' % (kind, name))
+            objs[name] = found[name]
+        else:
+            logger.warning('%s %s does not exist, skipping this %s' % (kind, name, kind.lower()))
+    return [objs[name] for name in names if name in objs], objs
+
+
+def get_files_mtime(filenames):
+    """
+    Returns the modification times of a list of files, None for files that do not exist
+    """
+
+    mtimes = []
+    for filename in filenames:
+        try:
+            mtimes.append(os.path.getmtime(filename))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def read_schedule_file(logger, filename):
+    """
+    Returns the list of (time offset, VM name, host name) entries of a recorded schedule, sorted by time offset
+    """
+
+    schedule = []
+    with open_csv_file(filename) as schedule_file:
+        schedule_reader = csv.reader(schedule_file, delimiter=';', quotechar="'")
+        for row in schedule_reader:
+            if len(row) < 3:
+                logger.warning('Invalid schedule row, skipping: %s' % ';'.join(row))
+                continue
+            try:
+                schedule.append((float(row[0]), row[1], row[2]))
+            except ValueError:
+                logger.warning('Invalid time offset in schedule row, skipping: %s' % ';'.join(row))
+    schedule.sort(key=lambda entry: entry[0])
+    return schedule
+
+
+def record_schedule(recorder, offset, vm_name, host_name):
+    """
+    Appends a started vMotion task to the schedule recording if enabled
+    """
+
+    if recorder is None:
+        return
+    with recorder['lock']:
+        recorder['writer'].writerow(['%.3f' % offset, vm_name, host_name])
+        recorder['file'].flush()
+
+
+def add_inventory_filter(logger, inventory, objs):
+    """
+    Adds a property collector filter on the watched properties of a list of VMs and hosts to the live inventory
+    """
+
+    if not objs:
+        return None
+
+    logger.debug('Adding %s objects to the live inventory feed' % len(objs))
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
+    filter_spec.propSet = [
+        vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_WATCH_PROPERTIES),
+        vmodl.query.PropertyCollector.PropertySpec(type=vim.HostSystem, pathSet=HOST_WATCH_PROPERTIES)
+    ]
+    property_filter = inventory['collector'].CreateFilter(filter_spec, partialUpdates=True)
+    inventory['filters'].append((property_filter, objs))
+    return property_filter
+
+
+def remove_inventory_objects(logger, inventory, objs):
+    """
+    Removes a list of VMs and hosts from the live inventory. The property collector filters of the objects are destroyed, the other objects of those filters get a new filter.
+    """
+
+    if not objs:
+        return
+
+    logger.debug('Removing %s objects from the live inventory feed' % len(objs))
+    removed = set(obj._moId for obj in objs)
+    filters = inventory['filters']
+    inventory['filters'] = []
+    remaining = []
+    for property_filter, filter_objs in filters:
+        if not any(obj._moId in removed for obj in filter_objs):
+            inventory['filters'].append((property_filter, filter_objs))
+            continue
+        property_filter.DestroyPropertyFilter()
+        remaining.extend(obj for obj in filter_objs if obj._moId not in removed)
+    add_inventory_filter(logger, inventory, remaining)
+
+    with inventory['lock']:
+        for moid in removed:
+            inventory['objects'].pop(moid, None)
+
+
+def update_inventory(logger, inventory, maxwait):
+    """
+    Waits up to maxwait seconds for property collector updates and applies them to the live inventory
+    """
+
+    wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=maxwait)
+    update_set = inventory['collector'].WaitForUpdatesEx(inventory['version'], wait_options)
+    while update_set:
+        with inventory['lock']:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    moid = object_update.obj._moId
+                    if object_update.kind == 'leave':
+                        logger.info('Object %s has been removed from the inventory' % inventory['objects'].get(moid, {}).get('name', moid))
+                        inventory['objects'].pop(moid, None)
+                        continue
+                    properties = inventory['objects'].setdefault(moid, {})
+                    for change in object_update.changeSet:
+                        if change.op in ['remove', 'indirectRemove']:
+                            properties.pop(change.name, None)
+                        else:
+                            properties[change.name] = change.val
+                    logger.debug('Inventory update for %s: %s' % (properties.get('name', moid), ', '.join('%s=%s' % (change.name, change.val) for change in object_update.changeSet)))
+            inventory['version'] = update_set.version
+        if not update_set.truncated:
+            break
+        update_set = inventory['collector'].WaitForUpdatesEx(inventory['version'], vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0))
+
+
+def inventory_watch_handler(logger, inventory):
+    """
+    Keeps the live inventory current until it is stopped
+    """
+
+    while not inventory['stop'].is_set():
+        try:
+            update_inventory(logger, inventory, 10)
+        except vmodl.MethodFault as e:
+            logger.warning('Live inventory update failed, retrying in 5 seconds: %s' % e.msg)
+            sleep(5)
+        except Exception as e:
+            logger.warning('Live inventory update failed, retrying in 5 seconds: %s' % str(e))
+            sleep(5)
+
+
+def start_inventory_watch(si, logger, vms, hosts):
+    """
+    Creates the live inventory of the VMs and hosts, loads the current state and starts the thread that keeps it current
+    """
+
+    inventory = {
+        'lock': threading.Lock(),
+        'objects': {},
+        'collector': si.content.propertyCollector.CreatePropertyCollector(),
+        'filters': [],
+        'version': '',
+        'stop': threading.Event(),
+        'thread': None
+    }
+    add_inventory_filter(logger, inventory, vms + hosts)
+    update_inventory(logger, inventory, 0)
+
+    inventory['thread'] = threading.Thread(target=inventory_watch_handler, args=(logger, inventory))
+    inventory['thread'].daemon = True
+    inventory['thread'].start()
+    return inventory
+
+
+def stop_inventory_watch(logger, inventory):
+    """
+    Stops the live inventory thread and removes the property collector
+    """
+
+    logger.debug('Stopping live inventory feed')
+    inventory['stop'].set()
+    try:
+        inventory['collector'].Destroy()
+    except Exception as e:
+        logger.debug('Unable to remove the live inventory property collector: %s' % str(e))
+
+
+def get_inventory_property(inventory, obj, name, default=None):
+    """
+    Returns a property of a VM or host from the live inventory
+    """
+
+    if obj is None:
+        return default
+    with inventory['lock']:
+        return inventory['objects'].get(obj._moId, {}).get(name, default)
+
+
+def is_vm_eligible(inventory, vm):
+    """
+    A VM can be migrated if it still exists and is powered on
+    """
+
+    return get_inventory_property(inventory, vm, 'runtime.powerState') == vim.VirtualMachine.PowerState.poweredOn
+
+
+def is_host_eligible(inventory, host):
+    """
+    A host can receive a VM if it still exists, is connected and is not in maintenance mode
+    """
+
+    return get_inventory_property(inventory, host, 'runtime.connectionState') == vim.HostSystem.ConnectionState.connected and not get_inventory_property(inventory, host, 'runtime.inMaintenanceMode', True)
+
+
+def get_retry_settings(retries, delay, budget, threshold, cooldown):
+    """
+    Returns the retry and circuit breaker settings shared by all vMotions, or None if both are disabled
+    """
+
+    if not retries and not threshold:
+        return None
+    return {'lock': threading.Lock(), 'retries': retries, 'delay': delay, 'budget': budget, 'budgets': {}, 'threshold': threshold, 'cooldown': cooldown, 'breakers': {}}
+
+
+def is_host_blocked(retry, host):
+    """
+    A host does not receive new vMotions while its circuit breaker is open and its cooldown has not passed
+    """
+
+    if retry is None or not retry['threshold']:
+        return False
+    with retry['lock']:
+        breaker = retry['breakers'].get(host._moId)
+        return breaker is not None and breaker['failures'] >= retry['threshold'] and time() < breaker['until']
+
+
+def is_breaker_open(logger, retry, host):
+    """
+    Checks the circuit breaker of the target host of a vMotion. Once the cooldown of an open breaker has passed, a single vMotion is let through to test whether the host has recovered.
+    """
+
+    now = time()
+    with retry['lock']:
+        breaker = retry['breakers'].get(host._moId)
+        if not retry['threshold'] or breaker is None or breaker['failures'] < retry['threshold']:
+            return False
+        if now < breaker['until']:
+            logger.warning('Circuit breaker of host %s is open for %s more seconds, not migrating', host._moId, int(breaker['until'] - now))
+            return True
+        logger.info('Testing host %s after its circuit breaker cooldown', host._moId)
+        breaker['until'] = now + retry['cooldown']
+    return False
+
+
+def record_breaker(logger, retry, host, fault):
+    """
+    Records the outcome of a vMotion in the circuit breaker of its target host. A success closes the breaker, it opens after the threshold of failures in a row.
+    """
+
+    with retry['lock']:
+        breaker = retry['breakers'].setdefault(host._moId, {'failures': 0, 'until': 0})
+        if fault is None:
+            breaker['failures'] = 0
+        elif isinstance(fault, TARGET_FAULTS):
+            breaker['failures'] += 1
+            if retry['threshold'] and breaker['failures'] >= retry['threshold']:
+                logger.warning('Circuit breaker of host %s is open for %s seconds after %s failures in a row', host._moId, retry['cooldown'], breaker['failures'])
+                breaker['until'] = time() + retry['cooldown']
+
+
+def get_retry_delay(logger, retry, fault, attempt):
+    """
+    Returns the amount of seconds to wait before retrying a vMotion after a fault, or None if it should not be retried. Only transient faults are retried, within the amount of retries per vMotion and the retry budget of the fault over the whole run. The delay doubles with each attempt and half of it is random, to spread out the retries of many vMotions.
+    """
+
+    if retry is None or attempt > retry['retries'] or not isinstance(fault, TRANSIENT_FAULTS):
+        return None
+    fault_name = type(fault).__name__
+    with retry['lock']:
+        used = retry['budgets'].get(fault_name, 0)
+        if used >= retry['budget']:
+            logger.warning('Retry budget for %s faults is used up, not retrying', fault_name)
+            return None
+        retry['budgets'][fault_name] = used + 1
+    delay = min(RETRY_MAX_DELAY, retry['delay'] * 2 ** (attempt - 1))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def vm_vmotion_handler(si, logger, vm, host, interval, stats, inventory, retry=None, recorder=None):
     """
     Will handle the thread handling to vMotion a virtual machine
     """
 
-    logger.debug('THREAD %s - started' % vm.name)
+    vm_name = get_inventory_property(inventory, vm, 'name', vm._moId)
+    host_name = get_inventory_property(inventory, host, 'name', host._moId)
+    source_host = get_inventory_property(inventory, vm, 'runtime.host')
+    source_name = get_inventory_property(inventory, source_host, 'name', source_host._moId if source_host else None)
+    logger = get_vm_logger(logger, vm_name)
+    logger.debug('started')
 
-    # Getting resource pool
-    resource_pool = vm.resourcePool
+    # Recording the task once a thread starts it, a task can wait in the pool when all threads are busy
+    record_schedule(recorder, time() - stats['start'], vm_name, host_name)
 
-    # Checking powerstate
-    if vm.runtime.powerState != 'poweredOn':
-        logger.warning('THREAD %s - VM is not powered on, vMotion is only available for powered on VMs.' % vm.name)
+    # Checking powerstate and target host state, they might have changed since the task was scheduled
+    if not is_vm_eligible(inventory, vm):
+        logger.warning('VM is not powered on or does not exist anymore, vMotion is only available for powered on VMs.')
+        record_migration(stats, vm_name, source_name, host_name, 0.0, 0.0, 'skipped')
+        return 0
+    if not is_host_eligible(inventory, host):
+        logger.warning('Host %s is not connected or in maintenance mode, not migrating.', host_name)
+        record_migration(stats, vm_name, source_name, host_name, 0.0, 0.0, 'skipped')
         return 0
 
+    # Getting resource pool
+    resource_pool = vm.resourcePool
+
     # Setting migration priority
     migrate_priority = vim.VirtualMachine.MovePriority.defaultPriority
 
-    # Starting migration
-    logger.debug('THREAD %s - Starting migration to host %s' % (vm.name, host.name))
-    migrate_task = vm.Migrate(pool=resource_pool, host=host, priority=migrate_priority)
-
-    run_loop = True
-    while run_loop:
-        info = migrate_task.info
-        logger.debug('THREAD %s - Checking vMotion task' % vm.name)
-        if info.state == vim.TaskInfo.State.success:
-            logger.debug('THREAD %s - vMotion finished' % vm.name)
-            run_loop = False
+    # Starting migration, retrying it after transient faults
+    attempt = 0
+    while True:
+        attempt += 1
+        if retry is not None and is_breaker_open(logger, retry, host):
+            record_migration(stats, vm_name, source_name, host_name, 0.0, 0.0, 'skipped')
             break
-        elif info.state == vim.TaskInfo.State.running:
-            logger.debug('THREAD %s - vMotion task is at %s percent' % (vm.name, info.progress))
-        elif info.state == vim.TaskInfo.State.queued:
-            logger.debug('THREAD %s - vMotion task is queued' % vm.name)
-        elif info.state == vim.TaskInfo.State.error:
-            if info.error.fault:
-                logger.info('THREAD %s - vMotion task has quit with error: %s' % (vm.name, info.error.fault.faultMessage))
-            else:
-                logger.info('THREAD %s - vMotion task has quit with cancelation' % vm.name)
-            run_loop = False
+
+        logger.debug('Starting migration to host %s', host_name)
+        submitted = time()
+        info = None
+        fault = None
+        try:
+            migrate_task = vm.Migrate(pool=resource_pool, host=host, priority=migrate_priority)
+        except vmodl.MethodFault as e:
+            logger.info('vMotion task could not be created: %s', e.msg)
+            fault = e
+            outcome = 'error'
+
+        while fault is None:
+            info = migrate_task.info
+            logger.debug('Checking vMotion task')
+            if info.state == vim.TaskInfo.State.success:
+                logger.debug('vMotion finished')
+                outcome = 'success'
+                break
+            elif info.state == vim.TaskInfo.State.running:
+                logger.debug('vMotion task is at %s percent', info.progress)
+            elif info.state == vim.TaskInfo.State.queued:
+                logger.debug('vMotion task is queued')
+            elif info.state == vim.TaskInfo.State.error:
+                fault = info.error
+                if isinstance(fault, vmodl.fault.RequestCanceled):
+                    logger.info('vMotion task has quit with cancelation')
+                    outcome = 'cancelled'
+                else:
+                    logger.info('vMotion task has quit with error: %s', fault.msg)
+                    outcome = 'error'
+                break
+            logger.debug('Sleeping 1 second for new check')
+            sleep(1)
+
+        if info is not None:
+            queued, running = task_durations(info, submitted, time())
+        else:
+            queued, running = 0.0, time() - submitted
+        if retry is not None:
+            record_breaker(logger, retry, host, fault)
+        delay = None
+        if outcome == 'error':
+            delay = get_retry_delay(logger, retry, fault, attempt)
+        if delay is None:
+            record_migration(stats, vm_name, source_name, host_name, queued, running, outcome)
             break
-        logger.debug('THREAD %s - Sleeping 1 second for new check' % vm.name)
-        sleep(1)
+        record_migration(stats, vm_name, source_name, host_name, queued, running, 'retried')
+        logger.info('Retrying vMotion in %.1f seconds after a %s fault (attempt %s of %s)', delay, type(fault).__name__, attempt + 1, retry['retries'] + 1)
+        sleep(delay)
 
-    logger.debug('THREAD %s - Waiting %s seconds (interval) before ending the thread and releasing it for a new task' % (vm.name, interval))
+    logger.debug('Waiting %s seconds (interval) before ending the thread and releasing it for a new task', interval)
     sleep(interval)
 
 
@@ -134,6 +704,8 @@ def main():
     # Handling arguments
     args = get_args()
     onerun = args.onerun
+    breaker_cooldown = args.breaker_cooldown[0]
+    breaker_threshold = args.breaker_threshold[0]
     debug = args.debug
     host = args.host[0]
     interval = args.interval[0]
@@ -141,15 +713,36 @@ def main():
     if args.logfile:
         log_file = args.logfile[0]
     port = args.port[0]
+    recordfile = None
+    if args.recordfile:
+        recordfile = args.recordfile[0]
+    replayfile = None
+    if args.replayfile:
+        replayfile = args.replayfile[0]
+    reload_interval = args.reload_interval[0]
+    retries = args.retries[0]
+    retry_budget = args.retry_budget[0]
+    retry_delay = args.retry_delay[0]
+    seed = None
+    if args.seed is not None:
+        seed = args.seed[0]
     password = None
     if args.password:
         password = args.password[0]
     nosslcheck = args.nosslcheck
-    targetfile = args.targetfile[0]
+    statsfile = None
+    if args.statsfile:
+        statsfile = args.statsfile[0]
+    stats_max_size = args.stats_max_size[0]
+    targetfile = None
+    if args.targetfile:
+        targetfile = args.targetfile[0]
     threads = args.threads[0]
     username = args.username[0]
     verbose = args.verbose
-    vmfile = args.vmfile[0]
+    vmfile = None
+    if args.vmfile:
+        vmfile = args.vmfile[0]
 
     # Logging settings
     if debug:
@@ -165,19 +758,54 @@ def main():
         logging.basicConfig(filename=log_file, format='%(asctime)s %(levelname)s %(message)s', level=log_level)
     logger = logging.getLogger(__name__)
 
+    # Statistics settings
+    stats = {
+        'lock': threading.Lock(),
+        'records': [],
+        'start': time(),
+        'file_logger': None
+    }
+    if statsfile:
+        logger.debug('Appending migration statistics to %s' % statsfile)
+        stats_handler = logging.handlers.RotatingFileHandler(statsfile, maxBytes=stats_max_size * 1024 * 1024, backupCount=5)
+        stats_handler.setFormatter(logging.Formatter('%(message)s'))
+        stats['file_logger'] = logging.getLogger('%s.stats' % __name__)
+        stats['file_logger'].propagate = False
+        stats['file_logger'].setLevel(logging.INFO)
+        stats['file_logger'].addHandler(stats_handler)
+
+    if replayfile is None and (vmfile is None or targetfile is None):
+        logger.critical('A VM file and a target file are required when no schedule is replayed, exiting')
+        return 1
+
+    # Retry budgets and circuit breakers shared by all vMotions
+    retry = get_retry_settings(retries, retry_delay, retry_budget, breaker_threshold, breaker_cooldown)
+
+    # Randomness and schedule recording
+    logger.debug('Seeding random host selection with %s' % seed)
+    rng = random.Random(seed)
+    recorder = None
+    if recordfile:
+        logger.debug('Recording schedule to %s' % recordfile)
+        recorder = {'file': open_csv_file(recordfile, 'w'), 'lock': threading.Lock()}
+        recorder['writer'] = csv.writer(recorder['file'], delimiter=';', quotechar="'")
+        atexit.register(recorder['file'].close)
+
     # Getting user password
     if password is None:
         logger.debug('No command line password received, requesting password from user')
         password = getpass.getpass(prompt='Enter password for vCenter %s for user %s: ' % (host, username))
 
+    logger.debug('Loading the vSphere modules')
+    import_vsphere_modules()
+
+    pool = None
+    pool_results = None
     try:
         si = None
         try:
             logger.info('Connecting to server %s:%s with username %s' % (host, port, username))
-            if nosslcheck:
-                si = SmartConnectNoSSL(host=host, user=username, pwd=password, port=int(port))
-            else:
-                si = SmartConnect(host=host, user=username, pwd=password, port=int(port))
+            si = smart_connect(host, username, password, int(port), nosslcheck)
         except IOError as e:
             pass
 
@@ -188,83 +816,82 @@ def main():
         logger.debug('Registering disconnect at exit')
         atexit.register(Disconnect, si)
 
-        # Handling vms file
-        logger.debug('Parsing VMs %s' % vmfile)
-
-        if not os.path.isfile(vmfile):
-            logger.critical('VM file %s does not exist, exiting' % vmfile)
-            return 1
-
-        # Getting VMs
-        vms = []
-        content = si.content
-        obj_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
-        vm_list = obj_view.view
-        with open(vmfile, 'rb') as tasklist:
-            taskreader = csv.reader(tasklist, delimiter=';', quotechar="'")
-            for row in taskreader:
-                logger.debug('Found CSV row: %s' % ','.join(row))
-                # VM Name
-                if row[0] is None or row[0] is '':
-                    logger.warning('No VM name specified, skipping this vm')
-                    continue
-                else:
-                    cur_vm_name = row[0]
-
-                # Finding VM
-                found_vm = False
-                for vm in vm_list:
-                    if vm.name == cur_vm_name:
-                        logger.debug('Found VM %s' % cur_vm_name)
-                        vms.append(vm)
-                        found_vm = True
-                        # Removing VM out of the list to speed up further lookups
-                        vm_list.remove(vm)
-                        break
-
-                if not found_vm:
-                    logger.warning('VM %s does not exist, skipping this vm' % cur_vm_name)
-
-        # Getting hosts
-        obj_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.HostSystem], True)
-        host_list = obj_view.view
-        hosts = []
-        with open(targetfile, 'rb') as tasklist:
-            taskreader = csv.reader(tasklist, delimiter=';', quotechar="'")
-            for row in taskreader:
-                logger.debug('Found CSV row: %s' % ','.join(row))
-                # Host Name
-                if row[0] is None or row[0] is '':
-                    logger.warning('No host name specified, skipping this host')
-                    continue
-                else:
-                    cur_host_name = row[0]
-
-                found_host = False
-                for host in host_list:
-                    if host.name == cur_host_name:
-                        logger.debug('Found Host %s' % cur_host_name)
-                        hosts.append(host)
-                        found_host = True
-                        # Removing Host out of the list to speed up further lookups
-                        host_list.remove(host)
-                        break
-
-                if not found_host:
-                    logger.warning('Host %s does not exist, skipping this host' % cur_host_name)
+        schedule = None
+        if replayfile:
+            # Handling the schedule file
+            logger.debug('Parsing schedule %s' % replayfile)
+
+            if not os.path.isfile(replayfile):
+                logger.critical('Schedule file %s does not exist, exiting' % replayfile)
+                return 1
+
+            # Getting VMs and hosts from the schedule
+            schedule = read_schedule_file(logger, replayfile)
+            vm_objs = find_objs_by_name(si, logger, set(entry[1] for entry in schedule), vim.VirtualMachine)
+            host_objs = find_objs_by_name(si, logger, set(entry[2] for entry in schedule), vim.HostSystem)
+            for name in set(entry[1] for entry in schedule if entry[1] not in vm_objs):
+                logger.warning('VM %s does not exist, skipping its vMotion tasks' % name)
+            for name in set(entry[2] for entry in schedule if entry[2] not in host_objs):
+                logger.warning('Host %s does not exist, skipping vMotion tasks to it' % name)
+            vms = list(vm_objs.values())
+            hosts = list(host_objs.values())
+        else:
+            # Handling vms and targets file
+            logger.debug('Parsing VMs %s and hosts %s' % (vmfile, targetfile))
+
+            if not os.path.isfile(vmfile):
+                logger.critical('VM file %s does not exist, exiting' % vmfile)
+                return 1
+
+            if not os.path.isfile(targetfile):
+                logger.critical('Target file %s does not exist, exiting' % targetfile)
+                return 1
+
+            # Getting VMs and hosts
+            vms, vm_objs = load_names_file(si, logger, vmfile, 'VM', vim.VirtualMachine, {})
+            hosts, host_objs = load_names_file(si, logger, targetfile, 'Host', vim.HostSystem, {})
+            files_mtime = get_files_mtime([vmfile, targetfile])
+            last_reload_check = time()
+
+        # Starting the live inventory feed
+        logger.debug('Starting live inventory feed for %s VMs and %s hosts' % (len(vms), len(hosts)))
+        inventory = start_inventory_watch(si, logger, vms, hosts)
+        atexit.register(stop_inventory_watch, logger, inventory)
 
         if len(vms) < threads:
-            logger.warning('Amount of threads %s can not be higher than amount of vms: Setting amount of threads to %s' % (threads, len(vms)))
-            threads = len(vms)
+            logger.warning('Amount of threads %s is higher than amount of vms: Only %s vMotions will run at once until more VMs are added' % (threads, len(vms)))
 
         # Pool handling
+        stats['start'] = time()
         logger.debug('Setting up pools and threads')
         pool = ThreadPool(threads)
         pool_results = []
         logger.debug('Pools created with %s threads' % threads)
 
+        if schedule is not None:
+            # Replaying the schedule, each task is created at its recorded time offset
+            logger.info('Replaying %s vMotion tasks' % len(schedule))
+            for offset, vm_name, host_name in schedule:
+                delay = stats['start'] + offset - time()
+                if delay > 0:
+                    logger.debug('Waiting %.3f seconds for the next vMotion task' % delay)
+                    sleep(delay)
+                if vm_name not in vm_objs or host_name not in host_objs:
+                    continue
+                busy = len([result for result in pool_results if not result.ready()])
+                if busy >= threads:
+                    logger.warning('All %s threads are busy, the vMotion task for VM %s at offset %.3f will start late. Use more threads to replay the schedule with the same timing' % (threads, vm_name, offset))
+                logger.info('Creating vMotion task for VM %s to host %s at offset %.3f' % (vm_name, host_name, offset))
+                pool_results.append(pool.apply_async(vm_vmotion_handler, (si, logger, vm_objs[vm_name], host_objs[host_name], interval, stats, inventory, retry, recorder)))
+            logger.debug('All vMotion tasks of the schedule are created. Finishing.')
+            wait_for_pool_end(logger, pool, pool_results)
+            print_stats_report(stats)
+            run_loop = False
+        else:
+            run_loop = True
+
         vm_index = 0
-        run_loop = True
+        skipped_in_row = 0
         while run_loop:
             # Check if a pool_result is finished
             for result in pool_results:
@@ -272,22 +899,70 @@ def main():
                     logger.debug('Removing finished task from the pool results')
                     pool_results.remove(result)
 
+            # Reload the VM and targets files if they changed
+            if reload_interval > 0 and time() - last_reload_check >= reload_interval:
+                last_reload_check = time()
+                new_files_mtime = get_files_mtime([vmfile, targetfile])
+                if new_files_mtime != files_mtime and None not in new_files_mtime:
+                    logger.info('VM or target file changed, reloading')
+                    files_mtime = new_files_mtime
+                    new_vms, new_vm_objs = load_names_file(si, logger, vmfile, 'VM', vim.VirtualMachine, vm_objs)
+                    new_hosts, new_host_objs = load_names_file(si, logger, targetfile, 'Host', vim.HostSystem, host_objs)
+                    added = [obj for name, obj in new_vm_objs.items() if name not in vm_objs] + [obj for name, obj in new_host_objs.items() if name not in host_objs]
+                    removed_vms = [obj for name, obj in vm_objs.items() if name not in new_vm_objs]
+                    removed_hosts = [obj for name, obj in host_objs.items() if name not in new_host_objs]
+                    add_inventory_filter(logger, inventory, added)
+                    remove_inventory_objects(logger, inventory, removed_vms + removed_hosts)
+                    logger.info('Reloaded files: %s VMs and %s hosts, %s VMs and %s hosts removed, %s objects added' % (len(new_vms), len(new_hosts), len(removed_vms), len(removed_hosts), len(added)))
+                    # Swapping the schedule, running migrations keep their own VM and host
+                    if vm_index < len(vms) and vms[vm_index] in new_vms:
+                        vm_index = new_vms.index(vms[vm_index])
+                    else:
+                        vm_index = 0
+                    vms, vm_objs, hosts, host_objs = new_vms, new_vm_objs, new_hosts, new_host_objs
+                    skipped_in_row = 0
+
+            # Without VMs, wait for the VM file to change
+            if not vms:
+                logger.debug('No VMs to vMotion. Waiting 1 second to check again')
+                sleep(1)
+                continue
+
             # If the pool is still filled, continue
-            if len(pool_results) >= threads:
+            if len(pool_results) >= min(threads, len(vms)):
                 logger.debug('All threads running, not creating new vMotion tasks. Waiting 1 second to check again')
                 sleep(1)
                 continue
 
-            # If not, create new task (selects next VM, selects random host)
+            # If all VMs were skipped since the last scheduled task, wait for the inventory to change
+            if skipped_in_row >= len(vms):
+                logger.debug('No VM can be migrated to any of the hosts. Waiting 1 second to check again')
+                skipped_in_row = 0
+                sleep(1)
+
+            # If not, create new task (selects next VM, selects random eligible host)
             vm = vms[vm_index]
-            host = random.choice(hosts)
-            logger.info('Creating vMotion task for VM %s to host %s' % (vm.name, host.name))
-            pool_results.append(pool.apply_async(vm_vmotion_handler, (si, logger, vm, host, interval)))
+            vm_name = get_inventory_property(inventory, vm, 'name', vm._moId)
+            source_host = get_inventory_property(inventory, vm, 'runtime.host')
+            target_hosts = [target_host for target_host in hosts if target_host != source_host and is_host_eligible(inventory, target_host) and not is_host_blocked(retry, target_host)]
+            if not is_vm_eligible(inventory, vm):
+                logger.debug('VM %s is not powered on or does not exist anymore, skipping' % vm_name)
+                skipped_in_row += 1
+            elif not target_hosts:
+                logger.debug('No connected host out of maintenance mode and with a closed circuit breaker available for VM %s, skipping' % vm_name)
+                skipped_in_row += 1
+            else:
+                host = rng.choice(target_hosts)
+                host_name = get_inventory_property(inventory, host, 'name', host._moId)
+                logger.info('Creating vMotion task for VM %s to host %s' % (vm_name, host_name))
+                pool_results.append(pool.apply_async(vm_vmotion_handler, (si, logger, vm, host, interval, stats, inventory, retry, recorder)))
+                skipped_in_row = 0
 
             vm_index += 1
             if vm_index >= len(vms) and onerun:
                 logger.debug('One-run is enabled, all VMs are scheduled to vMotion. Finishing.')
                 wait_for_pool_end(logger, pool, pool_results)
+                print_stats_report(stats)
                 run_loop = False
                 break
 
@@ -299,6 +974,7 @@ def main():
         logger.info('Received interrupt, finishing running threads and not creating any new migrations')
         if pool is not None and pool_results is not None:
             wait_for_pool_end(logger, pool, pool_results)
+        print_stats_report(stats)
 
     except vmodl.MethodFault as e:
         logger.critical('Caught vmodl fault: %s' % e.msg)
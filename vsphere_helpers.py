@@ -0,0 +1,202 @@
+"""
+vsphere_helpers contains the connection, transfer statistics, property retrieval, lookup and logging helpers shared by the scripts in this repository. It has to be kept next to the scripts.
+
+pyVmomi is only imported when a helper is used, so the scripts can import this module without slowing down their start.
+
+--- Author ---
+Philippe Dellaert <philippe@dellaert.org>
+
+--- License ---
+https://raw.github.com/pdellaert/vSphere-Python/master/LICENSE.md
+
+"""
+from __future__ import print_function
+import logging
+import struct
+import sys
+import threading
+import zlib
+
+# Transport settings of the vCenter connections and the bytes of the SOAP responses, counted when the transfer statistics are enabled
+transport = {'compress': False, 'page_size': None, 'stats': False, 'lock': threading.Lock(), 'responses': 0, 'wire': 0, 'decompressed': 0}
+
+
+class VMLoggerAdapter(logging.LoggerAdapter):
+    """
+    Logger of the threads handling a single virtual machine, which adds its name to the records as vm. The VMPrefixFilter of the logger prefixes the messages with it.
+    """
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(kwargs.get('extra') or {}, **self.extra)
+        return msg, kwargs
+
+
+class VMPrefixFilter(logging.Filter):
+    """
+    Prefixes the message of each record of a virtual machine with its name. The name is only escaped for messages with arguments, as only those are formatted.
+    """
+
+    def filter(self, record):
+        vm = getattr(record, 'vm', None)
+        if vm is not None and not getattr(record, 'vm_prefixed', False):
+            record.msg = 'THREAD %s - %s' % (vm.replace('%', '%%') if record.args else vm, record.msg)
+            record.vm_prefixed = True
+        return True
+
+
+def get_vm_logger(logger, vm_name):
+    """
+    Returns a logger for the threads handling a virtual machine, which prefixes the messages with its name
+    """
+
+    if isinstance(logger, VMLoggerAdapter):
+        logger = logger.logger
+    if not any(isinstance(log_filter, VMPrefixFilter) for log_filter in logger.filters):
+        logger.addFilter(VMPrefixFilter())
+    return VMLoggerAdapter(logger, {'vm': vm_name})
+
+
+def smart_connect(host, user, pwd, port, nosslcheck=False, **kwargs):
+    """
+    Connects to a vCenter or ESXi host and returns the service instance. Without SSL certificate verification, SmartConnectNoSSL is used on the pyVmomi versions which still have it, newer versions take disableSslCertValidation instead.
+    """
+
+    from pyVim.connect import SmartConnect
+
+    if not nosslcheck:
+        return SmartConnect(host=host, user=user, pwd=pwd, port=port, **kwargs)
+    try:
+        from pyVim.connect import SmartConnectNoSSL
+    except ImportError:
+        return SmartConnect(host=host, user=user, pwd=pwd, port=port, disableSslCertValidation=True, **kwargs)
+    return SmartConnectNoSSL(host=host, user=user, pwd=pwd, port=port, **kwargs)
+
+
+def get_connect_args():
+    """
+    Returns the extra SmartConnect arguments for the transport settings, compression is requested with a custom HTTP header
+    """
+
+    if transport['compress']:
+        return {'customHeaders': {'Accept-Encoding': 'gzip'}}
+    return {}
+
+
+def record_transfer(wire, decompressed, responses=0):
+    """
+    Adds the bytes of SOAP responses to the transfer statistics
+    """
+
+    with transport['lock']:
+        transport['wire'] += wire
+        transport['decompressed'] += decompressed
+        transport['responses'] += responses
+
+
+def count_response(resp):
+    """
+    Counts the body of an HTTP response in the transfer statistics as it is read. The decompressed size of a gzip body is taken from its trailer, so it is not decompressed twice. A deflate body has no such trailer, so a copy of it is decompressed to count it.
+    """
+
+    read = resp.read
+    encoding = (resp.getheader('Content-Encoding') or '').lower()
+    state = {'tail': b'', 'done': False, 'unzip': None}
+
+    def counting_read(*args):
+        data = read(*args)
+        if data:
+            state['tail'] = (state['tail'] + data)[-4:]
+            if encoding == 'deflate':
+                if state['unzip'] is None:
+                    # The body is either zlib wrapped or raw deflate, a zlib header uses method 8 and is a multiple of 31
+                    header = bytearray(data[:2])
+                    wrapped = len(header) == 2 and header[0] & 0x0f == 8 and (header[0] * 256 + header[1]) % 31 == 0
+                    state['unzip'] = zlib.decompressobj(zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+                record_transfer(len(data), len(state['unzip'].decompress(data)))
+            else:
+                record_transfer(len(data), 0 if encoding == 'gzip' else len(data))
+        elif not state['done']:
+            state['done'] = True
+            if encoding == 'deflate' and state['unzip'] is not None:
+                record_transfer(0, len(state['unzip'].flush()), 1)
+            else:
+                record_transfer(0, struct.unpack('<I', state['tail'])[0] if encoding == 'gzip' and len(state['tail']) == 4 else 0, 1)
+        return data
+
+    resp.read = counting_read
+    return resp
+
+
+def count_transfer(si):
+    """
+    Counts the SOAP responses of a session in the transfer statistics. Only new connections are counted, so the open connections of the session are dropped.
+    """
+
+    stub = getattr(si._stub, 'soapStub', si._stub)
+    scheme = stub.scheme
+
+    def counting_scheme(*args, **kwargs):
+        conn = scheme(*args, **kwargs)
+        getresponse = conn.getresponse
+        conn.getresponse = lambda *args, **kwargs: count_response(getresponse(*args, **kwargs))
+        return conn
+
+    stub.scheme = counting_scheme
+    stub.DropConnections()
+
+
+def print_transfer_stats(label):
+    """
+    Prints the bytes of the SOAP responses on the wire and after decompression to stderr
+    """
+
+    with transport['lock']:
+        responses, wire, decompressed = transport['responses'], transport['wire'], transport['decompressed']
+    saved = (100.0 * (decompressed - wire) / decompressed) if decompressed else 0.0
+    print('%s: %s SOAP responses, %s bytes on the wire, %s bytes decompressed (%.1f%% saved)' % (label, responses, wire, decompressed, saved), file=sys.stderr)
+
+
+def get_properties(si, logger, vimtype, properties, root=None, objs=None, page_size=None):
+    """
+    Retrieve properties of objects with a paged property retrieval and yield an object and property dict tuple for each object as its page arrives. Either all objects of the type in a container view rooted at root (default = root folder) are retrieved, or only the given objects. The page size is the maximum amount of objects in each page (default = decided by vCenter).
+    """
+
+    from pyVmomi import vim, vmodl
+
+    content = si.content
+    obj_view = None
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    if objs is not None:
+        if not objs:
+            return
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objs]
+    else:
+        obj_view = content.viewManager.CreateContainerView(root or content.rootFolder, [vimtype], True)
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView', path='view', skip=False, type=vim.view.ContainerView)
+        filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj_view, skip=True, selectSet=[traversal_spec])]
+    filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=properties)]
+
+    try:
+        result = content.propertyCollector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size))
+        while result:
+            for obj_content in result.objects:
+                yield obj_content.obj, dict((prop.name, prop.val) for prop in obj_content.propSet)
+            if not result.token:
+                break
+            result = content.propertyCollector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        if obj_view is not None:
+            obj_view.Destroy()
+
+
+def find_obj(si, logger, name, vimtype, root=None, page_size=None):
+    """
+    Find an object in vSphere by it's name and return it. Only the names are retrieved, with a paged property retrieval.
+    """
+
+    for obj, properties in get_properties(si, logger, vimtype, ['name'], root=root, page_size=page_size):
+        logger.debug('Checking object "%s"', properties.get('name'))
+        if properties.get('name') == name:
+            logger.debug('Found object %s', name)
+            return obj
+    return None